@@ -5,7 +5,14 @@
     ~~~~~~
 """
 
+from __future__ import absolute_import
+
+import os
+import re
 import sys
+import shutil
+import subprocess
+import multiprocessing
 import numpy as np
 from scipy.stats import entropy
 
@@ -144,6 +151,247 @@ def formatpileup(infile, idxfile, outfile, outfile2):
 
 # -------------------------------------
 
+# the CIGAR operations which cover the reference, as mpileup counts them (deletions included),
+# and those which take up bases of the read
+cigar_op = re.compile(r'(\d+)([MIDNSHP=X])')
+cigar_ref = set('MD=X')
+cigar_query = set('MIS=X')
+
+def depth_array(starts, ends, length, maxdepth):
+    """
+    Return the depth at each position of a contig (a numpy array, zeros where nothing covers it)
+    given the (0-based) starts and (exclusive) ends of the blocks of reads which cover it
+    """
+
+    # +1 where each block starts, -1 where it ends: the running sum is the depth
+    ends = np.minimum(np.array(ends, dtype=np.int64), length)
+    diff = np.bincount(np.array(starts, dtype=np.int64), minlength=length + 1)[:length + 1] - np.bincount(ends, minlength=length + 1)
+    depth = np.cumsum(diff[:length])
+
+    return np.minimum(depth, maxdepth) if maxdepth else depth
+
+def coverage_metrics(depth):
+    """Return (breadth, mean depth, coefficient of variation) of a contig's depth array (the last is nan if nothing covers it)"""
+
+    mean = depth.mean()
+    return (np.count_nonzero(depth) / float(len(depth)), mean, depth.std() / mean if mean else float('nan'))
+
+def sam_depths(lines, lengths, maxdepth, minqual):
+    """
+    Return a dict which maps each contig to its depth array, from sam records sorted by position
+    (those mpileup counts), counting only the bases whose quality is at least minqual (deletions
+    count, as they do for mpileup, whose -Q, 13 by default, this is)
+
+    lines: the sam records (no header)
+    lengths: dict which maps each contig to its length
+    """
+
+    depths = {}
+    # the quality of the worst base to count, in phred+33, and runs of bases at least that good
+    minchar = chr(33 + minqual)
+    goodqual = re.compile('[' + re.escape(minchar) + '-~]+')
+
+    myid = None
+    (starts, ends) = ([], [])
+    for line in lines:
+        fields = line.split('\t', 11)
+        if fields[2] != myid:
+            if myid:
+                depths[myid] = depth_array(starts, ends, lengths[myid], maxdepth)
+            (myid, starts, ends) = (fields[2], [], [])
+        pos = int(fields[3]) - 1
+        cigar = fields[5]
+        qual = fields[10].rstrip('\n')
+        # ('*': no qualities, which counts as good enough, as it does for mpileup)
+        lowqual = qual != '*' and min(qual) < minchar
+        # most reads are one block, of good quality throughout
+        if not lowqual and cigar[-1] == 'M' and cigar[:-1].isdigit():
+            starts.append(pos)
+            ends.append(pos + int(cigar[:-1]))
+            continue
+        qpos = 0
+        for (n, op) in cigar_op.findall(cigar):
+            n = int(n)
+            if op in cigar_ref:
+                if op == 'D' or not lowqual:
+                    starts.append(pos)
+                    ends.append(pos + n)
+                else:
+                    # only the runs of good enough bases
+                    for m in goodqual.finditer(qual, qpos, qpos + n):
+                        starts.append(pos + m.start() - qpos)
+                        ends.append(pos + m.end() - qpos)
+            if op in cigar_ref or op == 'N':
+                pos += n
+            if op in cigar_query:
+                qpos += n
+    if myid:
+        depths[myid] = depth_array(starts, ends, lengths[myid], maxdepth)
+
+    return depths
+
+def contig_depths(task):
+    """
+    Work out the depth arrays of a batch of contigs from a coordinate-sorted, indexed bam,
+    going straight to them through the index; write their entropies and depths (for those
+    with any coverage) to files of the batch's own (the latter a part of a coverage store: see coverage.write)
+
+    task: tuple (bam, list of (contig, length), entropy file, depths file or None, maximum depth, minimum base quality)
+
+    Returns a list of (contig, length, breadth, mean depth, coefficient of variation), in the order of the batch
+    """
+
+    (bam, contigs, entropyfile, depthfile, maxdepth, minqual) = task
+
+    # the reads mpileup counts: not unmapped, secondary, QC-failed or duplicates (-F 1796)
+    proc = subprocess.Popen(['samtools', 'view', '-F', '1796', bam] + [i[0] for i in contigs], stdout=subprocess.PIPE, bufsize=1 << 20)
+    depths = sam_depths(proc.stdout, dict(contigs), maxdepth, minqual)
+
+    if proc.wait() != 0:
+        raise RuntimeError('samtools view exited with error code ' + str(proc.returncode) + ' reading ' + bam)
+
+    return write_depths(contigs, depths, entropyfile, depthfile)
+
+def write_depths(contigs, depths, entropyfile, depthfile):
+    """
+    Write the entropies and depths (a part of a coverage store: see coverage.write) of contigs with any coverage
+
+    contigs: list of (contig, length)
+    depths: dict which maps each covered contig to its depth array
+
+    Returns a list of (contig, length, breadth, mean depth, coefficient of variation), in the order of contigs
+    """
+
+    from helpers import coverage as cov
+
+    metrics = []
+    g = open(depthfile, 'wb') if depthfile else None
+    with open(entropyfile, 'w') as h:
+        for (myid, length) in contigs:
+            depth = depths.get(myid)
+            if depth is None:
+                depth = np.zeros(length, dtype=np.int64)
+            metrics.append((myid, length) + coverage_metrics(depth))
+            # (contigs with no coverage at all have no entropy, and no depths in the store)
+            if depth.any():
+                h.write(myid + '\t' + str(norm_entropy(depth)) + '\n')
+                if g:
+                    cov.write_part(g, depth)
+    if g:
+        g.close()
+
+    return metrics
+
+def coverage(bam, idxfile, store, outfile2, outfile3, processes, maxdepth=100000, minqual=13):
+    """
+    Compute the coverage of each contig from a coordinate-sorted, indexed bam,
+    as numpy depth arrays, in parallel batches of contigs read through the index
+
+    Parameters:
+        bam: the reads mapped to the contigs
+        idxfile: samtools idxstats of the bam
+        store: (or None) prefix of the coverage store (store.npy, store.idx) of the depth at every position
+               of every contig (see coverage.py, whose write_pileup writes it out as formatpileup did)
+        outfile2: col1=contig, col2=entropy (intuition: high entropy means uniform coverage, low means a cov spike)
+        outfile3: per-contig metrics: contig, length, breadth (fraction of positions covered), mean depth,
+                  coefficient of variation of the depth
+        processes: the number of processes
+        maxdepth: cap on the depth, as mpileup -d
+        minqual: the least base quality to count, as mpileup -Q
+
+    The depth is that of mpileup -A -B: every base of the reads mpileup counts whose quality is at least
+    minqual, deletions included, and zero where nothing covers the contig.
+
+    Returns:
+        nothing
+    """
+
+    from helpers import coverage as cov
+
+    # contigs in the order of the bam (and so of the mpileup), with their lengths and numbers of reads
+    contigs = idxstats_contigs(idxfile)
+
+    # batches of contigs with reads, each of about the same length, several per process so they even out;
+    # capped in number of contigs, since they go on the command line of samtools view
+    covered = [i for i in contigs if i[2]]
+    numbatches = max(1, 4 * int(processes))
+    target = sum(i[1] for i in covered) / float(numbatches)
+    batches = [[]]
+    size = 0
+    for (myid, length, numreads) in covered:
+        if batches[-1] and (size >= target or len(batches[-1]) >= 1000):
+            batches.append([])
+            size = 0
+        batches[-1].append((myid, length))
+        size += length
+
+    # (no regions would mean the whole bam)
+    tasks = [(bam, batch, outfile2 + '.' + str(k), store + '.' + str(k) if store else None, maxdepth, minqual) for (k, batch) in enumerate(batches) if batch]
+
+    pool = multiprocessing.Pool(int(processes))
+    try:
+        results = pool.map(contig_depths, tasks)
+    finally:
+        pool.close()
+        pool.join()
+
+    # gather the batches in order
+    with open(outfile2, 'wb') as f:
+        for task in tasks:
+            with open(task[2], 'rb') as g:
+                shutil.copyfileobj(g, f, 1 << 20)
+            os.remove(task[2])
+
+    metrics = dict((i[0], i) for batch in results for i in batch)
+
+    if store:
+        # in the order of the batches (the uncovered contigs, in no batch, anywhere: they have no depths)
+        covered = [(i[0], i[1], i[2] > 0) for batch in results for i in batch]
+        inbatch = set(i[0] for i in covered)
+        cov.write(store, covered + [(i[0], i[1], False) for i in contigs if i[0] not in inbatch], [i[3] for i in tasks])
+
+    write_coverage_metrics(contigs, metrics, outfile3)
+
+def idxstats_contigs(idxfile):
+    """Return a list of (contig, length, number of reads) from samtools idxstats, in order (without the unplaced reads)"""
+
+    contigs = []
+    with open(idxfile, 'r') as f:
+        for line in f:
+            fields = line.split()
+            if fields[0] != '*':
+                contigs.append((fields[0], int(fields[1]), int(fields[2])))
+
+    return contigs
+
+def write_coverage_metrics(contigs, metrics, outfile):
+    """Write the coverage metrics of each contig (see write_depths; contigs not in metrics have no coverage)"""
+
+    with open(outfile, 'w') as f:
+        f.write('\t'.join(['contig', 'length', 'breadth', 'mean_depth', 'cv']) + '\n')
+        for (myid, length, numreads) in contigs:
+            (breadth, mean, cv) = metrics[myid][2:] if myid in metrics else (0.0, 0.0, float('nan'))
+            f.write('{}\t{}\t{:.4f}\t{:.2f}\t{:.4f}\n'.format(myid, length, breadth, mean, cv))
+
+def coverage_from_depths(depths, idxfile, store, outfile2, outfile3):
+    """
+    Write the same coverage outputs as coverage, from depth arrays worked out some other way
+    (e.g., by pseudo-alignment: see pseudoalign.py)
+
+    depths: dict which maps each covered contig to its depth array
+    idxfile, store, outfile2, outfile3: as for coverage
+    """
+
+    from helpers import coverage as cov
+
+    contigs = idxstats_contigs(idxfile)
+    metrics = write_depths([i[:2] for i in contigs], depths, outfile2, store + '.0' if store else None)
+    if store:
+        cov.write(store, [(i[0], i[1], i[2] > 0) for i in metrics], [store + '.0'])
+    write_coverage_metrics(contigs, dict((i[0], i) for i in metrics), outfile3)
+
+# -------------------------------------
+
 if __name__ == "__main__":
 
     # to execute as a stand-alone script, give the name of the function 
@@ -0,0 +1,272 @@
+#!/usr/bin/env python
+
+"""
+    Step checkpoints: a completion manifest per step, holding hashes of
+    the step's inputs and parameters, so a rerun can skip finished work
+    ~~~~~~
+"""
+
+import os
+import json
+import fcntl
+import hashlib
+from datetime import datetime
+
+# directory (relative to the sample's working directory) holding the manifests
+checkpointdir = 'checkpoints'
+
+# the state of each step of the sample (running, done, failed, cancelled, skipped)
+statusfile = checkpointdir + '/status.json'
+
+# the jobs pandora submitted for the sample, so a failing step can cancel those downstream of it
+jobsfile = checkpointdir + '/jobs.json'
+
+# -------------------------------------
+
+def manifest_path(step):
+    """Return the path of the manifest for a step"""
+
+    return checkpointdir + '/step_' + step + '.json'
+
+# -------------------------------------
+
+def normalize_params(cmd):
+    """
+    Reduce a step's command to the part that determines its output
+
+    cmd: the shell command of the step (a string)
+    """
+
+    # --verbose only changes what gets printed, so toggling it shouldn't force a rerun
+    words = cmd.split()
+    params = []
+    skip = False
+    for i in words:
+        if skip:
+            skip = False
+        elif i == '--verbose':
+            skip = True
+        else:
+            params.append(i)
+
+    return ' '.join(params)
+
+# -------------------------------------
+
+def file_digest(myfile, cache=None):
+    """
+    Return a dict of the size, mtime and sha1 of a file (None if the file doesn't exist)
+
+    myfile: path of the file
+    cache: (optional) a dict previously returned for this file; if its size and mtime
+           still match, its sha1 is reused rather than re-reading the whole file
+    """
+
+    if not os.path.isfile(myfile):
+        return None
+
+    st = os.stat(myfile)
+
+    if cache and cache.get('size') == st.st_size and cache.get('mtime') == st.st_mtime:
+        return {'size': st.st_size, 'mtime': st.st_mtime, 'sha1': cache['sha1']}
+
+    h = hashlib.sha1()
+    with open(myfile, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+
+    return {'size': st.st_size, 'mtime': st.st_mtime, 'sha1': h.hexdigest()}
+
+# -------------------------------------
+
+def split_files(files):
+    """Flatten a list of files, some of which may be comma-delimited lists or None"""
+
+    myfiles = []
+    for i in files:
+        if i and i != 'None':
+            myfiles.extend(j for j in i.split(',') if j)
+
+    return myfiles
+
+# -------------------------------------
+
+def load_manifest(step):
+    """Return the manifest of a step as a dict (None if there isn't a readable one)"""
+
+    try:
+        with open(manifest_path(step), 'r') as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return None
+
+# -------------------------------------
+
+def write_manifest(step, inputs, outputs, cmd, cache=None):
+    """
+    Record that a step finished
+
+    step: the step (e.g., '1')
+    inputs: list of input files
+    outputs: list of output files
+    cmd: the shell command of the step
+    cache: (optional) dict which maps input files to their digests in an earlier manifest of the step
+           (by default, the current one's), so unchanged inputs aren't read again (see file_digest)
+    """
+
+    if cache is None:
+        cache = (load_manifest(step) or {}).get('inputs', {})
+
+    manifest = {
+        'step': step,
+        'finished': str(datetime.now()),
+        'params': hashlib.sha1(normalize_params(cmd).encode('utf-8')).hexdigest(),
+        'inputs': dict((i, file_digest(i, cache.get(i))) for i in split_files(inputs)),
+        'outputs': split_files(outputs)
+    }
+
+    if not os.path.isdir(checkpointdir):
+        os.makedirs(checkpointdir)
+
+    # write then rename, so a crash never leaves a half-written manifest
+    tmpfile = manifest_path(step) + '.tmp'
+    with open(tmpfile, 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.rename(tmpfile, manifest_path(step))
+
+# -------------------------------------
+
+def manifest_matches(step, inputs, outputs, cmd):
+    """
+    Return True if a step finished before with the same inputs and parameters
+    and its outputs are still there
+
+    step: the step (e.g., '1')
+    inputs: list of input files
+    outputs: list of output files
+    cmd: the shell command of the step
+    """
+
+    manifest = load_manifest(step)
+
+    if not manifest:
+        return False
+
+    if manifest.get('params') != hashlib.sha1(normalize_params(cmd).encode('utf-8')).hexdigest():
+        return False
+
+    for i in split_files(outputs):
+        if not os.path.isfile(i):
+            return False
+
+    recorded = manifest.get('inputs', {})
+    myinputs = split_files(inputs)
+
+    if set(recorded) != set(myinputs):
+        return False
+
+    for i in myinputs:
+        digest = file_digest(i, recorded[i])
+        # compare presence and content (an optional input may legitimately be absent)
+        if (digest is None) != (recorded[i] is None):
+            return False
+        if digest and digest['sha1'] != recorded[i]['sha1']:
+            return False
+
+    return True
+
+# -------------------------------------
+
+def clear_manifest(step):
+    """Remove the manifest of a step (if any), e.g., when the step is about to rerun"""
+
+    try:
+        os.remove(manifest_path(step))
+    except OSError:
+        pass
+
+# -------------------------------------
+
+def update_status(step, state, returncode=None, note=None):
+    """
+    Record the state of a step in the sample's status file
+
+    step: the step (e.g., '1')
+    state: running, done, failed, cancelled or skipped
+    returncode: (optional) the exit code of the step
+    note: (optional) why, e.g., the reason a step was killed
+    """
+
+    if not os.path.isdir(checkpointdir):
+        os.makedirs(checkpointdir)
+
+    # steps may finish at the same time: lock the file while reading and rewriting it
+    with open(statusfile + '.lock', 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            with open(statusfile, 'r') as f:
+                status = json.load(f)
+        except (IOError, ValueError):
+            status = {}
+
+        status[step] = {'state': state, 'returncode': returncode, 'time': str(datetime.now()), 'host': os.uname()[1]}
+        if note:
+            status[step]['note'] = note
+
+        tmpfile = statusfile + '.tmp'
+        with open(tmpfile, 'w') as f:
+            json.dump(status, f, indent=1, sort_keys=True)
+        os.rename(tmpfile, statusfile)
+
+# -------------------------------------
+
+def write_jobs(scheduler, jids, deps):
+    """
+    Record the jobs submitted for the sample
+
+    scheduler: the executor backend (e.g., sge)
+    jids: dict which maps each step to its job id
+    deps: dict which maps each step to the set of steps it depends on
+    """
+
+    if not os.path.isdir(checkpointdir):
+        os.makedirs(checkpointdir)
+
+    jobs = {'scheduler': scheduler, 'jids': jids, 'deps': dict((i, sorted(deps[i])) for i in deps)}
+
+    tmpfile = jobsfile + '.tmp'
+    with open(tmpfile, 'w') as f:
+        json.dump(jobs, f, indent=1, sort_keys=True)
+    os.rename(tmpfile, jobsfile)
+
+# -------------------------------------
+
+def load_jobs():
+    """Return the jobs submitted for the sample as a dict (None if there isn't a readable record)"""
+
+    try:
+        with open(jobsfile, 'r') as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return None
+
+# -------------------------------------
+
+def downstream(step, deps):
+    """
+    Return the set of steps which depend, directly or not, on a step
+
+    step: the step (e.g., '1')
+    deps: dict which maps each step to the steps it depends on
+    """
+
+    below = set()
+    grew = True
+    while grew:
+        grew = False
+        for i in deps:
+            if i not in below and (step in deps[i] or below & set(deps[i])):
+                below.add(i)
+                grew = True
+
+    return below
@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+
+"""
+    Clustering of contigs by k-mer containment: contigs which are (nearly)
+    contained in a longer contig join its cluster, so only one of each
+    cluster need be blasted
+    ~~~~~~
+"""
+
+from __future__ import absolute_import
+
+import numpy as np
+
+from helpers import pseudoalign as pa
+
+# -------------------------------------
+
+def mix(kmers):
+    """Hash packed k-mers (uint64) to uniformly spread uint64s (MurmurHash3's 64-bit finalizer)"""
+
+    h = kmers.copy()
+    h ^= h >> np.uint64(33)
+    h *= np.uint64(0xff51afd7ed558ccd)
+    h ^= h >> np.uint64(33)
+    h *= np.uint64(0xc4ceb9fe1a85ec53)
+    h ^= h >> np.uint64(33)
+
+    return h
+
+def sketch(seq, k, scale):
+    """
+    Return the FracMinHash sketch of a sequence: the distinct hashes of its canonical k-mers
+    which fall in the lowest 1/scale of the range (so the fraction of one sequence's sketch
+    found in another's estimates the fraction of its k-mers contained in it), and the position
+    of the first k-mer of each
+    """
+
+    if len(seq) < k:
+        return (np.zeros(0, dtype=np.uint64), np.zeros(0, dtype=np.int64))
+
+    starts = np.arange(len(seq) - k + 1)
+    (kmers, valid) = pa.kmers_at(pa.encode(seq), starts, k)
+    h = mix(kmers[valid])
+    keep = h < np.uint64((1 << 64) // scale)
+    (hashes, first) = np.unique(h[keep], return_index=True)
+
+    return (hashes, starts[valid][keep][first])
+
+# -------------------------------------
+
+def cluster(fasta, cutoff, identity=0.95, coverage=0.9, k=21, scale=8):
+    """
+    Cluster the contigs of a fasta file (a sequence on one line, as hp.fastajoinlines writes it),
+    among entries where seq length > cutoff
+
+    Longest first, each contig joins the cluster of the representative which contains most of its
+    k-mers, if it's close enough, or else represents a new cluster. The span of the shared k-mers
+    estimates how much of the contig the representative covers, and the fraction of the k-mers in
+    that span which are shared, c, its identity over it (c = identity^k, as for Mash).
+
+    fasta: input fasta file
+    cutoff: contig length threshold
+    identity: the least identity of a contig to its representative, over the part it covers
+    coverage: the least fraction of a contig its representative covers
+    k: the length of the k-mers
+    scale: sketch 1 in scale k-mers (contigs with an empty sketch represent themselves)
+
+    Returns a dict which maps each representative to the list of the other members of its cluster
+    """
+
+    threshold = identity ** k
+
+    # (id, seq) of the contigs above threshold length
+    contigs = []
+    with open(fasta, 'r') as f:
+        for line in f:
+            line = line.rstrip()
+            if line[0] == '>':
+                myid = line[1:]
+            elif len(line) > cutoff:
+                contigs.append((myid, line))
+
+    # the representatives of the sketch hashes seen so far
+    index = {}
+    members = {}
+    # the order of the representatives (ties go to the longest)
+    order = {}
+
+    # longest first (ties in the order of the fasta), so a contig is only ever contained in one already seen
+    for (myid, seq) in sorted(contigs, key=lambda x: -len(x[1])):
+        (hashes, positions) = sketch(seq, k, scale)
+        hashes = hashes.tolist()
+
+        # how many of the contig's hashes each representative has
+        counts = {}
+        for h in hashes:
+            for i in index.get(h, []):
+                counts[i] = counts.get(i, 0) + 1
+
+        best = max(counts, key=lambda i: (counts[i], -order[i])) if counts else None
+        if best is not None and close(hashes, positions, index, best, k, threshold, coverage):
+            members[best].append(myid)
+        else:
+            members[myid] = []
+            order[myid] = len(order)
+            for h in hashes:
+                index.setdefault(h, []).append(myid)
+
+    return members
+
+def close(hashes, positions, index, best, k, threshold, coverage):
+    """Return True if a representative covers enough of a contig (its sketch hashes and their positions), closely enough"""
+
+    shared = np.array([best in index[h] if h in index else False for h in hashes])
+    # (against the span of the whole sketch, which the sampling shortens alike)
+    (start, end) = (positions[shared].min(), positions[shared].max())
+    if float(end - start + k) / (positions.max() - positions.min() + k) < coverage:
+        return False
+
+    inspan = (positions >= start) & (positions <= end)
+
+    return shared.sum() >= threshold * inspan.sum()
@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+
+"""
+    A compact store of the depth of coverage of the contigs: one uint32
+    array of every covered contig's depths, end to end (prefix.npy, which
+    numpy can memory-map), and an index of where each contig's starts
+    (prefix.idx), so any contig's coverage can be sliced without parsing text
+    ~~~~~~
+"""
+
+import os
+import sys
+import shutil
+import numpy as np
+
+# -------------------------------------
+
+dtype = np.dtype('<u4')
+
+def write_part(f, depth):
+    """Append a contig's depth array to an open file (a part of the store, see write)"""
+    np.asarray(depth).astype(dtype).tofile(f)
+
+def write(prefix, contigs, parts):
+    """
+    Write the store (prefix.npy, prefix.idx) from parts written by write_part
+
+    contigs: list of (contig, length, covered), in the order of the parts, where only
+             the covered contigs have their depths in a part (the others are all zeros)
+    parts: the files of depths, in order (each deleted once it's in)
+    """
+
+    # the index: each contig's length and offset (-1: not covered)
+    offset = 0
+    with open(prefix + '.idx', 'w') as f:
+        for (myid, length, covered) in contigs:
+            f.write('{}\t{}\t{}\n'.format(myid, length, offset if covered else -1))
+            if covered:
+                offset += length
+
+    # a header for a 1-d array of them all, then the parts after it
+    with open(prefix + '.npy', 'wb') as f:
+        np.lib.format.write_array_header_1_0(f, {'descr': dtype.str, 'fortran_order': False, 'shape': (offset,)})
+        for i in parts:
+            with open(i, 'rb') as g:
+                shutil.copyfileobj(g, f, 1 << 20)
+            os.remove(i)
+
+# -------------------------------------
+
+class Coverage(object):
+    """
+    The depth of coverage of the contigs, read from a store (see write)
+
+    The depths are memory-mapped, so only what's sliced is read.
+
+    cov = Coverage('assembly/reads2contigs.depth')
+    cov.depth('contig_12')            # the depth at every position (position 1 at index 0)
+    cov.depth('contig_12', 100, 200)  # positions 101 to 200
+    """
+
+    def __init__(self, prefix):
+        # map each contig to (length, offset), and keep their order
+        self.index = {}
+        self.order = []
+        with open(prefix + '.idx', 'r') as f:
+            for line in f:
+                (myid, length, offset) = line.rstrip('\n').split('\t')
+                self.index[myid] = (int(length), int(offset))
+                self.order.append(myid)
+        self.depths = np.load(prefix + '.npy', mmap_mode='r')
+
+    def __len__(self):
+        return len(self.order)
+
+    def __contains__(self, contig):
+        return contig in self.index
+
+    def __iter__(self):
+        return iter(self.order)
+
+    def length(self, contig):
+        """Return the length of a contig"""
+        return self.index[contig][0]
+
+    def covered(self, contig):
+        """Return True if any of a contig is covered"""
+        return self.index[contig][1] >= 0
+
+    def depth(self, contig, start=0, end=None):
+        """Return the depths of a contig, or of a slice of it (0-based, end exclusive), as a read-only array"""
+
+        (length, offset) = self.index[contig]
+        (start, end, step) = slice(start, end).indices(length)
+        if offset < 0:
+            return np.zeros(max(0, end - start), dtype=dtype)
+        return self.depths[offset + start:offset + end]
+
+# -------------------------------------
+
+def write_pileup(prefix, outfile):
+    """Write a store out as text, a line (contig, position, depth) for every position of every covered contig"""
+
+    cov = Coverage(prefix)
+
+    with open(outfile, 'w') as f:
+        for myid in cov:
+            if cov.covered(myid):
+                lineprefix = myid + '\t'
+                f.writelines(lineprefix + str(i + 1) + '\t' + j + '\n' for (i, j) in enumerate(cov.depth(myid).astype(str)))
+
+# -------------------------------------
+
+if __name__ == "__main__":
+
+    # to execute as a stand-alone script, give the name of the function
+    # as the first arg, followed by the args to the function
+    # e.g., coverage.py write_pileup assembly/reads2contigs.depth reads2contigs.format.pileup
+    if sys.argv[1] in globals():
+        globals()[sys.argv[1]](*sys.argv[2:])
+    else:
+        print('Function not found')
@@ -0,0 +1,377 @@
+#!/usr/bin/env python
+
+"""
+    Job-execution backends: one interface (submit, array submit, dependencies,
+    wait, status, cancel) with implementations for SGE, SLURM, a local process
+    pool, and a fake scheduler that only records what it was asked to do
+    ~~~~~~
+"""
+
+from __future__ import absolute_import
+
+import sys
+import os
+import pipes
+import subprocess
+import threading
+
+from helpers import helpers as hp
+from helpers import scheduler
+
+# -------------------------------------
+
+# A job is described by a dict, all keys optional:
+#   name: job name
+#   cores: number of cores
+#   mem: memory in G
+#   hours: wall time limit in hours
+#   out, err: stdout and stderr log (a file, or for arrays a directory)
+#   extra: raw scheduler-specific flags; for SGE, if present, this is the whole
+#          qsub prefix and the keys above are ignored (this is how the steps' q dicts are passed)
+#
+# Array tasks find their index (1-based) in the environment variable of the
+# backend (SGE_TASK_ID, SLURM_ARRAY_TASK_ID); every backend also sets PANDORA_TASK_ID
+# where it can, and task_id() reads whichever is there.
+#
+# A step run by the local scheduler (see scheduler.run_dag) finds the cores and memory
+# it was granted in PANDORA_CORES and PANDORA_MEM: the local backend runs its array
+# tasks within them, rather than within the whole machine.
+
+# -------------------------------------
+
+def task_id(default='undefined'):
+    """Return the array task index of the current job, whichever backend launched it"""
+
+    for i in ['PANDORA_TASK_ID', 'SGE_TASK_ID', 'SLURM_ARRAY_TASK_ID']:
+        if os.environ.get(i, 'undefined') not in ('undefined', ''):
+            return os.environ[i]
+
+    return default
+
+# -------------------------------------
+
+def python_cmd(cmd):
+    """Prefix a command with this python interpreter if it runs a python script (as qsub -S does)"""
+
+    if cmd.split()[0].endswith('.py'):
+        return sys.executable + ' ' + cmd
+
+    return cmd
+
+# -------------------------------------
+
+class Executor(object):
+    """The interface every backend implements"""
+
+    name = None
+
+    def __init__(self, verbose=0):
+        self.verbose = verbose
+
+    def submit(self, cmd, job=None, hold=None):
+        """Submit a command; hold is a list of job ids to wait on. Returns the job id (str)"""
+        raise NotImplementedError
+
+    def submit_array(self, cmd, ntasks, job=None, hold=None):
+        """Submit a command as tasks 1..ntasks of an array job. Returns the job id (str)"""
+        raise NotImplementedError
+
+    def wait(self, jids, job=None):
+        """Block until all the jobs in jids have finished"""
+        raise NotImplementedError
+
+    def status(self, jid):
+        """Return one of 'queued', 'running', 'done', 'failed', 'unknown'"""
+        raise NotImplementedError
+
+    def cancel(self, jids):
+        """Cancel the jobs in jids (those already finished are ignored)"""
+        raise NotImplementedError
+
+    def run(self, cmd):
+        """Run a scheduler command, echoing it if verbose, and return its stdout"""
+        if self.verbose:
+            print(cmd)
+            sys.stdout.flush()
+        return subprocess.check_output(cmd, shell=True)
+
+# -------------------------------------
+
+class SGEExecutor(Executor):
+    """Oracle/Sun Grid Engine: qsub, -hold_jid, qsub -sync y, qstat/qacct, qdel"""
+
+    name = 'sge'
+
+    def options(self, job):
+        """Translate a job dict into qsub flags"""
+
+        if job.get('extra'):
+            return job['extra']
+
+        opts = []
+        if job.get('name'):
+            opts.append('-N ' + job['name'])
+        if job.get('out'):
+            opts.append('-o ' + job['out'])
+        if job.get('err'):
+            opts.append('-e ' + job['err'])
+        resources = []
+        if job.get('mem'):
+            resources.append('mem={}G'.format(job['mem']))
+        if job.get('hours'):
+            resources.append('time={}::'.format(job['hours']))
+        if resources:
+            opts.append('-l ' + ','.join(resources))
+        if int(job.get('cores', 1)) > 1:
+            opts.append('-pe smp {} -R y'.format(job['cores']))
+
+        return ' '.join(opts)
+
+    def qsub(self, cmd, job, hold, array=''):
+        # "sys.executable contains full path of the currently running Python interpreter"
+        qcmd = 'qsub -S ' + sys.executable + ' ' + self.options(job or {}) + ' ' + array
+        if hold:
+            qcmd += '-hold_jid ' + ','.join(hold) + ' '
+        message = self.run(qcmd + cmd)
+        if self.verbose:
+            print(message)
+        return hp.getjid(message)
+
+    def submit(self, cmd, job=None, hold=None):
+        return self.qsub(cmd, job, hold)
+
+    def submit_array(self, cmd, ntasks, job=None, hold=None):
+        return self.qsub(cmd, job, hold, array='-t 1-{} '.format(ntasks))
+
+    def wait(self, jids, job=None):
+        # a no-op job held on jids, submitted synchronously: returns when they're all done
+        name = (job or {}).get('name', 'pandora')
+        qcmd = 'qsub -V -b y -cwd -o log.out -e log.err -N wait_{} -hold_jid {} -sync y echo wait_here'.format(name, ','.join(jids))
+        print(self.run(qcmd))
+
+    def status(self, jid):
+        if subprocess.call('qstat -j ' + jid + ' > /dev/null 2>&1', shell=True) == 0:
+            return 'running'
+        try:
+            message = subprocess.check_output('qacct -j ' + jid + ' 2> /dev/null', shell=True)
+        except subprocess.CalledProcessError:
+            return 'unknown'
+        codes = [i.split()[1] for i in message.split('\n') if i.startswith('exit_status')]
+        if not codes:
+            return 'unknown'
+        return 'done' if all(i == '0' for i in codes) else 'failed'
+
+    def cancel(self, jids):
+        if jids:
+            subprocess.call('qdel ' + ' '.join(jids), shell=True)
+
+# -------------------------------------
+
+class SlurmExecutor(Executor):
+    """SLURM: sbatch --parsable, --dependency=afterany, sbatch --wait, sacct, scancel"""
+
+    name = 'slurm'
+
+    def options(self, job):
+        """Translate a job dict into sbatch flags"""
+
+        opts = ['--parsable', '--open-mode=append']
+        if job.get('name'):
+            opts.append('-J ' + job['name'])
+        if job.get('out'):
+            # for arrays, out/err are directories: one log per task, as SGE does
+            opts.append('-o ' + (job['out'] + '/%x.o%A.%a' if os.path.isdir(job['out']) else job['out']))
+        if job.get('err'):
+            opts.append('-e ' + (job['err'] + '/%x.e%A.%a' if os.path.isdir(job['err']) else job['err']))
+        if int(job.get('cores', 1)) > 1:
+            opts.append('-c {}'.format(job['cores']))
+        if job.get('mem'):
+            opts.append('--mem={}G'.format(job['mem']))
+        if job.get('hours'):
+            opts.append('-t {}:00:00'.format(job['hours']))
+        if job.get('extra'):
+            opts.append(job['extra'])
+
+        return ' '.join(opts)
+
+    def sbatch(self, cmd, job, hold, array=''):
+        scmd = 'sbatch ' + self.options(job or {}) + ' ' + array
+        if hold:
+            scmd += '--dependency=afterany:' + ':'.join(hold) + ' '
+        # quoted whole, so nothing in it (e.g., '$TMPDIR', meant for the node which runs it) is expanded by the shell submitting it
+        # --parsable prints "jobid" or "jobid;cluster"
+        return self.run(scmd + '--wrap ' + pipes.quote(python_cmd(cmd))).strip().split(';')[0]
+
+    def submit(self, cmd, job=None, hold=None):
+        return self.sbatch(cmd, job, hold)
+
+    def submit_array(self, cmd, ntasks, job=None, hold=None):
+        return self.sbatch(cmd, job, hold, array='--array=1-{} '.format(ntasks))
+
+    def wait(self, jids, job=None):
+        # a no-op job depending on jids, submitted with --wait: returns when they're all done
+        name = (job or {}).get('name', 'pandora')
+        self.run('sbatch --wait -J wait_{} -o /dev/null --dependency=afterany:{} --wrap "echo wait_here"'.format(name, ':'.join(jids)))
+
+    def status(self, jid):
+        try:
+            message = subprocess.check_output('sacct -n -X -P -o State -j ' + jid, shell=True)
+        except subprocess.CalledProcessError:
+            return 'unknown'
+        states = [i.split()[0] for i in message.split('\n') if i.strip()]
+        if not states:
+            return 'unknown'
+        if any(i in ('PENDING', 'REQUEUED', 'SUSPENDED') for i in states):
+            return 'queued'
+        if any(i in ('RUNNING', 'COMPLETING') for i in states):
+            return 'running'
+        return 'done' if all(i == 'COMPLETED' for i in states) else 'failed'
+
+    def cancel(self, jids):
+        if jids:
+            subprocess.call('scancel ' + ' '.join(jids), shell=True)
+
+# -------------------------------------
+
+class LocalExecutor(Executor):
+    """
+    Run on this machine: single jobs run to completion when submitted (so dependencies
+    are satisfied by construction); array tasks run concurrently in a pool of processes,
+    as many at a time as fit in the cores and memory (in G) the step was granted
+    (PANDORA_CORES, PANDORA_MEM) or, failing that, those of the machine
+    """
+
+    name = 'local'
+
+    def __init__(self, verbose=0, cores=None, mem=None):
+        Executor.__init__(self, verbose)
+        (machinecores, machinemem) = scheduler.local_resources()
+        self.cores = cores or int(os.environ.get('PANDORA_CORES') or machinecores)
+        self.mem = mem or float(os.environ.get('PANDORA_MEM') or machinemem)
+        self.counter = 0
+        self.returncodes = {}
+
+    def logs(self, job, suffix=''):
+        """Return the (stdout, stderr) log files for a job"""
+
+        out = job.get('out') or 'log.o.steps'
+        err = job.get('err') or 'log.e.steps'
+        if os.path.isdir(out):
+            out = os.path.join(out, job.get('name', 'job') + '.o' + suffix)
+        if os.path.isdir(err):
+            err = os.path.join(err, job.get('name', 'job') + '.e' + suffix)
+
+        return (out, err)
+
+    def submit(self, cmd, job=None, hold=None):
+        job = job or {}
+        self.counter += 1
+        jid = str(self.counter)
+        (out, err) = self.logs(job, jid)
+        self.returncodes[jid] = [hp.run_log_cmd(cmd, self.verbose, out, err)]
+        return jid
+
+    def submit_array(self, cmd, ntasks, job=None, hold=None):
+        job = job or {}
+        self.counter += 1
+        jid = str(self.counter)
+        returncodes = [None] * ntasks
+        # as many tasks at a time as there are cores and memory for (one, at least)
+        numslots = self.cores // max(1, int(job.get('cores') or 1))
+        if float(job.get('mem') or 0) > 0:
+            numslots = min(numslots, int(self.mem // float(job['mem'])))
+        slots = threading.BoundedSemaphore(max(1, numslots))
+
+        def task(k):
+            try:
+                (out, err) = self.logs(job, jid + '.' + str(k))
+                # the task index goes in the environment, as a scheduler would put it
+                returncodes[k - 1] = hp.run_log_cmd('export PANDORA_TASK_ID={k} SGE_TASK_ID={k}; {cmd}'.format(k=k, cmd=cmd), self.verbose, out, err, failfast=False)
+            finally:
+                slots.release()
+
+        threads = []
+        for k in range(1, ntasks + 1):
+            slots.acquire()
+            t = threading.Thread(target=task, args=(k,))
+            t.start()
+            threads.append(t)
+        for t in threads:
+            t.join()
+
+        self.returncodes[jid] = returncodes
+        return jid
+
+    def wait(self, jids, job=None):
+        # everything already ran to completion when it was submitted
+        pass
+
+    def status(self, jid):
+        if jid not in self.returncodes:
+            return 'unknown'
+        return 'done' if all(i == 0 for i in self.returncodes[jid]) else 'failed'
+
+    def cancel(self, jids):
+        # nothing is ever left pending
+        pass
+
+# -------------------------------------
+
+class FakeExecutor(Executor):
+    """
+    A stand-in scheduler which runs nothing: it prints and records every request,
+    so the orchestration (what is submitted, with which dependencies) can be checked offline
+    """
+
+    name = 'fake'
+
+    def __init__(self, verbose=0):
+        Executor.__init__(self, verbose)
+        self.jobs = []
+
+    def record(self, kind, cmd, job, hold, ntasks=None):
+        jid = str(1000 + len(self.jobs))
+        self.jobs.append({'jid': jid, 'kind': kind, 'cmd': cmd, 'job': job or {}, 'hold': list(hold or []), 'ntasks': ntasks})
+        print('[fake {}] jid={} hold={} tasks={} job={} cmd={}'.format(kind, jid, ','.join(hold or []) or '-', ntasks or '-', job or {}, cmd))
+        return jid
+
+    def submit(self, cmd, job=None, hold=None):
+        return self.record('submit', cmd, job, hold)
+
+    def submit_array(self, cmd, ntasks, job=None, hold=None):
+        return self.record('array', cmd, job, hold, ntasks)
+
+    def wait(self, jids, job=None):
+        print('[fake wait] ' + ','.join(jids))
+
+    def status(self, jid):
+        return 'done' if any(i['jid'] == jid for i in self.jobs) else 'unknown'
+
+    def cancel(self, jids):
+        print('[fake cancel] ' + ','.join(jids))
+
+# -------------------------------------
+
+# backends by name (the choices of the --scheduler flags)
+backends = {
+    'sge': SGEExecutor,
+    'slurm': SlurmExecutor,
+    'local': LocalExecutor,
+    'fake': FakeExecutor
+}
+
+# -------------------------------------
+
+# one executor per backend per process, so job ids and records are shared between callers
+_executors = {}
+
+def get_executor(name, verbose=0):
+    """Return the executor for a backend name (one of the keys of backends)"""
+
+    if name not in backends:
+        hp.quitwitherror('Unknown scheduler ' + str(name) + ' (choose from ' + ', '.join(sorted(backends)) + ')')
+
+    if name not in _executors:
+        _executors[name] = backends[name](verbose)
+
+    return _executors[name]
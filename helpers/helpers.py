@@ -6,10 +6,15 @@
     ~~~~~~
 """
 
+import re
 import sys
 import subprocess
 import os
 import time
+import errno
+import json
+import threading
+import signal
 import ConfigParser
 from distutils import spawn
 from datetime import datetime
@@ -93,27 +98,8 @@ def check_file_exists_and_nonzero(myfile, step=''):
 def run_cmd(cmd, bool_verbose, bool_getstdout, step=''):
     """Run a system (i.e., shell) command"""
 
-    # if verbose, print command
-    if bool_verbose:
-        print('[command] ' + cmd)
-        sys.stdout.flush()
-
-    proc = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    proc.wait()
-
-    # print return code if not zero
-    if proc.returncode != 0:
-        print('[nonzero error code] ' + str(proc.returncode))
-
-    # stdout stderr tuple
-    (stdout, stderr) = proc.communicate()
-
-    # if error, print it
-    if stderr:
-	if step:
-            sys.stderr.write('[stderror ' + step + '] ' + stderr)
-        else:
-            sys.stderr.write('[stderror] ' + stderr)
+    # stdout is thrown away unless it's wanted; stderr streams to the console
+    (returncodes, stdout) = run_pipeline([cmd], bool_verbose, stdout=None if bool_getstdout else os.devnull, getstdout=bool_getstdout, step=step)
 
     # return stdout
     if bool_getstdout: 
@@ -124,7 +110,7 @@ def run_cmd(cmd, bool_verbose, bool_getstdout, step=''):
 
 # -------------------------------------
 
-def run_long_cmd(cmd, bool_verbose, myfile):
+def run_long_cmd(cmd, bool_verbose, myfile, step=''):
     """Run a system command that prints a lot of stuff to stdout or stderr"""
 
     # https://thraxil.org/users/anders/posts/2008/03/13/Subprocess-Hanging-PIPE-is-your-enemy/
@@ -138,29 +124,492 @@ def run_long_cmd(cmd, bool_verbose, myfile):
     # Luckily the solution is fairly simple. Instead of setting stdout and stderr to PIPE, 
     # they need to be given proper file (or unix pipe) objects that will accept a reasonable amount of data."
 
-    # if verbose, print command
-    if bool_verbose:
-        print('[command] ' + cmd)
-        sys.stdout.flush()
-
     with open(myfile, 'w') as f:
-        proc = subprocess.Popen(cmd, shell=True, stdout=f, stderr=f)
-        proc.wait()
+        (returncodes, stdout) = run_pipeline([cmd], bool_verbose, stdout=f, stderr=f, step=step)
+
+    # return the exit code
+    return returncodes[0]
 
 # -------------------------------------
 
-def run_log_cmd(cmd, bool_verbose, myout, myerr):
-    """Run a system command and save stdout and stderr to logs"""
+def run_log_cmd(cmd, bool_verbose, myout, myerr, cwd=None, step='', env=None, failfast=None):
+    """Run a system command and save stdout and stderr to logs (optionally, in directory cwd, with environment env)"""
+
+    with open(myout, 'a') as f:
+        with open(myerr, 'a') as g:
+            (returncodes, stdout) = run_pipeline([cmd], bool_verbose, stdout=f, stderr=g, cwd=cwd, step=step, env=env, failfast=failfast)
+
+    # return the exit code
+    return returncodes[0]
+
+# -------------------------------------
+
+def child_setup(pgid=None):
+    """
+    Return a function which readies a child process before it runs
+
+    pgid: None to leave the process group alone, 0 to start a new group,
+          or the id of the group to join (so the watchdog can kill a whole pipeline at once)
+    """
+
+    def setup():
+        # give the child the default SIGPIPE handling (python ignores it, and children inherit that)
+        signal.signal(signal.SIGPIPE, signal.SIG_DFL)
+        if pgid is not None:
+            os.setpgid(0, pgid)
+
+    return setup
+
+# -------------------------------------
+
+def run_pipeline(stages, bool_verbose, stdin=None, stdout=None, stderr=None, getstdout=0, cwd=None, step='', env=None, timeout=None, idle=None, watch=None, failfast=None):
+    """
+    Run a command, or a pipeline of commands connected by OS pipes, streaming its output
+
+    stages: list of commands, each an argv list (run directly) or a string (run by the shell)
+    stdin: (optional) path or open file from which the first stage reads
+    stdout: (optional) where the last stage writes: a path (truncated, as with >) or an open file
+            (default: the console)
+    stderr: (optional) where every stage writes errors: a path (appended to, as with 2>>) or an open file
+            (default: streamed to the console line by line, labelled with step)
+    getstdout: capture the stdout of the last stage and return it (nothing else is held in memory)
+    cwd: (optional) the directory in which to run
+    step: label for error messages and metrics
+    env: (optional) the environment of the commands
+    timeout: (optional) seconds after which to kill the pipeline
+    idle: (optional) seconds without the logs growing after which to kill the pipeline
+    watch: (optional) list of further files whose growth shows the pipeline is alive
+           (stdout and stderr are watched if they're files)
+    failfast: whether a failure ends the program (default: in fail-fast mode, see failfast below).
+              Callers which handle exit codes themselves, e.g. worker threads, pass False
+
+    Limits for the tools in the pipeline (see tool_timeouts, tool_idle) apply too, whichever is shorter.
+    Stages killed by the watchdog exit with watchdog_exit.
+
+    Returns a tuple (list of exit codes, one per stage; the captured stdout or None)
+    """
+
+    def describe(stage):
+        return ' '.join(stage) if isinstance(stage, (list, tuple)) else stage
 
     # if verbose, print command
     if bool_verbose:
-        print('[command] ' + cmd)
-        sys.stdout.flush()
+        print('[command] ' + ' | '.join(describe(i) for i in stages))
+    # so our own output comes before the children's
+    sys.stdout.flush()
 
-    with open(myout, 'a') as f:
-        with open(myerr, 'a') as g:
-            proc = subprocess.Popen(cmd, shell=True, stdout=f, stderr=g)
-            proc.wait()
+    # files we open (as opposed to ones we're given) we close
+    opened = []
+
+    def openfile(myfile, mode):
+        if myfile is None or hasattr(myfile, 'fileno'):
+            return myfile
+        f = open(myfile, mode)
+        opened.append(f)
+        return f
+
+    infile = openfile(stdin, 'r')
+    outfile = subprocess.PIPE if getstdout else openfile(stdout, 'w')
+    errfile = openfile(stderr, 'a')
+
+    # errors for the console go through a pipe, which a thread drains a line at a time
+    drain = None
+    if errfile is None:
+        (errread, errwrite) = os.pipe()
+        errfile = errwrite
+        label = '[stderror ' + step + '] ' if step else '[stderror] '
+
+        def copy_lines():
+            atstart = True
+            with os.fdopen(errread, 'r') as f:
+                # cap the line length, so a child that never writes a newline can't fill memory
+                for line in iter(lambda: f.readline(65536), ''):
+                    sys.stderr.write((label if atstart else '') + line)
+                    atstart = line.endswith('\n')
+
+        drain = threading.Thread(target=copy_lines)
+        drain.daemon = True
+        drain.start()
+
+    # the shortest of the limits which apply
+    tools = [tool_name(describe(i)) for i in stages]
+    timeout = min([i for i in [timeout] + [tool_timeouts.get(j) for j in tools] if i] or [None])
+    idle = min([i for i in [idle] + [tool_idle.get(j) for j in tools] if i] or [None])
+
+    # with a watchdog, the stages share a process group of their own, which it can kill in one go
+    pgid = 0 if timeout or idle else None
+
+    procs = []
+    returncodes = [None] * len(stages)
+    for k, stage in enumerate(stages):
+        try:
+            starttime = time.time()
+            proc = subprocess.Popen(
+                stage,
+                shell=not isinstance(stage, (list, tuple)),
+                cwd=cwd,
+                env=env,
+                stdin=procs[-1][0].stdout if procs else infile,
+                stdout=outfile if k == len(stages) - 1 else subprocess.PIPE,
+                stderr=errfile,
+                close_fds=True,
+                preexec_fn=child_setup(pgid))
+            if pgid == 0:
+                pgid = proc.pid
+        except OSError as e:
+            # e.g., the program isn't on the PATH: the stages downstream of it never start
+            sys.stderr.write('[ERROR ' + step + '] can\'t run ' + describe(stage) + ': ' + str(e) + '\n')
+            returncodes[k] = 127
+            break
+        finally:
+            # the upstream stage now writes only to this one (and gets SIGPIPE if this one goes away)
+            if procs and procs[-1][0].stdout:
+                procs[-1][0].stdout.close()
+        procs.append((proc, stage, starttime, start_metrics(proc)))
+
+    # the children have the write end of the error pipe now
+    if drain:
+        os.close(errwrite)
+
+    # why the watchdog killed the pipeline (if it did)
+    killed = []
+    finished = threading.Event()
+    if procs and (timeout or idle):
+        # what to watch for signs of life
+        watched = [i for i in [outfile, errfile] if hasattr(i, 'fileno')] + [os.path.join(cwd or '', i) for i in watch or []]
+        dog = threading.Thread(target=watchdog, args=(pgid, timeout, idle, watched, finished, killed, ' | '.join(describe(i) for i in stages)))
+        dog.daemon = True
+        dog.start()
+
+    output = None
+    try:
+        if getstdout:
+            output = procs[-1][0].stdout.read() if len(procs) == len(stages) else ''
+            if len(procs) == len(stages):
+                procs[-1][0].stdout.close()
+
+        for k, (proc, stage, starttime, sampler) in enumerate(procs):
+            returncodes[k] = wait_metrics(proc, describe(stage), starttime, sampler, step, cwd, killed)
+            if killed and returncodes[k] < 0:
+                returncodes[k] = watchdog_exit
+    except (KeyboardInterrupt, SystemExit):
+        # in a process group of their own, the stages don't get the terminal's Ctrl-C: don't leave them running
+        if pgid:
+            try:
+                os.killpg(pgid, signal.SIGTERM)
+            except OSError:
+                pass
+        raise
+    finally:
+        finished.set()
+
+    if drain:
+        drain.join()
+    for f in opened:
+        f.close()
+
+    # print return codes if not zero
+    # (an upstream stage killed by SIGPIPE just means a downstream one stopped reading, as with head)
+    failed = []
+    for k, returncode in enumerate(returncodes):
+        if returncode and not (returncode == -signal.SIGPIPE and k < len(stages) - 1):
+            failed.append(describe(stages[k]))
+            if len(stages) > 1:
+                print('[nonzero error code] ' + str(returncode) + ' (' + describe(stages[k]) + ')')
+            else:
+                print('[nonzero error code] ' + str(returncode))
+    sys.stdout.flush()
+
+    # in fail-fast mode, end the step
+    if failfast is None:
+        failfast = globals()['failfast']
+    if failed and failfast:
+        quitwitherror('command failed (fail-fast mode): ' + failed[0], step=step or metrics_step)
+
+    return (returncodes, output)
+
+# -------------------------------------
+
+### watchdog
+
+# -------------------------------------
+
+def parse_limits(limits):
+    """
+    Parse a comma-delimited list of limits in hours, e.g., Trinity=48,blastn=6,2=60,
+    into a dict which maps each name (a tool or a step) to seconds
+    """
+
+    mydict = {}
+    for i in limits.split(','):
+        if '=' in i:
+            (name, hours) = i.split('=', 1)
+            try:
+                mydict[name.strip()] = float(hours) * 3600
+            except ValueError:
+                sys.stderr.write('[WARNING] ignoring the time limit ' + i + ' (expected name=hours)\n')
+
+    return mydict
+
+# -------------------------------------
+
+# wall-time and inactivity limits per tool (in seconds, keyed on the program name), set via
+# the environment by the step wrapper from pandora's --timeouts and --idletimeouts
+tool_timeouts = parse_limits(os.environ.get('PANDORA_TIMEOUTS', ''))
+tool_idle = parse_limits(os.environ.get('PANDORA_IDLE', ''))
+
+# the exit code of a command killed by the watchdog (as with coreutils timeout)
+watchdog_exit = 124
+
+# seconds between the watchdog's checks, and between its SIGTERM and SIGKILL
+watchdog_interval = 10
+watchdog_grace = 60
+
+# -------------------------------------
+
+def tool_name(cmd):
+    """Return the name of the program a command runs (e.g., Trinity for /opt/trinity/Trinity --CPU 8)"""
+
+    words = cmd.split()
+    return os.path.basename(words[0]) if words else ''
+
+# -------------------------------------
+
+def watchdog(pgid, timeout, idle, watched, finished, killed, cmd):
+    """
+    Kill a process group if it runs too long, or if the files it writes stop growing
+
+    pgid: the process group
+    timeout: seconds after which to kill it (or None)
+    idle: seconds without growth after which to kill it (or None)
+    watched: list of paths or open files (the logs of the process)
+    finished: event set when the process group has ended
+    killed: list to which the reason for killing it is appended
+    cmd: the command (for the messages)
+    """
+
+    def size():
+        total = 0
+        for i in watched:
+            try:
+                total += os.fstat(i.fileno()).st_size if hasattr(i, 'fileno') else os.path.getsize(i)
+            except OSError:
+                pass
+        return total
+
+    starttime = lastgrowth = time.time()
+    lastsize = size()
+
+    while not finished.wait(watchdog_interval):
+        now = time.time()
+        reason = None
+        if timeout and now - starttime > timeout:
+            reason = 'ran longer than {:.2f}h'.format(timeout / 3600.0)
+        elif idle and watched:
+            mysize = size()
+            if mysize != lastsize:
+                (lastsize, lastgrowth) = (mysize, now)
+            elif now - lastgrowth > idle:
+                reason = 'logs stopped growing for {:.2f}h'.format(idle / 3600.0)
+        if reason:
+            killed.append(reason)
+            message = '[watchdog] killing ' + cmd + ': ' + reason
+            print(message)
+            sys.stdout.flush()
+            sys.stderr.write(message + '\n')
+            try:
+                os.killpg(pgid, signal.SIGTERM)
+                if not finished.wait(watchdog_grace):
+                    os.killpg(pgid, signal.SIGKILL)
+            except OSError:
+                # already gone
+                pass
+            return
+
+# -------------------------------------
+
+### fail-fast mode
+
+# -------------------------------------
+
+# set (via the environment) by the step wrapper when pandora is run with --failfast:
+# then any command exiting nonzero ends the step, rather than the step carrying on regardless
+failfast = os.environ.get('PANDORA_FAILFAST', '0') == '1'
+
+# -------------------------------------
+
+### resource accounting
+
+# -------------------------------------
+
+# the step whose commands are being run (set by echostep), recorded with each command's metrics
+metrics_step = ''
+
+# file (relative to the sample's working directory) to which each command appends a json record
+metrics_file = 'metrics.jsonl'
+
+# seconds between samples of the process tree
+metrics_interval = 2
+
+# -------------------------------------
+
+def proc_tree(pid):
+    """Return the list of pids of a process and all of its descendants (via /proc)"""
+
+    children = {}
+    for i in os.listdir('/proc'):
+        if i.isdigit():
+            try:
+                with open('/proc/' + i + '/stat', 'r') as f:
+                    # the command name (in parentheses) may contain spaces, so split after it
+                    ppid = int(f.read().rsplit(')', 1)[1].split()[1])
+                children.setdefault(ppid, []).append(int(i))
+            except (IOError, IndexError, ValueError):
+                # process exited while we were looking
+                pass
+
+    pids = [pid]
+    for i in pids:
+        pids.extend(children.get(i, []))
+
+    return pids
+
+# -------------------------------------
+
+def proc_usage(pid):
+    """Return (rss in kB, bytes read, bytes written) of a process (None if it's gone)"""
+
+    try:
+        rss = 0
+        with open('/proc/' + str(pid) + '/status', 'r') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    rss = int(line.split()[1])
+        io = {}
+        with open('/proc/' + str(pid) + '/io', 'r') as f:
+            for line in f:
+                (key, value) = line.split(':')
+                io[key] = int(value)
+        return (rss, io.get('read_bytes', 0), io.get('write_bytes', 0))
+    except (IOError, ValueError):
+        return None
+
+# -------------------------------------
+
+class TreeSampler(threading.Thread):
+    """
+    Sample the memory and I/O of a process tree in the background
+
+    A process's I/O counters include those of the children it has reaped,
+    so the largest total seen over the tree approximates the I/O of the whole run.
+    """
+
+    def __init__(self, pid, interval):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.pid = pid
+        self.interval = interval
+        self.finished = threading.Event()
+        self.peak_rss = 0
+        self.read_bytes = 0
+        self.write_bytes = 0
+
+    def sample(self):
+        usage = [i for i in map(proc_usage, proc_tree(self.pid)) if i]
+        if usage:
+            self.peak_rss = max(self.peak_rss, sum(i[0] for i in usage))
+            self.read_bytes = max(self.read_bytes, sum(i[1] for i in usage))
+            self.write_bytes = max(self.write_bytes, sum(i[2] for i in usage))
+
+    def run(self):
+        self.sample()
+        while not self.finished.wait(self.interval):
+            self.sample()
+
+    def stop(self):
+        self.finished.set()
+
+# -------------------------------------
+
+def start_metrics(proc):
+    """Start sampling a process tree (returns None where there's no /proc)"""
+
+    if not os.path.isdir('/proc'):
+        return None
+
+    sampler = TreeSampler(proc.pid, metrics_interval)
+    sampler.start()
+
+    return sampler
+
+# -------------------------------------
+
+def wait_metrics(proc, cmd, starttime, sampler, step='', cwd=None, killed=None):
+    """
+    Wait for a process, then append its resource usage to the metrics file
+
+    proc: the subprocess.Popen object
+    cmd: its command (a string)
+    starttime: time.time() when it was started
+    sampler: the TreeSampler returned by start_metrics (or None)
+    step: label of the step (default: the one set by echostep)
+    cwd: the directory it ran in (where the metrics file goes)
+    killed: (optional) list holding the reason the watchdog killed it, if it did
+    """
+
+    # wait4 rather than wait, for the rusage of the process and of every descendant it waited for
+    while True:
+        try:
+            (pid, status, rusage) = os.wait4(proc.pid, 0)
+            break
+        except OSError as e:
+            if e.errno != errno.EINTR:
+                raise
+    walltime = time.time() - starttime
+
+    # tell Popen what happened, since it didn't reap the process itself
+    if os.WIFSIGNALED(status):
+        proc.returncode = -os.WTERMSIG(status)
+    else:
+        proc.returncode = os.WEXITSTATUS(status)
+
+    if sampler:
+        sampler.stop()
+        sampler.join()
+
+    record = {
+        'step': step or metrics_step,
+        'cmd': cmd,
+        'host': os.uname()[1],
+        'start': str(datetime.fromtimestamp(starttime)),
+        'returncode': proc.returncode,
+        'wall_s': round(walltime, 3),
+        'user_s': round(rusage.ru_utime, 3),
+        'sys_s': round(rusage.ru_stime, 3),
+        # the largest single process (kB on Linux)
+        'max_rss_kb': rusage.ru_maxrss,
+        # the most the whole tree held at once, as sampled (None without /proc)
+        'tree_peak_rss_kb': sampler.peak_rss if sampler else None,
+        'read_bytes': sampler.read_bytes if sampler else None,
+        'write_bytes': sampler.write_bytes if sampler else None,
+        'killed': killed[0] if killed else None
+    }
+
+    write_metrics(record, cwd)
+
+    return proc.returncode
+
+# -------------------------------------
+
+def write_metrics(record, cwd=None):
+    """Append a record (a dict) to the metrics file (optionally, in directory cwd)"""
+
+    # accounting must never sink the pipeline
+    try:
+        with open(os.path.join(cwd or '', metrics_file), 'a') as f:
+            f.write(json.dumps(record, sort_keys=True) + '\n')
+    except IOError as e:
+        sys.stderr.write('[WARNING] can\'t write ' + metrics_file + ': ' + str(e) + '\n')
 
 # -------------------------------------
 
@@ -206,14 +655,23 @@ def getjid(x):
 
 # -------------------------------------
 
-def fastajoinlines(infile, outfile, idbase):
-    """Put all the sequence portions of a fasta file onto a single line"""
+def fastajoinlines(infile, outfile, idbase, idfile=None):
+    """
+    Put all the sequence portions of a fasta file onto a single line
+
+    infile: input fasta file
+    outfile: output fasta file, its entries renamed idbase_1, idbase_2, ...
+    idbase: the prefix of the new IDs
+    idfile: (optional) a file in which to keep the old ID of each entry (new ID, old ID), e.g., Trinity's
+    """
 
     # a counter for entries
     counter = 1
     # a flag
     flag = 0
 
+    h = open(idfile, 'w') if idfile else None
+
     with open(outfile, 'w') as f:
         with open(infile, 'r') as g:
             for line in g:
@@ -224,12 +682,17 @@ def fastajoinlines(infile, outfile, idbase):
                         f.write('\n')
                         counter += 1
                     f.write('>' + idbase + '_' + str(counter) + '\n')
+                    if h:
+                        h.write(idbase + '_' + str(counter) + '\t' + line[1:].split()[0] + '\n')
                     flag = 1
                 # if sequence line
                 else:
                     f.write(line)
         f.write('\n')
 
+    if h:
+        h.close()
+
     # return the number of entries in the fasta file
     return counter
 
@@ -295,6 +758,65 @@ def fastasplit2(infile, filename, cutoff, filesize):
 
 # -------------------------------------
 
+def fastqsplit(infile, filename, numshards, bool_gzip, chunksize=100000):
+    """
+    Split a fastq file, or several (lanes) one after another, into shards (filename_1.fastq, ...,
+    or .fastq.gz if bool_gzip), dealing out chunks of chunksize reads in turn, so two mates split alike stay in step
+
+    infile: input fastq, or a comma-separated list of them (gzipped if bool_gzip)
+    filename: output file prefix
+    numshards: the number of shards
+    bool_gzip: the input is gzipped, and so are the shards (quickly: gzip -1)
+
+    Returns a list of the number of reads of each input file
+    """
+
+    import itertools
+
+    outfiles = [filename + '_' + str(k) + '.fastq' + ('.gz' if bool_gzip else '') for k in range(1, numshards + 1)]
+
+    # (de)compress in processes of their own, in parallel with the dealing out here
+    procs = []
+    if bool_gzip:
+        outs = []
+        for i in outfiles:
+            proc = subprocess.Popen(['gzip', '-1', '-c'], stdin=subprocess.PIPE, stdout=open(i, 'wb'), bufsize=1 << 20)
+            procs.append(proc)
+            outs.append(proc.stdin)
+    else:
+        outs = [open(i, 'w', 1 << 20) for i in outfiles]
+
+    # (each lane carries on where the last left off)
+    shards = itertools.cycle(range(numshards))
+    counts = []
+    for myfile in infile.split(','):
+        if bool_gzip:
+            reader = subprocess.Popen(['gzip', '-dc', myfile], stdout=subprocess.PIPE, bufsize=1 << 20)
+            g = reader.stdout
+            procs.append(reader)
+        else:
+            g = open(myfile, 'r', 1 << 20)
+
+        numlines = 0
+        while True:
+            lines = list(itertools.islice(g, 4 * chunksize))
+            if not lines:
+                break
+            outs[next(shards)].writelines(lines)
+            numlines += len(lines)
+        g.close()
+        counts.append(numlines / 4)
+
+    for i in outs:
+        i.close()
+    for proc in procs:
+        if proc.wait() != 0:
+            quitwitherror('gzip exited with error code ' + str(proc.returncode) + ' splitting ' + infile)
+
+    return counts
+
+# -------------------------------------
+
 def fastafilter(infile, outfile, cutoff):
     """
     Filter a fasta file to produce a new fasta file such that seq length > cutoff (assume fastajoinlines)
@@ -350,52 +872,81 @@ def fastaidfilter(infile, outfile, ids):
 
 # -------------------------------------
 
-def fastqfilter(infile, outfile, cutoff):
+def trinitygene(myid):
+    """Return the Trinity gene of a Trinity ID (TRINITY_DN1000_c0_g1_i2 -> TRINITY_DN1000_c0_g1), or the ID itself if it has no isoform"""
+
+    match = re.match(r'(.*_g\d+)_i\d+$', myid)
+
+    return match.group(1) if match else myid
+
+# -------------------------------------
+
+def fastarepresentatives(infile, outfile, groups, cutoff):
     """
-    Filter a fastq file to produce a new fastq file such that seq length > cutoff
+    Filter a fasta file to produce a new fasta file with one representative (the longest entry)
+    of each group, among entries where seq length > cutoff (assume fastajoinlines)
 
-    infile: input fastq file
-    outfile: output fastq file
+    infile: input fasta file
+    outfile: output fasta file
+    groups: dict which maps IDs to their group (IDs not in it are groups of their own)
     cutoff: contig length threshold
+
+    Returns a dict which maps each representative to the list of the other members of its group (above cutoff)
     """
 
-    # a counter
-    counter = 0
-    # a counter for unfiltered entries
-    ecounter = 0
-    fourlinechunk = ''
-    abovecutoff = False
+    # the longest entry of each group so far: group -> (length, id)
+    longest = {}
+    # the IDs of each group, in order
+    members = {}
+
+    with open(infile, 'r') as g:
+        for line in g:
+            line = line.rstrip()
+            if line[0] == '>':
+                id = line[1:]
+            elif len(line) > cutoff:
+                group = groups.get(id, id)
+                members.setdefault(group, []).append(id)
+                if group not in longest or len(line) > longest[group][0]:
+                    longest[group] = (len(line), id)
+
+    representatives = {longest[i][1]: [j for j in members[i] if j != longest[i][1]] for i in longest}
 
     with open(infile, 'r') as g, open(outfile, 'w') as f:
         for line in g:
-        # increment counter
-            counter += 1
-
-            # for every new fastq entry
-            if counter % 4 == 1:
-                # write previous if above threshold length
-                if counter > 1 and abovecutoff:
-                    f.write(fourlinechunk)
-                    ecounter += 1
-                # reset variables
-                fourlinechunk = ''
-                abovecutoff = False
-
-            # if sequence line
-            if counter % 4 == 2:
-                if (len(line.rstrip()) > cutoff):
-                    abovecutoff = True
-
-            # increment chunk
-            fourlinechunk += line
-
-        # do the last one
-        if abovecutoff:
-            f.write(fourlinechunk)
-            ecounter += 1
+            line = line.rstrip()
+            if line[0] == '>':
+                id = line[1:]
+            elif id in representatives and len(line) > cutoff:
+                f.write('>' + id + '\n')
+                f.write(line + '\n')
 
-    # return counter for contigs above threshold length
-    return ecounter
+    return representatives
+
+# -------------------------------------
+
+def expandhits(infile, members):
+    """
+    Rewrite a blast tsv in place so every hit of a representative is followed by a copy for each
+    of the other members of its group (the same hit, but for the member's ID)
+
+    infile: blast tsv file
+    members: dict which maps each representative to the list of the other members of its group
+
+    Lines which aren't hits (no tab) are passed through as they are
+    """
+
+    with open(infile, 'r') as g, open(infile + '.tmp', 'w') as f:
+        for line in g:
+            line = line.rstrip('\n')
+            f.write(line + '\n')
+            fields = line.split('\t', 1)
+            if len(fields) < 2:
+                continue
+            for i in members.get(fields[0], []):
+                f.write(i + '\t' + fields[1] + '\n')
+
+    os.rename(infile + '.tmp', infile)
 
 # -------------------------------------
 
@@ -468,6 +1019,34 @@ def getnohits(infile, infile2, outfile):
 
 # -------------------------------------
 
+def bam_idxstats(bam, bool_verbose):
+    """
+    Return samtools idxstats of a coordinate-sorted, indexed bam, as a list of
+    (reference, length, mapped reads, unmapped reads), the last being '*' (unplaced reads);
+    or None if the bam isn't sorted by coordinate or hasn't got an index
+    (idxstats only reads the index, so this costs nothing however large the bam)
+    """
+
+    if not any(os.path.exists(i) for i in [bam + '.bai', bam + '.csi', os.path.splitext(bam)[0] + '.bai']):
+        return None
+
+    (returncodes, header) = run_pipeline([['samtools', 'view', '-H', bam]], bool_verbose, getstdout=1)
+    if returncodes[0] != 0 or not any(i.startswith('@HD') and 'SO:coordinate' in i for i in header.split('\n')):
+        return None
+
+    (returncodes, output) = run_pipeline([['samtools', 'idxstats', bam]], bool_verbose, getstdout=1)
+    if returncodes[0] != 0:
+        return None
+
+    stats = []
+    for line in output.strip().split('\n'):
+        fields = line.split('\t')
+        stats.append((fields[0], int(fields[1]), int(fields[2]), int(fields[3])))
+
+    return stats
+
+# -------------------------------------
+
 def getorf(infile, outfile, threshold):
     """get ORF (open reading frame)"""
 
@@ -564,8 +1143,12 @@ def quitwitherror(message, step=''):
 def echostep(step, start=1):
     """Print text to define start or end of a step"""
 
-    cmd = 'uname -a'
-    nodeinfo = run_cmd(cmd, 0, 1)
+    # label the metrics of the commands run during the step
+    global metrics_step
+    metrics_step = step if start else ''
+
+    # (not via run_cmd, so it doesn't show up in the metrics)
+    nodeinfo = ' '.join(os.uname())
 
     if start:
         print('------------------------------------------------------------------')
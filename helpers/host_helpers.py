@@ -0,0 +1,376 @@
+#!/usr/bin/env python
+
+"""
+    Helper functions for the host separation step: turn STAR's own
+    outputs (Log.final.out, Unmapped.out.mate*, ReadsPerGene.out.tab)
+    into the files the rest of the pipeline expects, count the lanes
+    of the input, and merge the outputs of shards of the reads
+    ~~~~~~
+"""
+
+import os
+import re
+import hashlib
+from collections import OrderedDict
+
+# -------------------------------------
+
+def star_log_final(logfile):
+    """Return a dict which maps each field of STAR's Log.final.out to its value (as a string)"""
+
+    d = {}
+
+    with open(logfile, 'r') as f:
+        for line in f:
+            if '|' in line:
+                (key, value) = line.split('|', 1)
+                d[key.strip()] = value.strip()
+
+    return d
+
+def write_flagstat(outfile, total, mapped, paired=0, pairmapped=0, primary=False):
+    """
+    Write counts in the format of samtools flagstat (those not given are 0)
+
+    paired: reads paired in sequencing
+    pairmapped: paired reads with itself and mate mapped (taken as properly paired)
+    primary: total and mapped count primary alignments only: label them 'primary' and 'primary mapped'
+             (as samtools flagstat 1.13 on does) rather than 'in total' and 'mapped', which would count
+             secondary and supplementary alignments too, and leave out the counts of those (not known)
+    """
+
+    def percent(i, total):
+        return '{:.2f}%'.format(100.0 * i / total) if total else 'N/A'
+
+    if primary:
+        lines = [
+            (total, 'primary'),
+            (0, 'primary duplicates'),
+            (mapped, 'primary mapped ({} : N/A)'.format(percent(mapped, total)))
+        ]
+    else:
+        lines = [
+            (total, 'in total (QC-passed reads + QC-failed reads)'),
+            (0, 'secondary'),
+            (0, 'supplementary'),
+            (0, 'duplicates'),
+            (mapped, 'mapped ({} : N/A)'.format(percent(mapped, total)))
+        ]
+
+    lines += [
+        (paired, 'paired in sequencing'),
+        (paired / 2, 'read1'),
+        (paired / 2, 'read2'),
+        (pairmapped, 'properly paired ({} : N/A)'.format(percent(pairmapped, paired))),
+        (pairmapped, 'with itself and mate mapped'),
+        (0, 'singletons ({} : N/A)'.format(percent(0, paired))),
+        (0, 'with mate mapped to a different chr'),
+        (0, 'with mate mapped to a different chr (mapQ>=5)')
+    ]
+
+    with open(outfile, 'w') as f:
+        for (i, text) in lines:
+            f.write('{} + 0 {}\n'.format(i, text))
+
+def star_flagstat(logfile, outfile, single):
+    """
+    Write STAR's counts from Log.final.out in the format of samtools flagstat
+
+    Mapped means uniquely mapped or mapped to (not too many) multiple loci, which are the reads
+    STAR reports as mapped in its bam. Only primary alignments are counted: there's no bam,
+    so no record of secondary ones, and so the counts are labelled as flagstat labels those of
+    primary alignments ('primary', 'primary mapped'). As in flagstat, a pair counts as two reads.
+    """
+
+    d = star_log_final(logfile)
+    factor = 1 if single else 2
+
+    total = factor * int(d['Number of input reads'])
+    mapped = factor * (int(d['Uniquely mapped reads number']) + int(d['Number of reads mapped to multiple loci']))
+    # STAR only maps pairs as pairs (by default): mapped mates are properly paired, and never singletons
+    if single:
+        write_flagstat(outfile, total, mapped, primary=True)
+    else:
+        write_flagstat(outfile, total, mapped, total, mapped, primary=True)
+
+def idxstats_flagstat(stats, outfile):
+    """
+    Write the counts of samtools idxstats (see helpers.bam_idxstats) in the format of samtools flagstat
+
+    Only the total and mapped counts are known (and, as in flagstat, they count every record,
+    secondary alignments included), so the rest are 0
+    """
+
+    mapped = sum(i[2] for i in stats)
+    write_flagstat(outfile, mapped + sum(i[3] for i in stats), mapped)
+
+def unmapped_regions(stats, unplaced_only):
+    """
+    Return the regions of a coordinate-sorted bam (for samtools view) which hold its unmapped reads
+
+    stats: samtools idxstats of the bam (see helpers.bam_idxstats)
+    unplaced_only: only the unplaced unmapped reads are wanted, e.g., pairs with neither mate mapped
+    (which have no position: '*'), rather than also the unmapped mates of mapped reads (which sit
+    next to their mates, on the references with unmapped reads)
+    """
+
+    regions = [] if unplaced_only else [i[0] for i in stats if i[3] and i[0] != '*']
+
+    # always ask for something: no regions would mean the whole bam
+    return regions + ['*']
+
+# -------------------------------------
+
+def star_unmapped2fastq(infile, outfile, mate, stats=None):
+    """
+    Convert one of STAR's Unmapped.out.mate* files into fastq named as sam2fastq.py does (@id/1, @id/2),
+    adding each read to stats (a read_stats.ReadStats), if given; return the number of reads written
+
+    For pairs, STAR notes the mapping status of the mates on the header line (00: neither mapped,
+    10: mate 1 mapped, 01: mate 2 mapped); keep only the pairs where neither mate mapped, as
+    samtools view -f 13 does. The status is the same in both files, so the mates stay in step.
+    """
+
+    status = re.compile(r'^[01][01]$')
+    numreads = 0
+
+    with open(infile, 'r') as f, open(outfile, 'w') as g:
+        while True:
+            header = f.readline()
+            if not header:
+                break
+            myread = f.readline()
+            f.readline()
+            qual = f.readline()
+
+            fields = header[1:].split()
+            # STAR keeps any /1, /2 on the name
+            id = re.sub(r'/[12]$', '', fields[0])
+
+            if any(status.match(i) and i != '00' for i in fields[1:]):
+                continue
+
+            g.write('@' + id + '/' + mate + '\n' + myread + '+\n' + qual)
+            numreads += 1
+            if stats:
+                stats.add(myread.rstrip('\n'))
+
+    return numreads
+
+# -------------------------------------
+
+def lane_countfile(countdir, lane):
+    """Return the file in countdir in which scripts/lane_reads.py records the number of reads of a lane (fastq)"""
+
+    # lanes from different directories may well have the same name
+    return os.path.join(countdir, hashlib.md5(os.path.abspath(lane)).hexdigest() + '.txt')
+
+def lane_reads(countdir, lane):
+    """Return the number of reads of a lane recorded by scripts/lane_reads.py, or None if it wasn't"""
+
+    try:
+        with open(lane_countfile(countdir, lane), 'r') as f:
+            return int(f.read())
+    except (IOError, ValueError):
+        return None
+
+# -------------------------------------
+
+def gtf_genes(gtf):
+    """
+    Return an OrderedDict (in order of the gtf) which maps each gene_id to its exons,
+    a list of (chromosome, start, end, strand), as featureCounts takes them by default
+    """
+
+    genes = OrderedDict()
+    geneid = re.compile(r'gene_id "?([^";]+)"?')
+
+    with open(gtf, 'r') as f:
+        for line in f:
+            if line[0] == '#':
+                continue
+            fields = line.rstrip('\n').split('\t')
+            if len(fields) < 9 or fields[2] != 'exon':
+                continue
+            match = geneid.search(fields[8])
+            if match:
+                genes.setdefault(match.group(1), []).append((fields[0], int(fields[3]), int(fields[4]), fields[6]))
+
+    return genes
+
+def exon_length(exons):
+    """Return the number of bases covered by a list of (chromosome, start, end, strand) (overlaps counted once)"""
+
+    length = 0
+    (lastchr, lastend) = (None, 0)
+
+    for (chr, start, end, strand) in sorted(exons):
+        if chr != lastchr:
+            (lastchr, lastend) = (chr, 0)
+        if end > lastend:
+            length += end - max(start, lastend + 1) + 1
+            lastend = end
+
+    return length
+
+def star_gene_counts(readspergene, gtf, outfile, label):
+    """
+    Write STAR's gene counts (ReadsPerGene.out.tab) in the format of featureCounts,
+    with the coordinates of each gene taken from the gtf, plus the summary (outfile.summary)
+
+    label: the name of the counts column (featureCounts uses the bam)
+
+    The counts are STAR's unstranded ones (column 2), as featureCounts counts by default.
+    Note STAR counts a pair once, as featureCounts -p does.
+    """
+
+    counts = {}
+    summary = {}
+
+    with open(readspergene, 'r') as f:
+        for line in f:
+            fields = line.rstrip('\n').split('\t')
+            if fields[0].startswith('N_'):
+                summary[fields[0]] = int(fields[1])
+            else:
+                counts[fields[0]] = int(fields[1])
+
+    with open(outfile, 'w') as g:
+        g.write('# Program:STAR --quantMode GeneCounts (as featureCounts)\n')
+        g.write('\t'.join(['Geneid', 'Chr', 'Start', 'End', 'Strand', 'Length', label]) + '\n')
+        for (gene, exons) in gtf_genes(gtf).items():
+            g.write('\t'.join([
+                gene,
+                ';'.join(i[0] for i in exons),
+                ';'.join(str(i[1]) for i in exons),
+                ';'.join(str(i[2]) for i in exons),
+                ';'.join(i[3] for i in exons),
+                str(exon_length(exons)),
+                str(counts.get(gene, 0))
+            ]) + '\n')
+
+    with open(outfile + '.summary', 'w') as g:
+        g.write('Status\t' + label + '\n')
+        for (i, j) in [('Assigned', sum(counts.values())),
+                       ('Unassigned_Unmapped', summary.get('N_unmapped', 0)),
+                       ('Unassigned_MultiMapping', summary.get('N_multimapping', 0)),
+                       ('Unassigned_NoFeatures', summary.get('N_noFeature', 0)),
+                       ('Unassigned_Ambiguity', summary.get('N_ambiguous', 0))]:
+            g.write('{}\t{}\n'.format(i, j))
+
+# -------------------------------------
+
+def merge_flagstat(infiles, outfile):
+    """
+    Sum files in the format of samtools flagstat (e.g., of shards of the reads) into one,
+    working the percentages out again
+    """
+
+    # what each percentage is a percentage of
+    denominators = {
+        'mapped': 'in total (QC-passed reads + QC-failed reads)',
+        'primary mapped': 'primary',
+        'properly paired': 'paired in sequencing',
+        'singletons': 'paired in sequencing'
+    }
+    line = re.compile(r'^(\d+) \+ (\d+) (.*)$')
+
+    # labels (in order) and their [QC-passed, QC-failed] counts
+    labels = []
+    counts = {}
+    percent = set()
+
+    for infile in infiles:
+        with open(infile, 'r') as f:
+            for i in f:
+                match = line.match(i.rstrip('\n'))
+                if not match:
+                    continue
+                text = match.group(3)
+                # drop a percentage, e.g., (85.00% : N/A), though not (mapQ>=5)
+                if text.endswith(')') and ' : ' in text:
+                    text = text[:text.rindex(' (')]
+                    percent.add(text)
+                if text not in counts:
+                    labels.append(text)
+                    counts[text] = [0, 0]
+                counts[text][0] += int(match.group(1))
+                counts[text][1] += int(match.group(2))
+
+    def fraction(i, total):
+        return '{:.2f}%'.format(100.0 * i / total) if total else 'N/A'
+
+    with open(outfile, 'w') as f:
+        for text in labels:
+            c = counts[text]
+            if text in percent:
+                d = counts.get(denominators.get(text), [0, 0])
+                f.write('{} + {} {} ({} : {})\n'.format(c[0], c[1], text, fraction(c[0], d[0]), fraction(c[1], d[1])))
+            else:
+                f.write('{} + {} {}\n'.format(c[0], c[1], text))
+
+def merge_linecounts(infiles, outfile, labels):
+    """
+    Sum files of line counts (as wc -l writes them: count, then file name), line by line,
+    into one, naming the lines with labels (by default, the names in the first file)
+    """
+
+    counts = []
+    names = []
+
+    for infile in infiles:
+        with open(infile, 'r') as f:
+            for (k, i) in enumerate(f):
+                fields = i.split()
+                if k == len(counts):
+                    counts.append(0)
+                    names.append(fields[1] if len(fields) > 1 else '')
+                counts[k] += int(fields[0])
+
+    with open(outfile, 'w') as f:
+        for k in range(len(counts)):
+            f.write('{} {}\n'.format(counts[k], labels[k] if k < len(labels) else names[k]))
+
+def merge_gene_counts(infiles, outfile, label):
+    """
+    Sum gene counts in the format of featureCounts (e.g., of shards of the reads) into one,
+    plus their summaries (outfile.summary), naming the counts column label
+    """
+
+    counts = OrderedDict()
+    comments = []
+
+    for (k, infile) in enumerate(infiles):
+        with open(infile, 'r') as f:
+            for i in f:
+                fields = i.rstrip('\n').split('\t')
+                if i[0] == '#':
+                    if k == 0:
+                        comments.append(i)
+                elif fields[0] == 'Geneid':
+                    header = fields[:-1] + [label]
+                elif fields[0] in counts:
+                    counts[fields[0]][-1] += int(fields[-1])
+                else:
+                    counts[fields[0]] = fields[:-1] + [int(fields[-1])]
+
+    with open(outfile, 'w') as f:
+        f.writelines(comments)
+        f.write('\t'.join(header) + '\n')
+        for i in counts.values():
+            f.write('\t'.join(i[:-1] + [str(i[-1])]) + '\n')
+
+    summary = OrderedDict()
+    for infile in infiles:
+        if os.path.exists(infile + '.summary'):
+            with open(infile + '.summary', 'r') as f:
+                for i in f:
+                    fields = i.rstrip('\n').split('\t')
+                    if fields[0] != 'Status':
+                        summary[fields[0]] = summary.get(fields[0], 0) + int(fields[-1])
+
+    if summary:
+        with open(outfile + '.summary', 'w') as f:
+            f.write('Status\t' + label + '\n')
+            for (i, j) in summary.items():
+                f.write('{}\t{}\n'.format(i, j))
@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+
+"""
+    Intermediate files of a step: delete each one as soon as the last
+    command which reads it has finished (rather than all of them at the
+    end of the step), and keep track of the step's peak disk usage
+    ~~~~~~
+"""
+
+from __future__ import absolute_import
+
+import os
+import glob
+import shutil
+
+from helpers import helpers as hp
+
+# -------------------------------------
+
+def disk_usage(mydir):
+    """Return the bytes used by the files under a directory, or by a file (not following symlinks)"""
+
+    if not os.path.isdir(mydir) or os.path.islink(mydir):
+        try:
+            return os.lstat(mydir).st_blocks * 512
+        except OSError:
+            return 0
+
+    total = 0
+    for (root, dirs, files) in os.walk(mydir):
+        for i in files:
+            try:
+                st = os.lstat(os.path.join(root, i))
+                # allocated blocks, so sparse files and /dev/shm are counted as they really are
+                total += st.st_blocks * 512
+            except OSError:
+                # deleted while we were looking
+                pass
+
+    return total
+
+# -------------------------------------
+
+class Intermediates(object):
+    """
+    The intermediate files of a step, and the commands which read them
+
+    Register each file with the names of the commands which read it; tell the tracker
+    when each command has finished; a file goes as soon as all of its readers have.
+    With noclean, files are kept (those registered with compress=True are gzipped instead).
+    """
+
+    def __init__(self, noclean, verbose, step, mydir='.'):
+        """
+        noclean: keep the files
+        verbose: echo what's deleted
+        step: label for the metrics
+        mydir: the step's output directory: its usage, and that of the files registered, is tracked
+               (not the whole working directory, which other steps may be writing to at the same time)
+        """
+        self.noclean = int(noclean)
+        self.verbose = verbose
+        self.step = step
+        self.mydir = mydir
+        # map each file (or glob) to [set of readers still to come, compress]
+        self.files = {}
+        self.peak = 0
+
+    def add(self, myfile, readers, compress=False):
+        """Register a file (or glob) and the names of the commands which read it"""
+        self.files[myfile] = [set(readers), compress]
+
+    def done(self, reader):
+        """Note that a command has finished, and delete the files nobody else reads"""
+
+        # the peak is right before anything goes
+        self.measure()
+
+        # (files registered with no readers wait for report)
+        for myfile in sorted(self.files):
+            if reader in self.files[myfile][0]:
+                self.files[myfile][0].discard(reader)
+                if not self.files[myfile][0]:
+                    self.remove(myfile, self.files[myfile][1])
+                    del self.files[myfile]
+
+    def remove(self, myfile, compress=False):
+        """Delete (or, with noclean, keep or gzip) a file or directory"""
+
+        for i in glob.glob(myfile):
+            if self.noclean:
+                if compress and os.path.isfile(i):
+                    hp.run_cmd('gzip -f ' + i, self.verbose, 0)
+                continue
+            if self.verbose:
+                print('[intermediates] remove ' + i)
+            if os.path.isdir(i) and not os.path.islink(i):
+                shutil.rmtree(i, ignore_errors=True)
+            else:
+                os.remove(i)
+
+    def measure(self):
+        """Update the peak disk usage"""
+
+        # the files registered outside the output directory count too (those inside it already do)
+        paths = [self.mydir] + [i for myfile in self.files for i in glob.glob(myfile)]
+        paths = set(i for i in paths if i == self.mydir or os.path.relpath(i, self.mydir).startswith('..'))
+
+        self.peak = max(self.peak, sum(disk_usage(i) for i in paths))
+
+    def report(self):
+        """Delete whatever is left, then record the peak disk usage in the metrics file"""
+
+        self.measure()
+
+        for myfile in sorted(self.files):
+            self.remove(myfile, self.files[myfile][1])
+        self.files = {}
+
+        print('[intermediates] peak disk usage: {:.2f}G'.format(self.peak / float(2**30)))
+        hp.write_metrics({'step': self.step, 'dir': self.mydir, 'peak_disk_bytes': self.peak})
@@ -0,0 +1,284 @@
+#!/usr/bin/env python
+
+"""
+    Pseudo-alignment of reads to contigs by shared k-mers: count the reads of
+    each contig (as samtools idxstats would of the reads mapped to them), and
+    approximate the coverage, in one streaming pass over the reads, without
+    aligning them
+    ~~~~~~
+"""
+
+import sys
+import subprocess
+import itertools
+import numpy as np
+
+# -------------------------------------
+
+# 2-bit codes of the bases (anything else, e.g., N or a newline, is 4: no k-mer spans it)
+codes = np.full(256, 4, dtype=np.uint8)
+for (i, base) in enumerate('ACGT'):
+    codes[ord(base)] = i
+    codes[ord(base.lower())] = i
+
+def encode(seq):
+    """Return the 2-bit codes of a string of bases, as a numpy array"""
+    return codes[np.frombuffer(seq, dtype=np.uint8)]
+
+def kmers_at(code, starts, k):
+    """
+    Return the canonical k-mers (the lesser of the k-mer and its reverse complement, packed 2 bits
+    a base into a uint64) of a coded sequence starting at each of starts, and which of them are valid
+    (don't span anything but ACGT)
+    """
+
+    fwd = np.zeros(len(starts), dtype=np.uint64)
+    rev = np.zeros(len(starts), dtype=np.uint64)
+    bad = np.zeros(len(starts), dtype=bool)
+    for j in range(k):
+        c = code[starts + j]
+        bad |= c > 3
+        c = (c & 3).astype(np.uint64)
+        fwd = (fwd << np.uint64(2)) | c
+        rev |= (np.uint64(3) - c) << np.uint64(2 * j)
+
+    return (np.minimum(fwd, rev), ~bad)
+
+# -------------------------------------
+
+class KmerIndex(object):
+    """
+    The k-mers of a set of contigs, sorted, so a batch of k-mers is looked up all at once (np.searchsorted)
+
+    Each k-mer maps to the first contig it's in (in the order of the fasta), its position there,
+    and whether it's shared by other contigs (and so says little about where a read belongs).
+    """
+
+    def __init__(self, fasta, k):
+        """
+        fasta: the contigs (a sequence on one line, as hp.fastajoinlines writes it)
+        k: the length of the k-mers (at most 32)
+        """
+
+        self.k = k
+        self.names = []
+        self.lengths = []
+
+        allkmers = []
+        contigs = []
+        positions = []
+
+        with open(fasta, 'r') as f:
+            for line in f:
+                if line[0] == '>':
+                    self.names.append(line[1:].split()[0])
+                    continue
+                seq = line.rstrip('\n')
+                self.lengths.append(len(seq))
+                if len(seq) < k:
+                    continue
+                starts = np.arange(len(seq) - k + 1)
+                (kmers, valid) = kmers_at(encode(seq), starts, k)
+                allkmers.append(kmers[valid])
+                positions.append(starts[valid].astype(np.int32))
+                contigs.append(np.full(valid.sum(), len(self.names) - 1, dtype=np.int32))
+
+        kmers = np.concatenate(allkmers) if allkmers else np.zeros(0, dtype=np.uint64)
+        contigs = np.concatenate(contigs) if contigs else np.zeros(0, dtype=np.int32)
+        positions = np.concatenate(positions) if positions else np.zeros(0, dtype=np.int32)
+
+        # sort on k-mer, then contig, so the first of each run of a k-mer is its first contig
+        order = np.lexsort((contigs, kmers))
+        (kmers, contigs, positions) = (kmers[order], contigs[order], positions[order])
+        first = np.ones(len(kmers), dtype=bool)
+        first[1:] = kmers[1:] != kmers[:-1]
+        last = np.ones(len(kmers), dtype=bool)
+        last[:-1] = first[1:]
+        # a k-mer is shared if its run spans more than one contig
+        shared = contigs[last] != contigs[first]
+
+        self.kmers = kmers[first]
+        self.contigs = contigs[first]
+        self.positions = positions[first]
+        self.shared = shared
+
+    def lookup(self, kmers):
+        """Return (contig, position, shared) of each of a batch of k-mers (contig -1 if it's in none)"""
+
+        if not len(self.kmers):
+            return (np.full(len(kmers), -1, dtype=np.int32), np.zeros(len(kmers), dtype=np.int32), np.zeros(len(kmers), dtype=bool))
+
+        i = np.minimum(np.searchsorted(self.kmers, kmers), len(self.kmers) - 1)
+        found = self.kmers[i] == kmers
+
+        return (np.where(found, self.contigs[i], -1), self.positions[i], self.shared[i] & found)
+
+# -------------------------------------
+
+def read_starts(lengths, k, stride):
+    """
+    Return the reads (indices) and offsets in them at which to take k-mers: every stride bases,
+    and the last k-mer of the read, so all of it is covered (reads shorter than k have none)
+    """
+
+    numkmers = np.where(lengths >= k, (lengths - k + stride - 1) // stride + 1, 0)
+    reads = np.repeat(np.arange(len(lengths)), numkmers)
+    offsets = (np.arange(len(reads)) - np.repeat(np.cumsum(numkmers) - numkmers, numkmers)) * stride
+
+    return (reads, np.minimum(offsets, lengths[reads] - k))
+
+def hits(index, seqs, stride):
+    """
+    Look up the k-mers of a batch of reads (their sequences, each ending with a newline)
+
+    Returns (read, contig, position, shared) of each k-mer found in the index
+    """
+
+    lengths = np.array([len(i) - 1 for i in seqs], dtype=np.int64)
+    # the reads end to end, each followed by its newline (which no k-mer spans)
+    code = encode(''.join(seqs))
+    offsets = np.cumsum(lengths + 1) - lengths - 1
+
+    (reads, starts) = read_starts(lengths, index.k, stride)
+    (kmers, valid) = kmers_at(code, offsets[reads] + starts, index.k)
+    (reads, kmers) = (reads[valid], kmers[valid])
+
+    (contigs, positions, shared) = index.lookup(kmers)
+    found = contigs >= 0
+
+    return (reads[found], contigs[found], positions[found], shared[found])
+
+def assign(numreads, numcontigs, reads, contigs, shared):
+    """
+    Assign each read (or pair) to a contig, given its k-mer hits: the contig most of its
+    unshared k-mers are in or, if all its k-mers are shared, the first contig of the first of them
+
+    Returns an array of the contig of each read (-1 for none)
+    """
+
+    assigned = np.full(numreads, -1, dtype=np.int64)
+
+    # reads with only shared k-mers first, so those with unshared ones overwrite them
+    first = np.unique(reads[shared], return_index=True)
+    assigned[first[0]] = contigs[shared][first[1]]
+
+    # count the unshared k-mers of each read in each contig, then keep the contig with most (ties: the first)
+    (keys, counts) = np.unique(reads[~shared].astype(np.int64) * numcontigs + contigs[~shared], return_counts=True)
+    (keyreads, keycontigs) = (keys // numcontigs, keys % numcontigs)
+    order = np.lexsort((-counts, keyreads))
+    best = np.ones(len(order), dtype=bool)
+    best[1:] = keyreads[order][1:] != keyreads[order][:-1]
+    assigned[keyreads[order][best]] = keycontigs[order][best]
+
+    return assigned
+
+# -------------------------------------
+
+def pseudoalign(fasta, fastqs, statsfile, bamfile, k=31, stride=8, batchsize=200000, bool_verbose=False):
+    """
+    Pseudo-align reads (single, or pairs) to contigs
+
+    fasta: the contigs
+    fastqs: list of the (gzipped) fastq of each mate, in step
+    statsfile: the number of reads of each contig, in the format of samtools idxstats (contig, length,
+               mapped reads, unmapped mates of mapped reads; then the unplaced reads, '*')
+    bamfile: a bam of the reads assigned to no contig (as unmapped records), for blasting the unassembled reads
+    k: the length of the k-mers
+    stride: take every stride-th k-mer of a read (pseudo-alignment needs few; taking fewer is faster)
+    batchsize: the number of reads (or pairs) looked up at once
+
+    A mate counts as mapped if any of its k-mers are found. The coverage is approximate:
+    each mate covers the span of its k-mers found in the contig of its read (or pair).
+
+    Returns a dict which maps each covered contig to its depth array (as for assembly_helpers.coverage)
+    """
+
+    index = KmerIndex(fasta, k)
+    numcontigs = len(index.names)
+    print('[pseudoalign] {} contigs, {} distinct {}-mers'.format(numcontigs, len(index.kmers), k))
+
+    single = len(fastqs) == 1
+    mapped = np.zeros(numcontigs, dtype=np.int64)
+    unmapped = np.zeros(numcontigs, dtype=np.int64)
+    unplaced = 0
+
+    # the contigs end to end, a base apart, so one running sum of +1s and -1s gives the depth of them all
+    offsets = np.concatenate([[0], np.cumsum(np.array(index.lengths, dtype=np.int64) + 1)])
+    diff = np.zeros(offsets[-1] + 1, dtype=np.int64)
+
+    readers = [subprocess.Popen(['gzip', '-dc', i], stdout=subprocess.PIPE, bufsize=1 << 20) for i in fastqs]
+    # the unassigned reads go into a bam (samtools view -b takes sam on stdin)
+    writer = subprocess.Popen(['samtools', 'view', '-b', '-o', bamfile, '-'], stdin=subprocess.PIPE, bufsize=1 << 20)
+    out = writer.stdin
+    out.write('@HD\tVN:1.0\tSO:unsorted\n')
+    for (name, length) in zip(index.names, index.lengths):
+        out.write('@SQ\tSN:{}\tLN:{}\n'.format(name, length))
+
+    (numreads, numassigned) = (0, 0)
+    while True:
+        batch = [list(itertools.islice(i.stdout, 4 * batchsize)) for i in readers]
+        if not batch[0]:
+            break
+        numbatch = len(batch[0]) // 4
+        numreads += numbatch
+
+        # the hits of every mate, on the index of its read (or pair)
+        mates = [hits(index, i[1::4], stride) for i in batch]
+        (reads, contigs, positions, shared) = [np.concatenate(i) for i in zip(*mates)]
+        assigned = assign(numbatch, numcontigs, reads, contigs, shared)
+        numassigned += np.count_nonzero(assigned >= 0)
+
+        for (mate, (r, c, p, s)) in enumerate(mates):
+            # a mate with hits is mapped (to the contig of its read); one without, of an assigned pair, is an unmapped mate
+            hit = np.zeros(numbatch, dtype=bool)
+            hit[r] = True
+            isassigned = assigned >= 0
+            mapped += np.bincount(assigned[hit & isassigned], minlength=numcontigs)
+            unmapped += np.bincount(assigned[~hit & isassigned], minlength=numcontigs)
+
+            # the span of the mate's k-mers in its read's contig
+            oncontig = c == assigned[r]
+            (r, p) = (r[oncontig], p[oncontig])
+            if len(r):
+                lo = np.full(numbatch, np.iinfo(np.int64).max, dtype=np.int64)
+                hi = np.full(numbatch, -1, dtype=np.int64)
+                np.minimum.at(lo, r, p)
+                np.maximum.at(hi, r, p)
+                spans = hi >= 0
+                base = offsets[assigned[spans]]
+                np.add.at(diff, base + lo[spans], 1)
+                np.add.at(diff, base + np.minimum(hi[spans] + k, np.array(index.lengths)[assigned[spans]]), -1)
+
+        # the unassigned reads, as unmapped records (pairs flagged as such)
+        for i in np.flatnonzero(assigned < 0):
+            for mate in range(len(batch)):
+                name = batch[mate][4 * i][1:].split()[0]
+                if not single:
+                    name = name[:-2] if name[-2:] in ['/1', '/2'] else name
+                flag = '4' if single else ['77', '141'][mate]
+                out.write('\t'.join([name, flag, '*', '0', '0', '*', '*', '0', '0', batch[mate][4 * i + 1].rstrip('\n'), batch[mate][4 * i + 3].rstrip('\n')]) + '\n')
+                unplaced += 1
+
+        if bool_verbose:
+            print('[pseudoalign] {} reads, {} assigned to contigs'.format(numreads, numassigned))
+            sys.stdout.flush()
+
+    out.close()
+    for proc in readers + [writer]:
+        if proc.wait() != 0:
+            raise RuntimeError('pseudo-alignment: a command exited with error code ' + str(proc.returncode))
+
+    with open(statsfile, 'w') as f:
+        for i in range(numcontigs):
+            f.write('{}\t{}\t{}\t{}\n'.format(index.names[i], index.lengths[i], mapped[i], unmapped[i]))
+        f.write('*\t0\t0\t{}\n'.format(unplaced))
+
+    # the depth of each covered contig
+    depth = np.cumsum(diff)
+    depths = {}
+    for i in range(numcontigs):
+        d = depth[offsets[i]:offsets[i] + index.lengths[i]]
+        if d.any():
+            depths[index.names[i]] = d
+
+    return depths
@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+
+"""
+    Read statistics (counts, length histogram, GC and N content, duplicate rate)
+    gathered in whatever pass already goes through the reads, and kept in a
+    json file with one record per set of reads
+    ~~~~~~
+"""
+
+import os
+import json
+
+# -------------------------------------
+
+class ReadStats(object):
+    """
+    Statistics of a set of reads, added one at a time
+
+    The duplicate rate is estimated over the first dupsample reads (as FastQC does),
+    so memory stays bounded however many reads there are.
+    """
+
+    dupsample = 1000000
+
+    def __init__(self):
+        self.reads = 0
+        self.bases = 0
+        self.gc = 0
+        self.n = 0
+        # map each read length to its number of reads
+        self.lengths = {}
+        # hashes of the sequences in the sample
+        self.seen = set()
+        self.sampled = 0
+        self.duplicates = 0
+
+    def add(self, myread):
+        """Add a read (its sequence)"""
+
+        self.reads += 1
+        length = len(myread)
+        self.bases += length
+        self.lengths[length] = self.lengths.get(length, 0) + 1
+        self.gc += myread.count('G') + myread.count('C')
+        self.n += myread.count('N')
+
+        if self.sampled < self.dupsample:
+            self.sampled += 1
+            h = hash(myread)
+            if h in self.seen:
+                self.duplicates += 1
+            else:
+                self.seen.add(h)
+
+    def summary(self):
+        """Return the statistics as a dict"""
+
+        def fraction(i, total):
+            return round(float(i) / total, 4) if total else None
+
+        return {
+            'reads': self.reads,
+            'bases': self.bases,
+            'mean_length': round(float(self.bases) / self.reads, 2) if self.reads else None,
+            'length_histogram': dict((str(i), j) for (i, j) in sorted(self.lengths.items())),
+            'gc_fraction': fraction(self.gc, self.bases),
+            'n_fraction': fraction(self.n, self.bases),
+            'duplicate_rate': fraction(self.duplicates, self.sampled),
+            'duplicate_sample': self.sampled
+        }
+
+# -------------------------------------
+
+def merge(records):
+    """
+    Merge summaries (see ReadStats.summary) of disjoint sets of reads, e.g., shards, into one
+
+    The duplicate rate is the average of the rates weighted by their samples: duplicates
+    across sets aren't seen. Records with only some fields (e.g., the input count) merge those.
+    """
+
+    d = {}
+
+    for i in ['reads', 'bases', 'duplicate_sample']:
+        if any(i in j for j in records):
+            d[i] = sum(j.get(i, 0) for j in records)
+
+    if any('length_histogram' in j for j in records):
+        histogram = {}
+        for j in records:
+            for (length, n) in j.get('length_histogram', {}).items():
+                histogram[length] = histogram.get(length, 0) + n
+        d['length_histogram'] = histogram
+
+    # fractions weighted by what they're fractions of
+    for (i, weight) in [('gc_fraction', 'bases'), ('n_fraction', 'bases'), ('duplicate_rate', 'duplicate_sample')]:
+        if any(i in j for j in records):
+            total = sum(j.get(weight, 0) for j in records if j.get(i) is not None)
+            d[i] = round(sum(j[i] * j.get(weight, 0) for j in records if j.get(i) is not None) / float(total), 4) if total else None
+
+    if 'bases' in d:
+        d['mean_length'] = round(float(d['bases']) / d['reads'], 2) if d['reads'] else None
+
+    return d
+
+def merge_files(infiles, outfile):
+    """Merge read statistics json files (e.g., of shards of the reads), record by record, into one"""
+
+    records = {}
+    for infile in infiles:
+        if os.path.exists(infile):
+            with open(infile, 'r') as f:
+                for (key, record) in json.load(f).items():
+                    records.setdefault(key, []).append(record)
+
+    for (key, record) in sorted(records.items()):
+        update(outfile, key, merge(record))
+
+# -------------------------------------
+
+def update(jsonfile, key, record):
+    """Set one record (a dict) of the read statistics json file, keeping the others"""
+
+    d = {}
+    if os.path.exists(jsonfile):
+        with open(jsonfile, 'r') as f:
+            d = json.load(f)
+
+    d[key] = record
+
+    # write then rename, so a reader never sees half a file
+    with open(jsonfile + '.tmp', 'w') as f:
+        json.dump(d, f, indent=2, sort_keys=True)
+    os.rename(jsonfile + '.tmp', jsonfile)
@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+
+"""
+    Local (non-SGE) scheduling of pipeline steps: work out which steps
+    depend on which from the files they read and write, then run every
+    step whose inputs are ready, as many at a time as the machine allows
+    ~~~~~~
+"""
+
+from __future__ import absolute_import
+
+import sys
+import os
+import time
+import threading
+import multiprocessing
+import Queue
+
+from helpers import helpers as hp
+
+# -------------------------------------
+
+def local_resources(maxcores=None, maxmem=None):
+    """
+    Return the (number of cores, memory in G) available on this machine
+
+    maxcores: cap on the number of cores (None means use them all)
+    maxmem: cap on the memory in G (None means use it all)
+    """
+
+    cores = multiprocessing.cpu_count()
+    try:
+        mem = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') / float(2**30)
+    except (ValueError, OSError):
+        # sysconf names not available on this platform: don't restrict on memory
+        mem = float('inf')
+
+    if maxcores:
+        cores = min(cores, int(maxcores))
+    if maxmem:
+        mem = min(mem, float(maxmem))
+
+    return (cores, mem)
+
+# -------------------------------------
+
+def step_graph(steps, io):
+    """
+    Map each step to the set of steps it depends on
+
+    steps: the steps to run, in pipeline order (e.g., '12345')
+    io: dict which maps each step to a tuple (list of input files, list of output files)
+
+    A step depends on an earlier step if it reads a file the earlier step writes.
+    Inputs not written by any of the steps being run are assumed to exist already.
+    """
+
+    deps = {}
+
+    for k, i in enumerate(steps):
+        inputs = set(j for j in io[i][0] if j)
+        deps[i] = set(j for j in steps[:k] if inputs & set(io[j][1]))
+
+    return deps
+
+# -------------------------------------
+
+def run_dag(tasks, deps, cores, mem, verbose, myout, myerr):
+    """
+    Run tasks concurrently, respecting dependencies and a budget of cores and memory
+
+    tasks: dict which maps each task name to a dict with keys
+        cmd (shell command), cores (int), mem (memory in G, float)
+        and, optionally, priority (lower runs first; default: the task name),
+        hours (how long it's expected to run, at most: default unknown)
+        and cwd (directory to run in, which is also where its logs go)
+    deps: dict which maps each task name to the set of task names it waits on
+    cores: total number of cores available
+    mem: total memory (in G) available
+    verbose: echo commands
+    myout, myerr: log files for stdout and stderr
+
+    Tasks whose dependencies failed are not run.
+
+    Ready tasks start in priority order, as they fit. The first which doesn't fit gets a reservation
+    (EASY backfilling): when the running tasks are expected to have freed enough for it (their hours),
+    and what will be left over then. Lower priority tasks start ahead of it only if they're expected
+    to be done by then, or fit in what it leaves over, so a stream of small tasks can't starve it.
+    Returns a dict which maps each task name to its exit code (None if not run)
+    """
+
+    # a task asking for more than the machine has would never start: cap its request
+    need = {}
+    for name, task in tasks.items():
+        need[name] = (min(int(task.get('cores', 1)), cores), min(float(task.get('mem', 0)), mem))
+
+    pending = set(tasks)
+    running = set()
+    # tasks which failed or were skipped
+    failed = set()
+    status = {}
+    free = [cores, mem]
+    # when each running task started
+    started = {}
+    # worker threads report (task name, exit code) here
+    done = Queue.Queue()
+
+    def worker(name):
+        cwd = tasks[name].get('cwd')
+        # what the task was granted, so what it runs in turn (e.g., a local array job) stays within it
+        env = dict(os.environ, PANDORA_CORES=str(need[name][0]), PANDORA_MEM=str(need[name][1]))
+        returncode = hp.run_log_cmd(tasks[name]['cmd'], verbose, os.path.join(cwd or '', myout), os.path.join(cwd or '', myerr), cwd=cwd, step=name, env=env, failfast=False)
+        done.put((name, returncode))
+
+    def order(name):
+        return (tasks[name].get('priority', name), name)
+
+    def hours(name):
+        return float(tasks[name].get('hours') or 'inf')
+
+    def reserve(name):
+        """Return (the time by which a task fits, what else is free then), going by the running tasks' hours"""
+        avail = list(free)
+        for (end, i) in sorted((started[i] + 3600 * hours(i), i) for i in running):
+            avail = [avail[0] + need[i][0], avail[1] + need[i][1]]
+            if need[name][0] <= avail[0] and need[name][1] <= avail[1]:
+                return (end, [avail[0] - need[name][0], avail[1] - need[name][1]])
+        return (float('inf'), [0, 0])
+
+    while pending or running:
+        # drop tasks downstream of a failure (repeat, so the skip propagates down the graph)
+        skipped = True
+        while skipped:
+            skipped = False
+            for name in sorted(pending, key=order):
+                if failed & set(deps.get(name, ())):
+                    print('[scheduler] skip ' + name + ' (upstream failed)')
+                    pending.discard(name)
+                    failed.add(name)
+                    status[name] = None
+                    skipped = True
+
+        # start every ready task that fits, in priority order (small tasks backfill around big ones),
+        # except where that would hold up the first one which doesn't fit
+        shadow = None
+        for name in sorted(pending, key=order):
+            if any(j in pending or j in running for j in deps.get(name, ())):
+                continue
+            if not (need[name][0] <= free[0] and need[name][1] <= free[1]):
+                if shadow is None:
+                    (shadow, extra) = reserve(name)
+                    if verbose:
+                        print('[scheduler] reserve cores={}, mem={}G for {}'.format(need[name][0], need[name][1], name))
+                continue
+            if shadow is not None and (shadow == float('inf') or time.time() + 3600 * hours(name) > shadow):
+                # not (known to be) done in time: only in what the reservation leaves over
+                if not (need[name][0] <= extra[0] and need[name][1] <= extra[1]):
+                    continue
+                extra = [extra[0] - need[name][0], extra[1] - need[name][1]]
+            pending.discard(name)
+            running.add(name)
+            free[0] -= need[name][0]
+            free[1] -= need[name][1]
+            started[name] = time.time()
+            print('[scheduler] start {} (cores={}, mem={}G)'.format(name, need[name][0], need[name][1]))
+            sys.stdout.flush()
+            t = threading.Thread(target=worker, args=(name,))
+            t.daemon = True
+            t.start()
+
+        if not running:
+            # nothing running and nothing startable: only happens if deps is cyclic or dangling
+            for name in pending:
+                print('[scheduler] skip ' + name + ' (unsatisfiable dependencies)')
+                status[name] = None
+            break
+
+        # wait for a task to finish (poll, so Ctrl-C still works)
+        while True:
+            try:
+                (name, returncode) = done.get(timeout=1)
+                break
+            except Queue.Empty:
+                pass
+
+        running.discard(name)
+        status[name] = returncode
+        if returncode != 0:
+            failed.add(name)
+        free[0] += need[name][0]
+        free[1] += need[name][1]
+        print('[scheduler] end {} (exit code {})'.format(name, returncode))
+        sys.stdout.flush()
+
+    return status
@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+
+"""
+    A STAR genome in shared memory, shared by the host separation jobs
+    on a node: the first to attach loads it, the last to detach removes it
+    ~~~~~~
+"""
+
+from __future__ import absolute_import
+
+import os
+import json
+import fcntl
+import errno
+import shutil
+import hashlib
+import tempfile
+
+from helpers import helpers as hp
+
+# -------------------------------------
+
+def genome_size(genomedir):
+    """Return the bytes of a STAR genome which go into memory (Genome, SA, SAindex), or 0 if they can't be read"""
+
+    total = 0
+    for i in ['Genome', 'SA', 'SAindex']:
+        try:
+            total += os.path.getsize(os.path.join(genomedir, i))
+        except OSError:
+            return 0
+
+    return total
+
+def alive(pid):
+    """Return True if a process (on this node) is still running"""
+
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        # it exists, it just isn't ours
+        return e.errno == errno.EPERM
+
+    return True
+
+# -------------------------------------
+
+class SharedGenome(object):
+    """
+    A STAR genome loaded into shared memory (STAR --genomeLoad), counted by the jobs using it
+
+    The jobs on a node using a genome are recorded, by pid, in a state file next to a lock file,
+    both in /dev/shm (so, like the genome itself, they don't outlive a reboot). Jobs which died
+    without detaching (e.g., killed by the scheduler) are dropped from the count when next looked at.
+    """
+
+    def __init__(self, genomedir, verbose, stderr=None):
+        """
+        genomedir: STAR's --genomeDir
+        verbose: echo commands
+        stderr: (optional) where STAR's errors go (see hp.run_pipeline)
+        """
+        self.genomedir = os.path.realpath(genomedir)
+        self.verbose = verbose
+        self.stderr = stderr
+        self.attached = False
+
+        shmdir = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+        # one pair of files per genome per node (and user, since others can't read ours)
+        key = hashlib.md5(self.genomedir).hexdigest()[:16]
+        prefix = os.path.join(shmdir, 'pandora_star_{}_{}'.format(os.getuid(), key))
+        self.lockfile = prefix + '.lock'
+        self.statefile = prefix + '.json'
+
+    def star(self, mode):
+        """Run STAR --genomeLoad mode (LoadAndExit or Remove) on the genome; return True if it worked"""
+
+        # STAR writes its logs wherever it's told to: somewhere we can throw away
+        logdir = tempfile.mkdtemp(prefix='pandora_star_')
+        try:
+            (returncodes, output) = hp.run_pipeline([['STAR', '--genomeLoad', mode, '--genomeDir', self.genomedir, '--outFileNamePrefix', logdir + '/']], self.verbose, stdout=os.devnull, stderr=self.stderr)
+        finally:
+            shutil.rmtree(logdir, ignore_errors=True)
+
+        return not returncodes[0]
+
+    def update(self, change):
+        """
+        Under the lock, read the state (dict of 'loaded' and 'pids', the jobs using the genome),
+        drop the jobs which have died, apply change (a function of the state), then write it back
+        """
+
+        with open(self.lockfile, 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                state = {'loaded': False, 'pids': []}
+                if os.path.exists(self.statefile):
+                    with open(self.statefile, 'r') as f:
+                        state = json.load(f)
+                state['pids'] = [i for i in state['pids'] if alive(i)]
+
+                change(state)
+
+                with open(self.statefile + '.tmp', 'w') as f:
+                    json.dump(state, f)
+                os.rename(self.statefile + '.tmp', self.statefile)
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def attach(self):
+        """
+        Count this job as using the genome, loading it first if nobody has;
+        return True if it's in shared memory (so STAR can run with --genomeLoad LoadAndKeep)
+        """
+
+        def change(state):
+            if not state['loaded']:
+                print('[star shm] loading ' + self.genomedir + ' into shared memory')
+                state['loaded'] = self.star('LoadAndExit')
+            else:
+                print('[star shm] attaching to ' + self.genomedir + ' ({} other job(s) using it)'.format(len(state['pids'])))
+            if state['loaded']:
+                state['pids'].append(os.getpid())
+                self.attached = True
+
+        self.update(change)
+
+        if not self.attached:
+            print('[star shm] could not load the genome into shared memory (is kernel.shmmax big enough?): STAR will load its own copy')
+
+        return self.attached
+
+    def detach(self):
+        """Stop counting this job as using the genome, removing it from shared memory if nobody else is"""
+
+        if not self.attached:
+            return
+
+        def change(state):
+            state['pids'] = [i for i in state['pids'] if i != os.getpid()]
+            if state['loaded'] and not state['pids']:
+                print('[star shm] removing ' + self.genomedir + ' from shared memory')
+                self.star('Remove')
+                state['loaded'] = False
+
+        self.update(change)
+        self.attached = False
@@ -14,6 +14,8 @@ import argparse
 import sys
 import subprocess
 import os
+import copy
+import glob
 import ConfigParser
 
 def add_common_args(sub):
@@ -26,7 +28,8 @@ def add_common_args(sub):
     sub.add_argument('-c', '--config', help='config file')
     sub.add_argument('--noclean', action='store_true', help='do not delete temporary intermediate files (default: off)')
     sub.add_argument('--verbose', action='store_true', help='verbose mode: echo commands, etc (default: off)')
-    sub.add_argument('--noSGE', action='store_true', help='do not qsub jobs with the Oracle Grid Engine (default: off)')
+    sub.add_argument('--noSGE', action='store_true', help='do not qsub jobs with the Oracle Grid Engine (default: off) (same as --scheduler local)')
+    sub.add_argument('--scheduler', default='sge', choices=['sge', 'slurm', 'local', 'fake'], help='how to run jobs: sge (qsub), slurm (sbatch), local (on this machine), or fake (print what would be submitted, run nothing) (default: sge)')
     ## parameter to use if running the CUMC cluster (not aws)
     sub.add_argument('--hpc', action='store_true', help = 'run on the CUMC hpc cluster (add additional qsub flags)')
 
@@ -34,45 +37,41 @@ def add_common_args(sub):
 
 # -------------------------------------
 
-def get_arg():
-    """Get Arguments"""
-
-    prog_description = 'microbial detection from paired-end RNAseq'
-    parser = argparse.ArgumentParser(description=prog_description)
-
-    # implement subcommands (Think git: git add, git commit, git push, etc)
-    subparsers = parser.add_subparsers(help='sub-command help')
-
-    # create the parser for the 'scan' command
-    parser_scan = subparsers.add_parser('scan', help='run the pathogen discovery pipeline')
-    parser_scan.add_argument('-r1', '--mate1', default=None, help='RNA-seq mate 1 fastq input or single-end read if --single flag')
-    parser_scan.add_argument('-r2', '--mate2', default=None, help='RNA-seq mate 2 fastq input')
-    parser_scan.add_argument('--bam', default=None, help='bam file input (provide this as an alternative to fastq\'s')
+def add_scan_args(sub):
+    """Add the pipeline args shared by the scan and batch subparsers"""
 
     ## Additional parameter to handle single-end input reads
-    parser_scan.add_argument('--single', action='store_true', help = 'boolean denoting single-end read data (turn on flag and use either -r1 or --bam)')
-
-    parser_scan.add_argument('-sr', '--refstar', help='STAR host reference')
-    parser_scan.add_argument('-br', '--refbowtie', help='bowtie2 host reference')
-    parser_scan.add_argument('--taxid2names', default=None, help='location of names.dmp file mapping taxid to names')
-    parser_scan.add_argument('-db', '--blastdb', help='blast (nt) database (contigs are the query set)')
-    parser_scan.add_argument('--map_threads', default='4', help='number of threads for the short read alignment (default: 4)')
-    parser_scan.add_argument('--blast_threads', default='1', help='number of threads for the blast (blast -num_threads) (default: 1)')
-    parser_scan.add_argument('--blastchunk', default='100', help='the number of rows per split file for blast (default: 100)')
-    parser_scan.add_argument('--bmem', default='8', help='memory (in G) for qsub of individual blast array job task (default: 8)')
-    parser_scan.add_argument('--btime', default='4', help='time (in hours) for qsub of individual blast array job task (default: 4)')
-    parser_scan.add_argument('-pdb', '--pblastdb', help='blast protein (nr) database (ORFs are the query set)')
-    parser_scan.add_argument('-gtf', '--gtf', help='optional host gft for computing gene coverage after host separation')
+    sub.add_argument('--single', action='store_true', help = 'boolean denoting single-end read data (turn on flag and use either -r1 or --bam)')
+
+    sub.add_argument('-sr', '--refstar', help='STAR host reference')
+    sub.add_argument('-br', '--refbowtie', help='bowtie2 host reference')
+    sub.add_argument('--taxid2names', default=None, help='location of names.dmp file mapping taxid to names')
+    sub.add_argument('-db', '--blastdb', help='blast (nt) database (contigs are the query set)')
+    sub.add_argument('--map_threads', default='4', help='number of threads for the short read alignment (default: 4)')
+    sub.add_argument('--map_shards', type=int, default=1, help='in Step 1, split the reads into this many shards and map each as a task of an array job, with --map_threads threads apiece (fastq input only) (default: 1)')
+    sub.add_argument('--bwtstream', action='store_true', help='in Step 1, stream bowtie2\'s output straight into gzipped fastq of the unmapped reads, rather than writing it to a sam file and reading it back (default: off)')
+    sub.add_argument('--starnative', action='store_true', help='in Step 1, have STAR write the unmapped reads as fastq and count genes itself (with --gtf), taking the mapping counts from its Log.final.out, rather than writing a bam of all reads (default: off)')
+    sub.add_argument('--starshm', action='store_true', help='in Step 1, load the STAR genome into shared memory once per node, for the host separation of every sample on the node to share, and remove it when the last one finishes (a genome made with its gtf can\'t take --gtf on the fly) (default: off)')
+    sub.add_argument('--blast_threads', default='1', help='number of threads for the blast (blast -num_threads) (default: 1)')
+    sub.add_argument('--blastchunk', default='100', help='the number of rows per split file for blast (default: 100)')
+    sub.add_argument('--collapse_isoforms', action='store_true', help='in Step 3, blast only the longest isoform of each Trinity gene, and give its hits to the other isoforms in the reports (default: off)')
+    sub.add_argument('--cluster_contigs', action='store_true', help='in Step 3, cluster the contigs by k-mer containment (after --collapse_isoforms), blast only the representative of each cluster, and give its hits to the other members in the reports (default: off)')
+    sub.add_argument('--cluster_identity', default='0.95', help='with --cluster_contigs, the least identity of a contig to its representative, over the part it covers (default: 0.95)')
+    sub.add_argument('--cluster_coverage', default='0.9', help='with --cluster_contigs, the least fraction of a contig its representative must cover (default: 0.9)')
+    sub.add_argument('--bmem', default='8', help='memory (in G) for qsub of individual blast array job task (default: 8)')
+    sub.add_argument('--btime', default='4', help='time (in hours) for qsub of individual blast array job task (default: 4)')
+    sub.add_argument('-pdb', '--pblastdb', help='blast protein (nr) database (ORFs are the query set)')
+    sub.add_argument('-gtf', '--gtf', help='optional host gft for computing gene coverage after host separation')
 
     ## Modfied contigthreshold to 99 from 500, i.e. default is to try to map all the human un-mapped reads to microbial species
-    parser_scan.add_argument('--contigthreshold', default='99', help='threshold on contig length for blast (default: 99)')
-
-    parser_scan.add_argument('--orfthreshold', default='200', help='threshold on ORF length for protein blast (default: 200)')
-    parser_scan.add_argument('--orfblast', action='store_true', help='blast the ORFs to protein (nr) database (default: off)')
-    parser_scan.add_argument('--blacklist', help='A text file containing a list of non-pathogen taxids to ignore')
-    parser_scan.add_argument('--gzip', action='store_true', help='input fastq files are gzipped (default: off)')
-    parser_scan.add_argument('--noerror', action='store_true', help='do not check for errors (default: off)')
-    parser_scan.add_argument('--steps', default='12345', help='steps to run. The steps are as follows: \
+    sub.add_argument('--contigthreshold', default='99', help='threshold on contig length for blast (default: 99)')
+
+    sub.add_argument('--orfthreshold', default='200', help='threshold on ORF length for protein blast (default: 200)')
+    sub.add_argument('--orfblast', action='store_true', help='blast the ORFs to protein (nr) database (default: off)')
+    sub.add_argument('--blacklist', help='A text file containing a list of non-pathogen taxids to ignore')
+    sub.add_argument('--gzip', action='store_true', help='input fastq files are gzipped (default: off)')
+    sub.add_argument('--noerror', action='store_true', help='do not check for errors (default: off)')
+    sub.add_argument('--steps', default='12345', help='steps to run. The steps are as follows: \
       step 1: host separation, \
       step 2: assembly, \
       step 3: blast contigs, \
@@ -82,11 +81,50 @@ def get_arg():
 
     # Trinity default contig length is 200
     # Ioan: for detection of species, impose no bound on the contig length in assembly
-    parser_scan.add_argument('--trinitycontigthreshold', default='99', help='threshold on contig length for Trinity (default: 99) (raise to 200 to speed up)')
-    parser_scan.add_argument('--trinitymem', default='50', help='max memory for Trinity in gigabytes (default: 50)')
-    parser_scan.add_argument('--trinitycores', default='8', help='number of cores for Trinity (default: 8)')
+    sub.add_argument('--trinitycontigthreshold', default='99', help='threshold on contig length for Trinity (default: 99) (raise to 200 to speed up)')
+    sub.add_argument('--trinitymem', default='50', help='max memory for Trinity in gigabytes (default: 50)')
+    sub.add_argument('--trinitycores', default='8', help='number of cores for Trinity (default: 8)')
+    sub.add_argument('--trinityretries', type=int, default=0, help='if Trinity fails or is killed (see --timeouts), rerun it up to this many times, each time with half the cores (default: 0)')
+    sub.add_argument('--remap', default='bowtie2', choices=['bowtie2', 'kmer'], help='how Step 2 maps the reads back onto the contigs: bowtie2 (align them) or kmer (pseudo-align them by shared k-mers: much faster, approximate coverage, and reads2contigs.bam holds only the reads on no contig) (default: bowtie2)')
+    sub.add_argument('--coverage', default='numpy', choices=['numpy', 'mpileup'], help='how Step 2 works out the coverage of the contigs: numpy (depth arrays straight from the bam, contigs in parallel) or mpileup (samtools mpileup, formatted in python) (default: numpy)')
+    sub.add_argument('--kmer', type=int, default=31, help='with --remap kmer, the length of the k-mers, at most 32 (default: 31)')
+    sub.add_argument('--maxcores', default=None, help='with --noSGE, the number of cores independent steps may share (default: all the cores on the machine)')
+    sub.add_argument('--maxmem', default=None, help='with --noSGE, the memory (in G) independent steps may share (default: all the memory on the machine)')
+    sub.add_argument('--force', action='store_true', help='rerun every step in --steps, even those whose checkpoint shows they already finished with the same inputs and parameters (default: off)')
+    sub.add_argument('--timeouts', help='time limits in hours, for steps (by number) or tools (by program name), e.g. 2=60,Trinity=48,STAR=6,blastn=4. Whatever overruns is killed, freeing its slot (default: none)')
+    sub.add_argument('--idletimeouts', help='kill a tool if its logs stop growing for this many hours, e.g. Trinity=4,STAR=1 (default: none)')
+    sub.add_argument('--scratch', help='run each step in a temporary directory under this one, on node-local disk (e.g., \'$TMPDIR\' or /dev/shm, quoted so it\'s expanded on the node), and move what the step leaves back when it finishes (default: run in the working directory)')
+    sub.add_argument('--failfast', action='store_true', help='end a step at its first failing command, and cancel the jobs of the sample\'s steps downstream of a failed step (default: off)')
+
+    return sub
+
+# -------------------------------------
+
+def get_arg():
+    """Get Arguments"""
+
+    prog_description = 'microbial detection from paired-end RNAseq'
+    parser = argparse.ArgumentParser(description=prog_description)
+
+    # implement subcommands (Think git: git add, git commit, git push, etc)
+    subparsers = parser.add_subparsers(help='sub-command help')
+
+    # create the parser for the 'scan' command
+    parser_scan = subparsers.add_parser('scan', help='run the pathogen discovery pipeline')
+    parser_scan.add_argument('-r1', '--mate1', default=None, help='RNA-seq mate 1 fastq input or single-end read if --single flag (several lanes: a comma-separated list)')
+    parser_scan.add_argument('-r2', '--mate2', default=None, help='RNA-seq mate 2 fastq input (several lanes: a comma-separated list, in the same order as --mate1)')
+    parser_scan.add_argument('--bam', default=None, help='bam file input (provide this as an alternative to fastq\'s) (several lanes: a comma-separated list)')
+
+    add_scan_args(parser_scan)
     parser_scan.set_defaults(which='scan')
 
+    # create the parser for the 'batch' command
+    parser_batch = subparsers.add_parser('batch', help='run the pathogen discovery pipeline on every sample in a manifest')
+    parser_batch.add_argument('--samples', required=True, help='tab-separated sample manifest: one sample per line, with columns sample ID, mate 1 fastq, mate 2 fastq (or sample ID, mate 1 fastq with --single, or sample ID, bam file), each file column taking a comma-separated list of lanes; lines starting with # are ignored')
+    parser_batch.add_argument('--batchdir', default='.', help='directory in which to make one output directory per sample (default: .)')
+    add_scan_args(parser_batch)
+    parser_batch.set_defaults(which='batch', mate1=None, mate2=None, bam=None)
+
     # create the parser for the 'aggregate' command
     parser_agg = subparsers.add_parser('aggregate', help='create report aggregated over multiple sample runs')
     parser_agg.add_argument('--samples', default=None, help='path of the file containing the samples names (one sample per line)')
@@ -102,11 +140,17 @@ def get_arg():
     parser_agg.set_defaults(which='aggregate')
 
     # add common arguments
-    for i in [parser_scan, parser_agg]:
+    for i in [parser_scan, parser_batch, parser_agg]:
         add_common_args(i)
 
     args = parser.parse_args()
 
+    # --noSGE is the local scheduler
+    if args.noSGE:
+        args.scheduler = 'local'
+    elif args.scheduler == 'local':
+        args.noSGE = True
+
     # path of this script
     if args.hpc:
         mycwd = os.path.dirname(os.path.realpath(__file__))
@@ -115,7 +159,9 @@ def get_arg():
         mycwd = '/opt/software/Pandora'
         sys.path.append(mycwd)
     global hp
+    global executors
     from helpers import helpers as hp
+    from helpers import executors
 
     # add key-value pairs to the args dict
     # directory where this script resides             
@@ -176,9 +222,9 @@ def check_arg_scan(args):
     for name in 'gzip verbose noclean noSGE orfblast hpc'.split():
         setattr(args, name, int(getattr(args, name, 0)))
 
-    # set bam file to abs path
+    # set bam file(s) to abs path
     if args.bam: 
-        setattr(args, 'bam', os.path.abspath(os.path.expanduser(args.bam)))
+        setattr(args, 'bam', ','.join(os.path.abspath(os.path.expanduser(i)) for i in args.bam.split(',')))
 
 # -------------------------------------
 
@@ -207,27 +253,35 @@ def check_error(args):
     # check for required programs
     #hp.check_dependencies(['samtools', 'bam', 'bowtie2', 'STAR', 'blastn', 'Trinity'])
 
+    # the inputs may be comma-separated lists of lanes
+    (mate1, mate2, bam) = [i.split(',') if i else [] for i in [args.mate1, args.mate2, args.bam]]
+
     # check for existence of files, if supplied
-    for i in [args.mate1, args.mate2, args.bam, args.blacklist]:
+    for i in mate1 + mate2 + bam + [args.blacklist]:
         if i:
             hp.check_path(i)
 
+    # the lanes of the mates pair up in order
+    if mate1 and mate2 and len(mate1) != len(mate2):
+        print('[ERROR] --mate1 and --mate2 must have the same number of lanes')
+        sys.exit(1)
+
     # check if input files gzipped
-    if args.mate1 and args.mate2:
-        if args.gzip and not (args.mate1[-3:] == '.gz' and args.mate2[-3:] == '.gz'):
+    if mate1 and mate2:
+        if args.gzip and not all(i[-3:] == '.gz' for i in mate1 + mate2):
             print('[ERROR] For --gzip option, files must have .gz extension')
             sys.exit(1)
-        elif (args.mate1[-3:] == '.gz' or args.mate2[-3:] == '.gz') and not args.gzip:
+        elif any(i[-3:] == '.gz' for i in mate1 + mate2) and not args.gzip:
             print('[ERROR] Files have .gz extension: use --gzip option')
             sys.exit(1)
-    elif args.mate1 and args.single:
-        if (args.gzip and not (args.mate1[-3:] == '.gz')) or  ((args.mate1[-3:] == '.gz') and not args.gzip):
+    elif mate1 and args.single:
+        if (args.gzip and not all(i[-3:] == '.gz' for i in mate1)) or (any(i[-3:] == '.gz' for i in mate1) and not args.gzip):
             print('[ERROR] Zip flag and file type do not match')
             sys.exit(1)
 
     # check if proper extention
-    if args.bam:
-        if not (args.bam[-4:] == '.bam'):
+    if bam:
+        if not all(i[-4:] == '.bam' for i in bam):
             print('[ERROR] For --bam option, files must have .bam extension')
             sys.exit(1)        
 
@@ -239,6 +293,7 @@ def main():
     # dict which maps each subcommand name to its corresponding function (reference)
     d = {
              'scan': scan_main,
+             'batch': batch_main,
              'aggregate': agg_main
     }
 
@@ -260,37 +315,33 @@ def main():
 
 # -------------------------------------
 
-def docmd(myqcmd, mycmd, jid, args):
-    """Run a command on the shell or with SGE qsub"""
+def docmd(myqcmd, mycmd, jid, args, job=None):
+    """Run a command on the shell or submit it with the scheduler"""
 
     # myqcmd - qsub portion (or prefix) of the command
     # mycmd - ordinary shell command
-    # jid - job id
+    # jid - job id, or comma-delimited job ids, to hold on ('0' for none)
     # args - args dict
+    # job - (optional) dict of the job's name and resources, for schedulers other than SGE
 
     # if run in the shell without qsub
     if args.noSGE:
-        print(hp.run_log_cmd(mycmd, args.verbose, 'log.o.steps', 'log.e.steps'))
+        hp.run_log_cmd(mycmd, args.verbose, 'log.o.steps', 'log.e.steps')
         return '0'
-    # if run command with SGE qsub
+    # if run command with the scheduler
     else:
-        # define qsub part of command
-        # "sys.executable contains full path of the currently running Python interpreter"
-        cmd = 'qsub -S ' + sys.executable + ' ' + myqcmd + ' '
-        # if not the first command, hold on previous job id
-        if jid != '0':
-            cmd += '-hold_jid ' + jid + ' '
-        # define shell (non-qsub) part of command
-        cmd += mycmd
-        # if verbose, print command
-        if args.verbose:
-            print(cmd)
+        ex = executors.get_executor(args.scheduler, args.verbose)
+        # SGE takes the qsub prefix as is
+        if args.scheduler == 'sge' or not job:
+            job = {'extra': myqcmd} if args.scheduler == 'sge' else {}
+        # if not the first command, hold on previous job id(s)
+        hold = jid.split(',') if jid != '0' else None
         # run command, get job id
-	return hp.getjid(subprocess.check_output(cmd, shell=True))
+        return ex.submit(mycmd, job, hold)
 
 # -------------------------------------
 
-def run_steps(q, clusterparams, d, args):
+def run_steps(q, clusterparams, d, args, io=None, res=None):
     """
     Run the steps in the pipeline
 
@@ -298,22 +349,53 @@ def run_steps(q, clusterparams, d, args):
     clusterparams: dict which maps each step to extra qsub params for the CUMC cluster
     d: dict which maps each step to the shell part of the command
     args: arguments
+    io: (optional) dict which maps each step to a tuple (list of input files, list of output files)
+    res: (optional) dict which maps each step to a tuple (number of cores, memory in G, time in hours)
     """
 
+    # if we know what each step reads and writes, skip finished steps and checkpoint the rest
+    if io:
+        d = checkpoint_steps(d, args, io)
+        from helpers import checkpoint as ckpt
+
+    # without qsub, run independent steps side by side if we know how the steps depend on each other
+    if args.noSGE and io and res:
+        run_steps_local(d, args, io, res)
+        return
+
     # start with job id set to zero string
     jid = '0'
+    # map each step to its job id
+    jids = {}
+    # if we know how steps depend on each other, hold each step on just the steps it needs
+    if io:
+        from helpers import scheduler
+        deps = scheduler.step_graph(args.steps, io)
 
     # run steps
     for i in args.steps:
+        if io:
+            jid = ','.join(jids[j] for j in sorted(deps[i]) if jids.get(j, '0') != '0') or '0'
+
+        # name and resources of the job, for schedulers that don't take qsub flags
+        job = None
+        if res:
+            job = {'name': 'pandora' + i + '_' + args.identifier, 'cores': res[i][0], 'mem': res[i][1], 'hours': res[i][2], 'out': 'log.out', 'err': 'log.err'}
+
         # if qsub params specified in config file
         if i in args.qparam:
-            jid = docmd(args.qparam[i], d[i], jid, args)
+            jid = docmd(args.qparam[i], d[i], jid, args, job)
         # if not, use default from dict q
         else:
             qprefix = q[i]
             if args.hpc:
                 qprefix += clusterparams[i]
-            jid = docmd(qprefix, d[i], jid, args)
+            jid = docmd(qprefix, d[i], jid, args, job)
+        jids[i] = jid
+
+        # record the jobs as they go in, so a failing step can cancel those downstream of it
+        if io and not args.noSGE:
+            ckpt.write_jobs(args.scheduler, jids, deps)
 
         # only print step name if qsub-ing
         if not args.noSGE:
@@ -321,6 +403,122 @@ def run_steps(q, clusterparams, d, args):
 
 # -------------------------------------
 
+def checkpoint_steps(d, args, io):
+    """
+    Drop steps whose checkpoint manifest still matches from args.steps,
+    and wrap the remaining steps so they write a manifest when they finish
+
+    d: dict which maps each step to the shell part of the command
+    args: arguments (args.steps is modified)
+    io: dict which maps each step to a tuple (list of input files, list of output files)
+
+    Returns a new dict which maps each step to its wrapped command
+    """
+
+    from helpers import checkpoint as ckpt
+    from helpers import scheduler
+
+    deps = scheduler.step_graph(args.steps, io)
+
+    # a step is done if its manifest matches and nothing upstream of it is about to rerun
+    torun = ''
+    for i in args.steps:
+        if not args.force and not (deps[i] & set(torun)) and ckpt.manifest_matches(i, io[i][0], io[i][1], d[i]):
+            print('Step ' + i + ' already finished with the same inputs and parameters (checkpoint ' + ckpt.manifest_path(i) + '), skipping')
+        else:
+            torun += i
+    args.steps = torun
+
+    # jobs from a previous run are not ours to cancel
+    if os.path.isfile(ckpt.jobsfile):
+        os.remove(ckpt.jobsfile)
+
+    # time limits: a step's own goes to its wrapper, the tools' go through to the step's scripts
+    limits = ''
+    if args.timeouts:
+        limits += ' --timeouts ' + args.timeouts
+    if args.idletimeouts:
+        limits += ' --idletimeouts ' + args.idletimeouts
+    steplimits = hp.parse_limits(args.timeouts or '')
+
+    wrapped = {}
+    for i in d:
+        # the tasks of an array job on other nodes couldn't see this node's scratch
+        scratch = ''
+        if args.scratch and (args.scheduler == 'local' or i not in array_steps(args)):
+            # single quotes, so variables (e.g., $TMPDIR) are expanded on the node which runs the step
+            scratch = " --scratch '" + args.scratch + "'"
+        wrapped[i] = '{scripts}/scripts/run_step.py --scripts {scripts} --step {step} --verbose {verbose} --failfast {failfast} --timeout {timeout}{limits}{scratch} --inputs {inputs} --outputs {outputs} -- {cmd}'.format(
+            scripts=args.scripts,
+            step=i,
+            verbose=args.verbose,
+            failfast=int(args.failfast),
+            timeout=steplimits.get(i, 0) / 3600,
+            limits=limits,
+            scratch=scratch,
+            inputs=' '.join(ckpt.split_files(io[i][0])),
+            outputs=' '.join(ckpt.split_files(io[i][1])),
+            cmd=d[i])
+
+    return wrapped
+
+# -------------------------------------
+
+def run_steps_local(d, args, io, res):
+    """
+    Run the steps in the pipeline on this machine, concurrently where their inputs allow
+
+    d: dict which maps each step to the shell part of the command
+    args: arguments
+    io: dict which maps each step to a tuple (list of input files, list of output files)
+    res: dict which maps each step to a tuple (number of cores, memory in G, time in hours)
+    """
+
+    from helpers import scheduler
+
+    # which steps wait on which
+    deps = scheduler.step_graph(args.steps, io)
+    (cores, mem) = scheduler.local_resources(args.maxcores, args.maxmem)
+    if '1' in args.steps:
+        mem -= starshm_mem(args)
+
+    if args.verbose:
+        print('[local executor] cores = {}, mem = {:.1f}G'.format(cores, mem))
+        for i in args.steps:
+            print('Step ' + i + ' waits on: ' + (', '.join(sorted(deps[i])) or 'nothing'))
+
+    tasks = {}
+    for k, i in enumerate(args.steps):
+        tasks[i] = {'cmd': d[i], 'cores': res[i][0], 'mem': res[i][1], 'hours': res[i][2], 'priority': k}
+
+    status = scheduler.run_dag(tasks, deps, cores, mem, args.verbose, 'log.o.steps', 'log.e.steps')
+
+    from helpers import checkpoint as ckpt
+
+    for i in args.steps:
+        print('Step ' + i + ', exit code = ' + str(status.get(i)))
+        # steps which never started don't record their own status
+        if status.get(i) is None:
+            ckpt.update_status(i, 'skipped')
+
+# -------------------------------------
+
+def absolute_paths(args):
+    """Make the input and reference paths in args absolute, for steps which run somewhere other than here"""
+
+    for name in 'mate1 mate2 bam'.split():
+        myval = getattr(args, name)
+        if myval and myval != 'None':
+            setattr(args, name, ','.join(os.path.abspath(os.path.expanduser(i)) for i in myval.split(',')))
+
+    for name in 'refstar refbowtie gtf blastdb pblastdb blacklist taxid2names'.split():
+        # only things that exist (as a file, directory or database prefix) relative to here
+        myval = getattr(args, name)
+        if myval and myval != 'None' and glob.glob(os.path.expanduser(myval) + '*'):
+            setattr(args, name, os.path.abspath(os.path.expanduser(myval)))
+
+# -------------------------------------
+
 def scan_main(args):
     """Run pathogen discovery steps"""
 
@@ -328,6 +526,44 @@ def scan_main(args):
     if not args.noerror:
         check_error(args)
 
+    # steps run in scratch see the working directory, but not what's relative to it
+    if args.scratch:
+        absolute_paths(args)
+
+    (q, clusterparams, d, io, res) = scan_steps(args)
+
+    run_steps(q, clusterparams, d, args, io, res)
+
+# -------------------------------------
+
+def array_steps(args):
+    """Return the steps which submit array jobs of their own (blast; host separation, if sharded)"""
+    return ('1' if args.map_shards > 1 else '') + '34'
+
+def starshm_mem(args):
+    """Return the memory (in G) of the STAR genome Step 1 keeps in shared memory (--starshm) on this machine, or 0"""
+
+    # sharded, the mapping happens in the array job's tasks
+    if not args.starshm or args.bam or args.map_shards > 1:
+        return 0
+
+    from helpers import star_shm
+    return -(-star_shm.genome_size(args.refstar) // 2**30)
+
+# -------------------------------------
+
+def scan_steps(args):
+    """
+    Define the pathogen discovery steps
+
+    Returns a tuple of dicts (q, clusterparams, d, io, res), each keyed on step:
+    q: the qsub part of the command
+    clusterparams: extra qsub params for the CUMC cluster
+    d: the shell part of the command
+    io: a tuple (list of input files, list of output files)
+    res: a tuple (number of cores, memory in G, time in hours)
+    """
+
     # dict which maps each step to the qsub part of the command
     q = {
              '1': '-S {mypython} -N hsep_{args.identifier} -V -cwd -o log.out -e log.err'.format(mypython=sys.executable, args=args),
@@ -336,7 +572,7 @@ def scan_main(args):
              '4': '-S {mypython} -N orf_{args.identifier} -V -cwd -o log.out -e log.err'.format(mypython=sys.executable, args=args),
              '5': '-S {mypython} -N rep_{args.identifier} -V -cwd -o log.out -e log.err'.format(mypython=sys.executable, args=args),
              '6': '-S {mypython} -N rep2_{args.identifier} -V -cwd -o log.out -e log.err'.format(mypython=sys.executable, args=args),
-             '7': '-S /bin/bash -N blst_unass_{args.identifier} -V -cwd -o log.out -e log.err'.format(args=args)
+             '7': '-S {mypython} -N blst_unass_{args.identifier} -V -cwd -o log.out -e log.err'.format(mypython=sys.executable, args=args)
     }
 
     # dict which maps each step to extra qsub params for the CUMC cluster
@@ -359,16 +595,184 @@ def scan_main(args):
 
     # dict which maps each step to the shell part of the command
     d = {
-             '1': '{args.scripts}/scripts/host_separation.py --scripts {args.scripts} -1 {args.mate1} -2 {args.mate2} --bam {args.bam} --threads {args.map_threads} --single {args.single} --refstar {args.refstar} --refbowtie {args.refbowtie} --gzip {args.gzip} --verbose {args.verbose} --noclean {args.noclean} --gtf {args.gtf}'.format(args=args),
-             '2': '{args.scripts}/scripts/assembly.py --scripts {args.scripts} --single {args.single} --trinitymem {args.trinitymem} --trinitycores {args.trinitycores} --trinitythreshold {args.trinitycontigthreshold} --verbose {args.verbose} --noclean {args.noclean}'.format(args=args),
-             '3': '{args.scripts}/scripts/blast_wrapper.py --scripts {args.scripts} --threshold {args.contigthreshold} --db {args.blastdb} --threads {args.blast_threads} --id {args.identifier} --filelength {args.blastchunk} --verbose {args.verbose} --noclean {args.noclean} --nosge {args.noSGE} --hpc {args.hpc} --btime {args.btime} --bmem {args.bmem}'.format(args=args),
-             '4': '{args.scripts}/scripts/orf_discovery.py --scripts {args.scripts} --id {args.identifier} --threshold {args.orfthreshold} --db {args.pblastdb} --blast {args.orfblast} --verbose {args.verbose} --noclean {args.noclean}'.format(args=args),
+             '1': '{args.scripts}/scripts/host_separation.py --scripts {args.scripts} -1 {args.mate1} -2 {args.mate2} --bam {args.bam} --threads {args.map_threads} --single {args.single} --refstar {args.refstar} --refbowtie {args.refbowtie} --gzip {args.gzip} --verbose {args.verbose} --noclean {args.noclean} --gtf {args.gtf} --bwtstream {bwtstream} --starnative {starnative} --starshm {starshm} --shards {args.map_shards} --scheduler {args.scheduler} --id {args.identifier}'.format(args=args, bwtstream=int(args.bwtstream), starnative=int(args.starnative), starshm=int(args.starshm)),
+             '2': '{args.scripts}/scripts/assembly.py --scripts {args.scripts} --single {args.single} --trinitymem {args.trinitymem} --trinitycores {args.trinitycores} --trinitythreshold {args.trinitycontigthreshold} --retries {args.trinityretries} --remap {args.remap} --coverage {args.coverage} --kmer {args.kmer} --verbose {args.verbose} --noclean {args.noclean}'.format(args=args),
+             '3': '{args.scripts}/scripts/blast_wrapper.py --scripts {args.scripts} --threshold {args.contigthreshold} --db {args.blastdb} --threads {args.blast_threads} --id {args.identifier} --filelength {args.blastchunk} --verbose {args.verbose} --noclean {args.noclean} --nosge {args.noSGE} --scheduler {args.scheduler} --hpc {args.hpc} --btime {args.btime} --bmem {args.bmem} --collapse_isoforms {collapse} --cluster {cluster} --cluster_identity {args.cluster_identity} --cluster_coverage {args.cluster_coverage}'.format(args=args, collapse=int(args.collapse_isoforms), cluster=int(args.cluster_contigs)),
+             '4': '{args.scripts}/scripts/orf_discovery.py --scripts {args.scripts} --id {args.identifier} --threshold {args.orfthreshold} --db {args.pblastdb} --blast {args.orfblast} --verbose {args.verbose} --noclean {args.noclean} --nosge {args.noSGE} --scheduler {args.scheduler}'.format(args=args),
              '5': '{args.scripts}/scripts/makereport.py --scripts {args.scripts} --id {args.identifier} --verbose {args.verbose} --blacklist {args.blacklist} --taxid2names {args.taxid2names} --hpc {args.hpc}'.format(args=args),
              '6': '{args.scripts}/scripts/makereport.py --outputdir report_ifilter --input blast/ifilter.concat.txt --scripts {args.scripts} --id {args.identifier} --verbose {args.verbose} --blacklist {args.blacklist} --taxid2names {args.taxid2names} --hpc {args.hpc}'.format(args=args),
              '7': '{args.scripts}/scripts/blast_unassembled_reads.sh assembly/reads2contigs.bam blast_unassembled_reads {args.scripts} {args.blastdb} {args.blacklist} {args.taxid2names} {args.scripts}/resources/blast.header'.format(args=args)
     }
 
-    run_steps(q, clusterparams, d, args)
+    # the reads left after host separation
+    unmapped = ['host_separation/unmapped_1.fastq.gz'] + ([] if args.single else ['host_separation/unmapped_2.fastq.gz'])
+
+    # dict which maps each step to the files it reads and the files it writes
+    # (steps are chained on these when run without qsub, so independent steps can overlap)
+    io = {
+             '1': ([args.mate1, args.mate2, args.bam],
+                   unmapped + ['host_separation/mapping_stats.STAR.txt'] + ([] if args.bam else ['host_separation/mapping_stats.bwt.txt'])),
+             '2': (unmapped,
+                   ['assembly/contigs_trinity.fasta', 'assembly/contigs_trinity.ids.txt', 'assembly/reads2contigs.bam', 'assembly/reads2contigs.stats.txt']),
+             '3': (['assembly/contigs_trinity.fasta'] + (['assembly/contigs_trinity.ids.txt'] if args.collapse_isoforms else []),
+                   ['blast/header', 'blast/top.concat.txt', 'blast/ifilter.concat.txt', 'blast/no_blastn.fa']),
+             '4': (['blast/no_blastn.fa'],
+                   ['discovery/orf.fa'] + (['discovery/blast/top.concat.txt'] if args.orfblast else [])),
+             '5': (['blast/header', 'blast/top.concat.txt', 'discovery/blast/top.concat.txt', 'assembly/reads2contigs.stats.txt', 'host_separation/mapping_stats.STAR.txt', 'host_separation/mapping_stats.bwt.txt'],
+                   ['report/report.contig.txt', 'report/report.taxon.txt']),
+             '6': (['blast/header', 'blast/ifilter.concat.txt', 'discovery/blast/top.concat.txt', 'assembly/reads2contigs.stats.txt', 'host_separation/mapping_stats.STAR.txt', 'host_separation/mapping_stats.bwt.txt'],
+                   ['report_ifilter/report.contig.txt', 'report_ifilter/report.taxon.txt']),
+             '7': (['assembly/reads2contigs.bam'],
+                   ['blast_unassembled_reads/top.concat.txt'])
+    }
+
+    # dict which maps each step to the (cores, memory in G, time in hours) it needs
+    # when run without qsub, or with a scheduler other than SGE
+    res = {
+             '1': (int(args.map_threads), int(memmap), 12),
+             '2': (int(args.trinitycores), int(args.trinitymem), 12),
+             '3': (int(args.blast_threads), int(args.bmem), 8),
+             '4': (1, 2, 2),
+             '5': (1, 4, 1),
+             '6': (1, 4, 1),
+             '7': (1, 1, 12)
+    }
+
+    # sharded, Step 1 itself only splits the reads, waits on its array job and merges: the tasks do the mapping.
+    # That holds under a scheduler, which finds the tasks room of their own. Without one the tasks run inside Step 1's
+    # grant (see executors.LocalExecutor), so it keeps the whole map_threads/memmap budget, and they map one at a time
+    if args.map_shards > 1 and not args.bam and not args.noSGE:
+        clusterparams['1'] = ' -l mem=4G,time=24::'
+        res['1'] = (1, 4, 24)
+
+    # without qsub, the genome in shared memory is charged to the pool once (see run_steps_local), not to each sample.
+    # Under a scheduler any job might be the first on its node, and the genome counts against the memory of every
+    # job attached to it, so the requests stay whole: what's saved there is the time to load it
+    if args.noSGE and starshm_mem(args):
+        res['1'] = (res['1'][0], max(res['1'][1] - starshm_mem(args), 4), res['1'][2])
+
+    return (q, clusterparams, d, io, res)
+
+# -------------------------------------
+
+def read_samples(samplefile):
+    """
+    Parse a sample manifest and return a list of tuples (sample ID, mate1, mate2, bam)
+
+    Each line is tab-separated: sample ID followed by either two fastq files,
+    one fastq file (single-end), or one bam file, each of which may be a comma-separated
+    list of lanes. Lines starting with # are ignored.
+    """
+
+    samples = []
+
+    with open(samplefile, 'r') as f:
+        for line in f:
+            if not line.strip() or line[0] == '#':
+                continue
+            fields = [i.strip() for i in line.rstrip('\n').split('\t') if i.strip()]
+            if len(fields) == 2 and fields[1][-4:] == '.bam':
+                samples.append((fields[0], None, None, fields[1]))
+            elif len(fields) == 2:
+                samples.append((fields[0], fields[1], None, None))
+            elif len(fields) == 3:
+                samples.append((fields[0], fields[1], fields[2], None))
+            else:
+                print('[ERROR] Can\'t parse sample manifest line: ' + line.rstrip())
+                sys.exit(1)
+
+    ids = [i[0] for i in samples]
+    if len(set(ids)) != len(ids):
+        print('[ERROR] Sample IDs in ' + samplefile + ' must be unique')
+        sys.exit(1)
+
+    return samples
+
+# -------------------------------------
+
+def batch_main(args):
+    """
+    Run pathogen discovery steps for every sample in a manifest,
+    each sample in its own directory under --batchdir
+
+    With qsub, each sample gets its own chain of held jobs.
+    Without, the steps of all samples share one pool of cores and memory,
+    so cheap steps (e.g., reporting) run in the gaps around expensive ones (e.g., mapping, assembly).
+    """
+
+    from helpers import scheduler
+
+    samples = read_samples(args.samples)
+    batchdir = os.path.abspath(os.path.expanduser(args.batchdir))
+    hp.mkdirp(batchdir)
+    mycwd = os.getcwd()
+
+    # tasks and dependencies across all samples, keyed on sample:step (for the local scheduler)
+    tasks = {}
+    deps = {}
+    # memory (in G) of the STAR genome the samples share (see starshm_mem)
+    shared = 0
+
+    for k, (sampleid, mate1, mate2, bam) in enumerate(samples):
+        # args for this sample: paths become absolute because the steps run in the sample's directory
+        sargs = copy.copy(args)
+        sargs.qparam = dict(args.qparam)
+        sargs.identifier = sampleid
+        sargs.mate1 = mate1
+        sargs.mate2 = mate2
+        sargs.bam = bam
+        check_arg_scan(sargs)
+        absolute_paths(sargs)
+        if not sargs.noerror:
+            check_error(sargs)
+
+        sampledir = os.path.join(batchdir, sampleid)
+        hp.mkdirp(sampledir)
+
+        print('Sample ' + sampleid + ' (' + sampledir + ')')
+
+        # checkpoints and qsub both work relative to the sample directory
+        os.chdir(sampledir)
+        try:
+            (q, clusterparams, d, io, res) = scan_steps(sargs)
+            if not sargs.noSGE:
+                run_steps(q, clusterparams, d, sargs, io, res)
+                continue
+            d = checkpoint_steps(d, sargs, io)
+            sampledeps = scheduler.step_graph(sargs.steps, io)
+        finally:
+            os.chdir(mycwd)
+
+        for i in sargs.steps:
+            # largest requests first, so cheap steps fill in around them
+            tasks[sampleid + ':' + i] = {
+                'cmd': d[i],
+                'cores': res[i][0],
+                'mem': res[i][1],
+                'hours': res[i][2],
+                'cwd': sampledir,
+                'priority': (-res[i][0] * res[i][1], k, i)
+            }
+            deps[sampleid + ':' + i] = set(sampleid + ':' + j for j in sampledeps[i])
+        if '1' in sargs.steps:
+            shared = max(shared, starshm_mem(sargs))
+
+    if args.noSGE:
+        (cores, mem) = scheduler.local_resources(args.maxcores, args.maxmem)
+        mem -= shared
+        if args.verbose:
+            print('[local executor] cores = {}, mem = {:.1f}G'.format(cores, mem))
+        status = scheduler.run_dag(tasks, deps, cores, mem, args.verbose, 'log.o.steps', 'log.e.steps')
+        from helpers import checkpoint as ckpt
+        for i in sorted(status):
+            print(i + ', exit code = ' + str(status[i]))
+            # steps which never started don't record their own status
+            if status[i] is None:
+                os.chdir(tasks[i]['cwd'])
+                try:
+                    ckpt.update_status(i.rsplit(':', 1)[1], 'skipped')
+                finally:
+                    os.chdir(mycwd)
 
 # -------------------------------------
 
@@ -2,6 +2,7 @@
 
 import argparse
 import sys
+import shutil
 
 # This script performs assembly on the reads leftover after host removal
 
@@ -24,6 +25,10 @@ def get_arg():
     parser.add_argument('--trinitymem', required=True, help='max memory for Trinity')
     parser.add_argument('--trinitycores', required=True, help='number of cores for Trinity')
     parser.add_argument('--trinitythreshold', required=True, help='number of cores for Trinity')
+    parser.add_argument('--retries', type=int, default=0, help='if Trinity fails or is killed, rerun it up to this many times, each time with half the cores (default: 0)')
+    parser.add_argument('--remap', default='bowtie2', choices=['bowtie2', 'kmer'], help='how to map the reads back onto the contigs: bowtie2 (align them) or kmer (pseudo-align them by shared k-mers: much faster, approximate coverage, and the bam holds only the reads on no contig) (default: bowtie2)')
+    parser.add_argument('--kmer', type=int, default=31, help='with --remap kmer, the length of the k-mers, at most 32 (default: 31)')
+    parser.add_argument('--coverage', default='numpy', choices=['numpy', 'mpileup'], help='how to work out the coverage of the contigs: numpy (depth arrays straight from the bam, contigs in parallel) or mpileup (samtools mpileup, formatted in python, as before) (default: numpy)')
     parser.add_argument('-l', '--logsdir', help='the logs directory')
     parser.add_argument('-d', '--scripts', help='the git repository directory')
     parser.add_argument('--noclean', help='do not delete temporary intermediate files (default: off)')
@@ -37,8 +42,12 @@ def get_arg():
     sys.path.append(args.scripts)
     global hp
     global ahp
+    global inter
+    global pa
     from helpers import helpers as hp
     from helpers import assembly_helpers as ahp
+    from helpers import intermediates as inter
+    from helpers import pseudoalign as pa
 
     # error checking: exit if previous step produced zero output
 
@@ -52,6 +61,9 @@ def get_arg():
     if args.single == 'False':
         args.single = False
 
+    if not 1 <= args.kmer <= 32:
+        hp.quitwitherror('--kmer must be between 1 and 32', step=args.step)
+
     return args
 
 # -------------------------------------
@@ -69,12 +81,27 @@ def assembly(args):
     hp.mkdirp(args.outputdir)
 
     # perform Trinity assembly
-    if (args.single):
-        cmd = 'Trinity --seqType fq --normalize_reads --min_contig_length={args.trinitythreshold} --max_memory {args.trinitymem}G --CPU {args.trinitycores} --output {args.outputdir} --single {args.mate1}'.format(args=args)
-    else:
-        cmd = 'Trinity --seqType fq --normalize_reads --min_contig_length={args.trinitythreshold} --max_memory {args.trinitymem}G --CPU {args.trinitycores} --output {args.outputdir} --left {args.mate1} --right {args.mate2}'.format(args=args)
-    # use run_long_cmd for programs with verbose output
-    hp.run_long_cmd(cmd, args.verbose, 'log.Trinity')
+    cores = int(args.trinitycores)
+    failfast = hp.failfast
+    for attempt in range(args.retries + 1):
+        if (args.single):
+            cmd = 'Trinity --seqType fq --normalize_reads --min_contig_length={args.trinitythreshold} --max_memory {args.trinitymem}G --CPU {cores} --output {args.outputdir} --single {args.mate1}'.format(args=args, cores=cores)
+        else:
+            cmd = 'Trinity --seqType fq --normalize_reads --min_contig_length={args.trinitythreshold} --max_memory {args.trinitymem}G --CPU {cores} --output {args.outputdir} --left {args.mate1} --right {args.mate2}'.format(args=args, cores=cores)
+        # in fail-fast mode, only the last attempt's failure ends the step
+        hp.failfast = failfast and attempt == args.retries
+        # use run_long_cmd for programs with verbose output
+        returncode = hp.run_long_cmd(cmd, args.verbose, 'log.Trinity')
+        if returncode == 0 or attempt == args.retries:
+            break
+        # fewer cores is less memory at once in Trinity's parallel phases, which is where it tends to hang or blow up
+        cores = max(1, cores // 2)
+        reason = 'killed by the watchdog' if returncode == hp.watchdog_exit else 'exit code ' + str(returncode)
+        print('[WARNING] Trinity failed (' + reason + '), retrying with --CPU ' + str(cores))
+        # start over, rather than from whatever state it was killed in
+        shutil.rmtree(args.outputdir, ignore_errors=True)
+        hp.mkdirp(args.outputdir)
+    hp.failfast = failfast
 
     print('Trinity complete')
 
@@ -87,18 +114,22 @@ def assembly(args):
     # mkdir -p
     hp.mkdirp('assembly')
 
+    # Trinity's working directory goes as soon as its contigs are read
+    tmp = inter.Intermediates(args.noclean, args.verbose, args.step, 'assembly')
+    tmp.add(args.outputdir, ['fastajoinlines'])
+
     # rename Trinity contigs, join sequence portion of fasta, return number of contigs
     # cat ${outputdir}/Trinity.fasta | awk 'BEGIN{f=0; counter=1}{if ($0~/^>/) {if (f) {printf "\n"; counter++}; print ">contig_"counter; f=1} else printf $0}END{printf "\n"}' > ${output}
     myoutput2 = 'assembly/contigs_trinity.fasta'
-    num_contigs = hp.fastajoinlines(myoutput, myoutput2, 'contig')
+    # (keeping Trinity's IDs, which say which contigs are isoforms of the same gene, in contigs_trinity.ids.txt)
+    num_contigs = hp.fastajoinlines(myoutput, myoutput2, 'contig', 'assembly/contigs_trinity.ids.txt')
+    tmp.done('fastajoinlines')
 
     # compute simple distribution
     # cat assembly/contigs_trinity.fasta | paste - - | awk '{print length($2)}' | sort -nr | ${d}/scripts/tablecount | awk -v tot=${num_contigs} 'BEGIN{x=0}{x+=$2; print $1"\t"$2"\t"x"/"tot"\t"int(100*x/tot)"%"}' > assembly/contigs.distrib.txt
     ahp.computedistrib(myoutput2, 'assembly/contigs.distrib.txt')
 
-    if not int(args.noclean):
-        cmd = 'rm -rf assembly_trinity'
-        hp.run_cmd(cmd, args.verbose, 0)
+    tmp.report()
 
     hp.echostep(args.step, start=0)
 
@@ -110,12 +141,19 @@ def assembly(args):
 def remap(args, contigs):
     """map contigs back onto assembly"""
 
+    if args.remap == 'kmer':
+        pseudoremap(args, contigs)
+        return
+
     hp.echostep('remap')
 
     hp.mkdirp('assembly/ref_remap')
 
     refbowtie="assembly/ref_remap/ref"
 
+    tmp = inter.Intermediates(args.noclean, args.verbose, 'remap', 'assembly')
+    tmp.add('assembly/ref_remap', ['bowtie2'])
+
     cmd = 'bowtie2-build {} {}'.format(contigs, refbowtie)
     hp.run_cmd(cmd, args.verbose, 0)
 
@@ -124,6 +162,7 @@ def remap(args, contigs):
     else:
         cmd = 'bowtie2 -p 4 -x {} -1 {} -2 {} -S {}'.format(refbowtie, args.mate1, args.mate2, 'assembly/reads2contigs.sam')
     hp.run_cmd(cmd, args.verbose, 0)
+    tmp.done('bowtie2')
 
     # convert to bam
     ## samtools version compatibility: need .bam extension
@@ -140,18 +179,44 @@ def remap(args, contigs):
     cmd = 'samtools idxstats assembly/reads2contigs.bam > assembly/reads2contigs.stats.txt'
     hp.run_cmd(cmd, args.verbose, 0)
 
-    # mpileup
-    cmd = 'samtools mpileup -A -B -d 100000 -L 100000 -f assembly/contigs_trinity.fasta assembly/reads2contigs.bam > assembly/reads2contigs.pileup'
-    hp.run_cmd(cmd, args.verbose, 0)
+    if args.coverage == 'numpy':
+        # depth arrays (zeros where nothing covers a contig) straight from the bam, batches of contigs in parallel,
+        # kept in a binary store (reads2contigs.depth.npy, .idx: see helpers/coverage.py) rather than as text
+        print('coverage commenced')
+        try:
+            ahp.coverage('assembly/reads2contigs.bam', 'assembly/reads2contigs.stats.txt', 'assembly/reads2contigs.depth', 'assembly/reads2contigs.entropy', 'assembly/reads2contigs.coverage.txt', args.trinitycores)
+        except RuntimeError as e:
+            hp.quitwitherror(str(e), step=args.step)
+        print('coverage finished')
+    else:
+        # mpileup
+        cmd = 'samtools mpileup -A -B -d 100000 -L 100000 -f assembly/contigs_trinity.fasta assembly/reads2contigs.bam > assembly/reads2contigs.pileup'
+        hp.run_cmd(cmd, args.verbose, 0)
+        tmp.add('assembly/reads2contigs.pileup', ['formatpileup'])
 
-    # format pileup file - i.e., add zeros to uncovered positions
-    ahp.formatpileup('assembly/reads2contigs.pileup', 'assembly/reads2contigs.stats.txt', 'assembly/reads2contigs.format.pileup', 'assembly/reads2contigs.entropy')
+        # format pileup file - i.e., add zeros to uncovered positions
+        ahp.formatpileup('assembly/reads2contigs.pileup', 'assembly/reads2contigs.stats.txt', 'assembly/reads2contigs.format.pileup', 'assembly/reads2contigs.entropy')
+        tmp.done('formatpileup')
 
-    if not int(args.noclean):
-        cmd = 'rm -r assembly/ref_remap'
-        hp.run_cmd(cmd, args.verbose, 0)
-        cmd = 'rm assembly/reads2contigs.pileup'
-        hp.run_cmd(cmd, args.verbose, 0)
+    tmp.report()
+
+    hp.echostep('remap', start=0)
+
+def pseudoremap(args, contigs):
+    """pseudo-align the reads to the contigs, in place of remap"""
+
+    hp.echostep('remap')
+
+    # no index to build, no sam to sort: the read counts (reads2contigs.stats.txt, as from samtools idxstats)
+    # and the depths come out of one pass over the reads, and the bam holds only the reads on no contig (for Step 7)
+    print('pseudo-alignment commenced')
+    fastqs = [args.mate1] if args.single else [args.mate1, args.mate2]
+    try:
+        depths = pa.pseudoalign(contigs, fastqs, 'assembly/reads2contigs.stats.txt', 'assembly/reads2contigs.bam', k=args.kmer, bool_verbose=args.verbose)
+        ahp.coverage_from_depths(depths, 'assembly/reads2contigs.stats.txt', 'assembly/reads2contigs.depth', 'assembly/reads2contigs.entropy', 'assembly/reads2contigs.coverage.txt')
+    except RuntimeError as e:
+        hp.quitwitherror(str(e), step=args.step)
+    print('pseudo-alignment finished')
 
     hp.echostep('remap', start=0)
 
@@ -18,18 +18,20 @@ def get_arg():
     """
     # parse arguments
 
-    # if SGE_TASK_ID is not defined in the shell, this avoids error
-    try:
-        sgeid_default = os.environ['SGE_TASK_ID']
-    except:
-        sgeid_default = 'undefined'
+    # the array task index, whichever scheduler set it
+    # (if none is defined in the shell, this avoids error)
+    sgeid_default = 'undefined'
+    for i in ['PANDORA_TASK_ID', 'SGE_TASK_ID', 'SLURM_ARRAY_TASK_ID']:
+        if os.environ.get(i, 'undefined') != 'undefined':
+            sgeid_default = os.environ[i]
+            break
 
     prog_description = 'A wrapper for blast'
     parser = argparse.ArgumentParser(description=prog_description)
     # parser.add_argument('-i', '--input', help='the input fasta')
     parser.add_argument('-o', '--outputdir', default='blast', help='the output directory')
     parser.add_argument('-d', '--scripts', help='the git repository directory')
-    parser.add_argument('--sgeid', default=sgeid_default, help='SGE_TASK_ID (set by hand only if qsub is turned off)')
+    parser.add_argument('--sgeid', default=sgeid_default, help='array task index, e.g. SGE_TASK_ID (set by hand only if running outside an array job)')
     parser.add_argument('--whichblast', default='blastn', choices=['blastn', 'blastp'], help='which blast to use (blastn, blastp)')
     parser.add_argument('--threads', default='1', help='blast -num_threads option')
     parser.add_argument('--db', help='the database prefix')
@@ -69,7 +71,12 @@ def blastnp(args):
 
     # do blastn or blastp
     cmd = '{args.whichblast} -outfmt "6 {args.fmt}" -query {args.input} -db {args.db} -num_threads {args.threads} {flag} > {args.outputdir}/blast_{args.sgeid}.result'.format(args=args, flag=flag)
-    hp.run_cmd(cmd, args.verbose, 0)
+    # the result file grows as queries finish, which shows the watchdog it's alive
+    (returncodes, stdout) = hp.run_pipeline([cmd], args.verbose, step=args.step, watch=[args.outputdir + '/blast_' + args.sgeid + '.result'])
+
+    # mark the task done, so the wrapper can tell a finished chunk from a failed or truncated one
+    if returncodes[0] == 0:
+        open(args.outputdir + '/blast_' + args.sgeid + '.ok', 'w').close()
 
     hp.echostep(args.step, start=0)
 
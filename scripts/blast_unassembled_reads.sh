@@ -14,7 +14,17 @@ if ! cd ${outputdir}; then exit; fi
 mkdir -p logs
 
 # get unmapped reads
-samtools view -b -f 4 ../${bamfile} > unassembled.bam
+# reads2contigs.bam is sorted by coordinate and indexed: go straight to the unmapped reads through the index,
+# i.e., the unplaced ones ('*') plus the contigs holding unmapped mates of mapped reads (per samtools idxstats)
+if [ -e ../${bamfile}.bai ] && samtools view -H ../${bamfile} | grep -q '^@HD.*SO:coordinate'; then
+    regions=$( samtools idxstats ../${bamfile} | awk '$4 > 0 && $1 != "*" {print $1}' )
+    # (no globbing, or '*' would be a file name)
+    set -f
+    samtools view -b -f 4 ../${bamfile} ${regions} '*' > unassembled.bam
+    set +f
+else
+    samtools view -b -f 4 ../${bamfile} > unassembled.bam
+fi
 
 # transform to fasta and split
 samtools view unassembled.bam | cut -f1,10 > tmp
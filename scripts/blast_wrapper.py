@@ -5,7 +5,6 @@ import sys
 import subprocess
 import os
 import glob
-import shutil
 import fileinput
 
 # This script blasts the entries of a fasta file,
@@ -38,9 +37,15 @@ def get_arg():
     parser.add_argument('--db', help='the database prefix')
     parser.add_argument('--whichblast', default='blastn', choices=['blastn', 'blastp'], help='which blast to use (blastn, blastp)')
     parser.add_argument('--threads', default='1', help='blast -num_threads option')
-    parser.add_argument('--nosge', type=int, default=0, help='no SGE bool')
+    parser.add_argument('--nosge', type=int, default=0, help='no SGE bool (same as --scheduler local)')
+    parser.add_argument('--scheduler', default='sge', choices=['sge', 'slurm', 'local', 'fake'], help='how to run the blast array job: sge (qsub), slurm (sbatch), local (a pool of processes on this machine), or fake (print, run nothing) (default: sge)')
     parser.add_argument('--hpc', type=int, default=0, help='run on the CUMC hpc cluster (add additional qsub flags)')
     parser.add_argument('--id', help='id')
+    parser.add_argument('--collapse_isoforms', type=int, default=0, help='blast only the longest isoform of each Trinity gene, and give its hits to the other isoforms (default: off)')
+    parser.add_argument('--isoforms', default='assembly/contigs_trinity.ids.txt', help='the Trinity ID of each contig (as assembly.py writes it), for --collapse_isoforms')
+    parser.add_argument('--cluster', type=int, default=0, help='cluster the contigs by k-mer containment, blast only the representative of each cluster, and give its hits to the other members (default: off)')
+    parser.add_argument('--cluster_identity', type=float, default=0.95, help='with --cluster, the least identity of a contig to its representative, over the part it covers (default: 0.95)')
+    parser.add_argument('--cluster_coverage', type=float, default=0.9, help='with --cluster, the least fraction of a contig its representative must cover (default: 0.9)')
     args = parser.parse_args()
 
     # blast format string
@@ -53,10 +58,20 @@ def get_arg():
     # need this to get local modules
     sys.path.append(args.scripts)
     global hp
+    global executors
+    global inter
+    global cl
     from helpers import helpers as hp
+    from helpers import executors
+    from helpers import intermediates as inter
+    from helpers import cluster as cl
+
+    # no SGE bool means run on this machine
+    if args.nosge:
+        args.scheduler = 'local'
 
     # error checking: exit if previous step produced zero output
-    for i in [args.input]:
+    for i in [args.input] + ([args.isoforms] if args.collapse_isoforms else []):
         hp.check_file_exists_and_nonzero(i, step=args.step)
 
     return args
@@ -81,83 +96,140 @@ def blast(args):
     with open(args.outputdir + '/header', 'w') as f:
         f.write(args.fmt.replace(' ', '\t') + '\n')
 
-    # if no qsub
-    if args.nosge:
-        # filter fasta file on contigs above threshold length and hardcode name for blast.py
-        # (splitting files doesnt make sense if no cluster)
-        filecount = hp.fastafilter(args.input, args.outputdir + '/blast_1.fasta', args.threshold)
-
-        if filecount == 0:
-            print("No contigs above threshold. Exiting")
-            sys.exit(1)
-
-        # define log files
-        logs_out = args.outputdir + '/' + 'blast_log_' + args.id + '.o'
-        logs_err = args.outputdir + '/' + 'blast_log_' + args.id + '.e'
-        # define command
-        cmd = '{args.scripts}/scripts/blast.py --scripts {args.scripts} --outputdir {args.outputdir} --whichblast {args.whichblast} --db {args.db} --threads {args.threads} --fmt "{args.fmt}" --sgeid 1 > {o} 2> {e}'.format(args=args, o=logs_out, e=logs_err)
-        hp.run_cmd(cmd, args.verbose, 0)
-
-        # make link
-        #cmd = 'ln -s blast_1.result {args.outputdir}/concat.txt'.format(args=args)
-        #hp.run_cmd(cmd, args.verbose, 0)
-        # get top hits
-        #hp.tophitsfilter(args.outputdir + '/blast_1.result', args.outputdir + '/top.concat.txt')
-        # get fasta file of entries that didn't blast
-        #hp.getnohits(args.outputdir + '/top.concat.txt', args.outputdir + '/blast_1.fasta', args.outputdir + '/no_blastn.fa')
-
-        # now filter blast results
-        concat(args)
-
-    # if qsub
+    # mkdir -p
+    hp.mkdirp(args.logsdir)
+
+    # the contigs to blast, and the contigs which get the hits of each of them
+    blastinput = args.input
+    members = {}
+    if args.collapse_isoforms:
+        (blastinput, members) = collapse(args)
+    if args.cluster:
+        (blastinput, members) = cluster(args, blastinput, members)
+
+    # split fasta file on contigs above threshold length (and return number of contigs, file count)
+    (numcontigs, filecount) = hp.fastasplit2(blastinput, args.outputdir + '/blast', args.threshold, args.filelength)
+
+    if numcontigs == 0:
+        print("No contigs above threshold. Exiting")
+        sys.exit(1)
     else:
-        # mkdir -p
-        hp.mkdirp(args.logsdir)
+        print("There are " + str(numcontigs) + " contigs above threshold, and " + str(filecount) + " files to blast.")
 
-        # split fasta file on contigs above threshold length (and return number of contigs, file count)
-        (numcontigs, filecount) = hp.fastasplit2(args.input, args.outputdir + '/blast', args.threshold, args.filelength)
+    # markers from an earlier run don't vouch for this one
+    for i in glob.glob(args.outputdir + '/blast_*.ok'):
+        os.remove(i)
 
-        if filecount == 0:
-            print("No contigs above threshold. Exiting")
-            sys.exit(1)
-        else:
-            print("There are " + str(numcontigs) + " contigs above threshold, and " + str(filecount) + " files to blast.")
-
-        # qsub part of command (array job)
-        qcmd = 'qsub -S {mypython} -N bc_{args.id} -e {args.logsdir} -o {args.logsdir} -l mem={args.bmem}G,time={args.btime}:: -t 1-{filecount} '.format(mypython=sys.executable, args=args, filecount=filecount)
-        #if args.hpc:
-        #    qcmd += ...
-        # regular part of command
-        cmd = '{args.scripts}/scripts/blast.py --scripts {args.scripts} --outputdir {args.outputdir} --whichblast {args.whichblast} --db {args.db} --threads {args.threads} --fmt "{args.fmt}"'.format(args=args)
-        if args.verbose:
-            print(qcmd + cmd)
-        message = subprocess.check_output(qcmd + cmd, shell=True)
-        print(message)
-        # get job id
-        jid = hp.getjid(message)
-
-        # hold the script up here, until all the blast jobs finish
-        # concat top blast hits; concat log files into one, so as not to clutter the file system
-        # qsub part of command
-        qcmd = 'qsub -V -b y -cwd -o log.out -e log.err -N wait_{args.id} -hold_jid {jid} -sync y echo wait_here'.format(args=args, jid=jid)
-        message = subprocess.check_output(qcmd, shell=True)
-        print(message)
-
-        # now concatenate and filter blast results
-        concat(args)
+    # the array job: one task per split file, on whichever backend was chosen
+    ex = executors.get_executor(args.scheduler, args.verbose)
+    job = {'name': 'bc_' + args.id, 'out': args.logsdir, 'err': args.logsdir, 'mem': args.bmem, 'hours': args.btime, 'cores': args.threads}
+    # regular part of command
+    cmd = '{args.scripts}/scripts/blast.py --scripts {args.scripts} --outputdir {args.outputdir} --whichblast {args.whichblast} --db {args.db} --threads {args.threads} --fmt "{args.fmt}"'.format(args=args)
+    jid = ex.submit_array(cmd, filecount, job)
+
+    # hold the script up here, until all the blast jobs finish
+    ex.wait([jid], job)
+
+    # don't concatenate around tasks which failed
+    check_tasks(args, filecount)
+
+    # now concatenate and filter blast results
+    # concat top blast hits; concat log files into one, so as not to clutter the file system
+    concat(args, members)
 
     hp.echostep(args.step, start=0)
 
 # -------------------------------------
 
-def concat(args):
+def collapse(args):
+    """
+    Pick the longest isoform (above threshold) of each Trinity gene to blast for all of them
+
+    Returns (the fasta of the representatives, dict which maps each representative to the other isoforms of its gene)
+    """
+
+    # contig -> Trinity gene
+    groups = {}
+    with open(args.isoforms, 'r') as f:
+        for line in f:
+            (myid, trinityid) = line.split()[:2]
+            groups[myid] = hp.trinitygene(trinityid)
+
+    fasta = args.outputdir + '/representatives.fa'
+    members = hp.fastarepresentatives(args.input, fasta, groups, args.threshold)
+
+    # which isoform stands in for which
+    with open(args.outputdir + '/isoforms.txt', 'w') as f:
+        for i in members:
+            for j in members[i]:
+                f.write(j + '\t' + i + '\n')
+
+    numcollapsed = sum(len(i) for i in members.values())
+    print('Blasting one isoform of each of ' + str(len(members)) + ' Trinity genes, in place of ' + str(len(members) + numcollapsed) + ' contigs (see ' + args.outputdir + '/isoforms.txt)')
+
+    return (fasta, members)
+
+def cluster(args, infile, members):
+    """
+    Cluster the contigs to blast by k-mer containment (see cluster.cluster), to blast one of each cluster for all of them
+
+    infile: the contigs to blast
+    members: dict which maps each of them to the contigs which get its hits already (see collapse)
+
+    Returns (the fasta of the representatives, dict which maps each representative to all the contigs which get its hits)
+    """
+
+    clusters = cl.cluster(infile, args.threshold, args.cluster_identity, args.cluster_coverage)
+
+    fasta = args.outputdir + '/clusters.fa'
+    hp.fastaidfilter(infile, fasta, set(clusters))
+
+    # which contig stands in for which
+    with open(args.outputdir + '/clusters.txt', 'w') as f:
+        for i in clusters:
+            for j in clusters[i]:
+                f.write(j + '\t' + i + '\n')
+
+    print('Blasting one contig of each of ' + str(len(clusters)) + ' clusters, in place of ' + str(len(clusters) + sum(len(i) for i in clusters.values())) + ' (see ' + args.outputdir + '/clusters.txt)')
+
+    # the members of a cluster bring the contigs they stood in for with them
+    return (fasta, {i: members.get(i, []) + [k for j in clusters[i] for k in [j] + members.get(j, [])] for i in clusters})
+
+# -------------------------------------
+
+def check_tasks(args, filecount):
+    """Check every task of the blast array job finished (blast.py leaves a .ok file for each)"""
+
+    failed = [str(i) for i in range(1, filecount + 1) if not os.path.isfile(args.outputdir + '/blast_' + str(i) + '.ok')]
+
+    if failed:
+        message = str(len(failed)) + ' of ' + str(filecount) + ' blast tasks failed (' + ', '.join(failed) + '); see ' + args.logsdir
+        if hp.failfast:
+            hp.quitwitherror(message, step=args.step)
+        else:
+            print('[WARNING] ' + message + '. Their contigs will be missing from the results')
+
+# -------------------------------------
+
+def concat(args, members=None):
     """
     Concatenate blast files and logs, so as not to leave many files messily scattered about.
     Also, implement Ioan's filtering
+
+    members: (optional) dict which maps each contig blasted to the other contigs which get its hits (see collapse)
     """
 
+    members = members or {}
+
     print('CONCATENATE START')
 
+    # the per-task files go as soon as they've been read
+    tmp = inter.Intermediates(args.noclean, args.verbose, args.step, args.outputdir)
+    tmp.add(args.outputdir + '/*.result', ['concat', 'tophits'])
+    tmp.add(args.outputdir + '/*.fasta', ['concat'])
+    tmp.add(args.outputdir + '/*.ok', [])
+    tmp.add(args.logsdir, ['logs'])
+
     # define commands
     # file of all blast hits
     cmd = 'cat {args.outputdir}/*.result > {args.outputdir}/concat.txt'.format(args=args)
@@ -165,6 +237,7 @@ def concat(args):
     # all fasta entries
     cmd = 'cat {args.outputdir}/*.fasta > {args.outputdir}/above_threshold.fa'.format(args=args)
     hp.run_cmd(cmd, args.verbose, 0)
+    tmp.done('concat')
 
     # set of all input IDs from the concatenated fasta file
     with open(args.outputdir + '/above_threshold.fa', 'r') as g:
@@ -189,7 +262,8 @@ def concat(args):
 
     # glob blast files
     myfiles = glob.glob(args.outputdir + '/*.result')
-    f = fileinput.input(files=myfiles)
+    # (with no files, fileinput would read stdin)
+    f = fileinput.input(files=myfiles or [os.devnull])
     for line in f:
         linelist = line.strip().split()
         myid = linelist[0]
@@ -229,8 +303,8 @@ def concat(args):
             minicounter += 1
             #print(myid + ' ' + str(minicounter) + ' ' + str(filterbool))
 
-    # do last entry
-    if not filterbool:
+    # do last entry (if there were any)
+    if topline and not filterbool:
         ifilterfile.write(topline)
 
     f.close()
@@ -242,27 +316,28 @@ def concat(args):
     # print(seenids)
     noblastids = allids - seenids
 
+    if members:
+        # the other isoforms get the hits of the one blasted for them (or, like it, none)
+        hp.expandhits(args.outputdir + '/top.concat.txt', members)
+        hp.expandhits(args.outputdir + '/ifilter.concat.txt', members)
+        noblastids |= {j for i in noblastids for j in members.get(i, [])}
+
     # get fasta file of entries that didn't blast
-    filecount = hp.fastaidfilter(args.outputdir + '/above_threshold.fa', args.outputdir + '/no_blastn.fa', noblastids)
+    filecount = hp.fastaidfilter(args.input if members else args.outputdir + '/above_threshold.fa', args.outputdir + '/no_blastn.fa', noblastids)
 
-    if not args.noclean:
-        cmd = 'rm {args.outputdir}/*.result {args.outputdir}/*.fasta'.format(args=args)
-        hp.run_cmd(cmd, args.verbose, 0)
+    tmp.done('tophits')
 
     print('No blast hits for: ' + ', '.join(list(noblastids)))
 
-    if args.nosge:
-        pass
-    else:
-        # concat blast logs and remove folder
-        print('concatenate blast logs')
-        cmd = 'head -100 {args.logsdir}/* > {args.outputdir}/log.blast'.format(args=args)
-        hp.run_cmd(cmd, args.verbose, 0)
+    # concat blast logs and remove folder
+    print('concatenate blast logs')
+    cmd = 'head -100 {args.logsdir}/* > {args.outputdir}/log.blast'.format(args=args)
+    hp.run_cmd(cmd, args.verbose, 0)
+    tmp.done('logs')
 
-        if not args.noclean:
-            shutil.rmtree(args.logsdir)
+    tmp.report()
 
-        print('CONCATENATE END')
+    print('CONCATENATE END')
 
 # -------------------------------------
 
@@ -6,6 +6,11 @@
 
 import argparse
 import sys
+import os
+import gzip
+import glob
+import shutil
+import pipes
 
 # -------------------------------------
 
@@ -17,9 +22,9 @@ def get_arg():
 
     prog_description = 'Separate host reads'
     parser = argparse.ArgumentParser(description=prog_description)
-    parser.add_argument('-1', '--mate1', help='mate1 fastq')
-    parser.add_argument('-2', '--mate2', help='mate2 fastq')
-    parser.add_argument('--bam', help='bam file')
+    parser.add_argument('-1', '--mate1', help='mate1 fastq (several lanes: a comma-separated list)')
+    parser.add_argument('-2', '--mate2', help='mate2 fastq (several lanes: a comma-separated list, in the same order as mate1)')
+    parser.add_argument('--bam', help='bam file (several lanes: a comma-separated list)')
     parser.add_argument('--single', default=None)
     parser.add_argument('-o', '--outputdir', default='host_separation', help='the output directory')
     parser.add_argument('-l', '--logsdir', help='the logs directory')
@@ -29,15 +34,44 @@ def get_arg():
     parser.add_argument('--refbowtie', help='the bowtie reference')
     parser.add_argument('--gtf', help='host gene feature gtf')
     parser.add_argument('--readlenfilter', type=int, default=25, help='filter reads smaller or equal to this (default: 25)')
+    parser.add_argument('--bwtstream', type=int, default=0, help='stream bowtie2\'s output straight into fastq.gz of the unmapped reads, counting as it goes, rather than writing bwt2.sam (default: off)')
+    parser.add_argument('--starnative', type=int, default=0, help='have STAR write the unmapped reads as fastq and count genes itself, rather than writing a bam of all reads (default: off)')
+    parser.add_argument('--starshm', type=int, default=0, help='share STAR\'s genome in shared memory with the other host separation jobs on this node, loading it if none has, and removing it when the last one is done (default: off)')
     parser.add_argument('--noclean', type=int, default=0, help='do not delete temporary intermediate files (default: off)')
     parser.add_argument('--gzip', type=int, default=0, help='input files are gzipped boolean (default: off)')
+    parser.add_argument('--shards', type=int, default=1, help='split the reads into this many shards, and separate the host reads of each as a task of an array job (fastq input only) (default: 1)')
+    parser.add_argument('--shardtask', type=int, default=0, help='run as a task of the array job of a sharded run, on the shard of the task index (set by --shards, not by hand)')
+    parser.add_argument('--scheduler', default='sge', choices=['sge', 'slurm', 'local', 'fake'], help='with --shards, how to run the array job: sge (qsub), slurm (sbatch), local (a pool of processes on this machine), or fake (print, run nothing) (default: sge)')
+    parser.add_argument('--id', default='0', help='id (for the name of the array job)')
     parser.add_argument('--verbose', type=int, default=0, help='verbose mode: echo commands, etc (default: off)')
     args = parser.parse_args()
 
     # need this to get local modules
     sys.path.append(args.scripts)
     global hp
+    global inter
+    global hhp
+    global read_stats
+    global executors
+    global star_shm
     from helpers import helpers as hp
+    from helpers import intermediates as inter
+    from helpers import host_helpers as hhp
+    from helpers import read_stats
+    from helpers import executors
+    from helpers import star_shm
+
+    # a task of a sharded run separates the host reads of one shard, in a directory of its own (see shard)
+    if args.shardtask:
+        k = executors.task_id()
+        if k == 'undefined':
+            hp.quitwitherror('--shardtask needs an array task index', step='host_separation')
+        sharddir = args.outputdir + '/shards'
+        suffix = '.fastq.gz' if args.gzip else '.fastq'
+        args.mate1 = sharddir + '/mate1_' + k + suffix
+        if args.mate2 != 'None':
+            args.mate2 = sharddir + '/mate2_' + k + suffix
+        args.outputdir = sharddir + '/' + k
 
     # add key-value pairs to the args dict
     vars(args)['step'] = 'host_separation'
@@ -45,37 +79,111 @@ def get_arg():
     # vars(args)['elog'] = args.outputdir + '/../' + 'log.hostmap.err'
     vars(args)['olog'] = args.outputdir + '/../' + 'log.out'
     vars(args)['elog'] = args.outputdir + '/../' + 'log.err'
+    # counts and statistics of the reads at each stage
+    vars(args)['readstats'] = args.outputdir + '/read_stats.json'
+    vars(args)['linecount'] = args.outputdir + '/mapping_percent.txt'
 
     # error checking: exit if input empty 
     for i in [args.mate1, args.mate2]:
         if i != 'None':
-            hp.check_file_exists_and_nonzero(i, step=args.step)
+            for j in i.split(','):
+                hp.check_file_exists_and_nonzero(j, step=args.step)
 
     # this silly line casts the string False to the boolean value
     if args.single == 'False':
         args.single = False
 
+    # likewise the string None (no gtf)
+    if args.gtf == 'None':
+        args.gtf = None
+
     return args
 
 # -------------------------------------
 
+def starbam(args, tmp):
+    """From STAR's bam of all reads, get the mapping counts, the host gene counts (if gtf) and the unmapped reads"""
+
+    tmp.add(args.outputdir + '/Aligned.out.bam', ['flagstat', 'featureCounts', 'star_fastq'] if args.gtf else ['flagstat', 'star_fastq'])
+
+    print('find unmapped reads')
+
+    hp.run_pipeline([['samtools', 'flagstat', args.outputdir + '/Aligned.out.bam']], args.verbose, stdout=args.outputdir + '/mapping_stats.STAR.txt', stderr=args.elog)
+    tmp.done('flagstat')
+
+    # if gtf variable set, get gene coverage
+    # (now, rather than at the end, so the STAR bam needn't wait around for it)
+    if args.gtf:
+        print('featureCounts commenced')
+        cmd = 'featureCounts -a {args.gtf} -o {args.outputdir}/host_gene_counts.txt {args.outputdir}/Aligned.out.bam'.format(args=args)
+        # hp.run_cmd(cmd, args.verbose, 0)
+        hp.run_log_cmd(cmd, args.verbose, args.olog, args.elog)
+        print('featureCounts finished')
+        tmp.done('featureCounts')
+
+    # bin(13) = '0b1101', which corresponds to SAM flag bits:
+    # read paired; read unmapped; mate unmapped
+    ## Flag for unmapped single paired reads is 4
+    unmappedflag = '4' if args.single else '13'
+
+    # sam2fastq.py pairs the mates by name itself, so there's no need to sort by name
+    hp.run_pipeline([
+        ['samtools', 'view', '-f', unmappedflag, args.outputdir + '/Aligned.out.bam'],
+        [sys.executable, args.scripts + '/scripts/sam2fastq.py', args.outputdir + '/star_unmapped', str(args.single), '--pair',
+            '--linecount', args.linecount, '--readstats', args.readstats]
+    ], args.verbose, stderr=args.elog)
+    tmp.done('star_fastq')
+
+# -------------------------------------
+
+def starnative(args, tmp):
+    """
+    Get the mapping counts, the host gene counts (if gtf) and the unmapped reads
+    from what STAR wrote itself (Log.final.out, ReadsPerGene.out.tab, Unmapped.out.mate*)
+    """
+
+    print('find unmapped reads')
+
+    hhp.star_flagstat(args.outputdir + '/Log.final.out', args.outputdir + '/mapping_stats.STAR.txt', args.single)
+
+    if args.gtf:
+        hhp.star_gene_counts(args.outputdir + '/ReadsPerGene.out.tab', args.gtf, args.outputdir + '/host_gene_counts.txt', args.mate1)
+        tmp.add(args.outputdir + '/ReadsPerGene.out.tab', [])
+
+    tmp.add(args.outputdir + '/Unmapped.out.mate*', ['star_fastq'], compress=True)
+    rstats = read_stats.ReadStats()
+    for i in ['1', '2']:
+        if i=='1' or not (args.single):
+            numreads = hhp.star_unmapped2fastq(
+                '{args.outputdir}/Unmapped.out.mate{i}'.format(args=args, i=i),
+                '{args.outputdir}/star_unmapped_{i}.fastq'.format(args=args, i=i),
+                i,
+                rstats
+            )
+            if i=='1':
+                with open(args.linecount, 'a') as f:
+                    f.write('{} {}\n'.format(4 * numreads, args.outputdir + '/star_unmapped_1.fastq'))
+    read_stats.update(args.readstats, 'star_unmapped', rstats.summary())
+    tmp.done('star_fastq')
+
+# -------------------------------------
+
 def hostsep(args):
     """Separate host reads"""
 
     # flags for STAR
-    starflag=''
-    # pipe into gunzip
-    gunzip_pipe = ''
+    starflag = []
     # if input files are gzipped
     if args.gzip: 
-        starflag='--readFilesCommand zcat'
-        gunzip_pipe = 'gunzip |'
+        starflag = ['--readFilesCommand', 'zcat']
 
-    print('Counting input reads')
-    cmd = 'cat {args.mate1} | {gunzip_pipe} wc -l | tr "\n" " " > {args.outputdir}/mapping_percent.txt'.format(args=args, gunzip_pipe=gunzip_pipe)
-    hp.run_cmd(cmd, args.verbose, 0)
-    cmd = 'echo {args.mate1} >> {args.outputdir}/mapping_percent.txt'.format(args=args)
-    hp.run_cmd(cmd, args.verbose, 0)
+    # STAR reads the lanes (comma-separated, as it takes them) one after another:
+    # have it read them through lane_reads.py, which counts each as it goes by
+    lanes = args.mate1.split(',')
+    countdir = args.outputdir + '/lanes'
+    if len(lanes) > 1:
+        hp.mkdirp(countdir)
+        starflag = ['--readFilesCommand', sys.executable, args.scripts + '/scripts/lane_reads.py', '--countdir', countdir] + (['--gzip'] if args.gzip else [])
 
     print('STAR mapping commenced')
 
@@ -84,38 +192,69 @@ def hostsep(args):
     # This option should not modify the downstream counts (of genes) with featureCounts,
     # which only counts features that are uniquely mapped (per BAM input marking info)
     if (args.single):
-        cmd = 'STAR --runThreadN {args.threads} --genomeDir {args.refstar} --readFilesIn {args.mate1} --outFileNamePrefix {args.outputdir}/ --outSAMtype BAM Unsorted --outFilterMultimapNmax 10 --outSAMunmapped Within {starflag}'.format(args=args, starflag=starflag)
+        readfiles = [args.mate1]
     else:
-        cmd = 'STAR --runThreadN {args.threads} --genomeDir {args.refstar} --readFilesIn {args.mate1} {args.mate2} --outFileNamePrefix {args.outputdir}/ --outSAMtype BAM Unsorted --outFilterMultimapNmax 10 --outSAMunmapped Within {starflag}'.format(args=args, starflag=starflag)
-
-    hp.run_cmd(cmd, args.verbose, 0)
+        readfiles = [args.mate1, args.mate2]
+
+    cmd = ['STAR', '--runThreadN', args.threads, '--genomeDir', args.refstar, '--readFilesIn'] + readfiles + ['--outFileNamePrefix', args.outputdir + '/', '--outFilterMultimapNmax', '10'] + starflag
+
+    if args.starnative:
+        # no bam: STAR writes the unmapped reads as fastq (Unmapped.out.mate*) and, given a gtf, counts genes itself
+        cmd += ['--outSAMtype', 'None', '--outReadsUnmapped', 'Fastx']
+        if args.gtf:
+            cmd += ['--quantMode', 'GeneCounts']
+            # a genome made without the annotation needs it now
+            if not os.path.exists(args.refstar + '/exonGeTrInfo.tab'):
+                cmd += ['--sjdbGTFfile', args.gtf]
+    else:
+        cmd += ['--outSAMtype', 'BAM', 'Unsorted', '--outSAMunmapped', 'Within']
+
+    # a genome in shared memory can't take annotations on the fly
+    genome = None
+    if args.starshm and '--sjdbGTFfile' in cmd:
+        print('[star shm] the genome has no annotation, so STAR has to add the gtf itself: not sharing it')
+    elif args.starshm:
+        genome = star_shm.SharedGenome(args.refstar, args.verbose, stderr=args.elog)
+        if genome.attach():
+            cmd += ['--genomeLoad', 'LoadAndKeep']
+
+    # STAR is chatty: stream its errors to the log rather than holding them in memory
+    # (it updates Log.progress.out every minute while mapping, which shows the watchdog it's alive)
+    try:
+        hp.run_pipeline([cmd], args.verbose, stderr=args.elog, watch=[args.outputdir + '/Log.progress.out'])
+    finally:
+        # bowtie2 doesn't need the genome: let it go now, rather than at the end of the step
+        if genome:
+            genome.detach()
 
     print('STAR mapping finished')
 
-    print('find unmapped reads')
+    # STAR counts the input reads, so there's no need to read through them again
+    numreads = int(hhp.star_log_final(args.outputdir + '/Log.final.out')['Number of input reads'])
+    with open(args.linecount, 'w') as f:
+        f.write('{} {}\n'.format(4 * numreads, args.mate1))
+    read_stats.update(args.readstats, 'input', {'reads': numreads})
 
-    cmd = 'samtools flagstat {args.outputdir}/Aligned.out.bam > {args.outputdir}/mapping_stats.STAR.txt'.format(args=args)
-    hp.run_cmd(cmd, args.verbose, 0)
+    # each intermediate goes as soon as the last command which reads it finishes
+    tmp = inter.Intermediates(args.noclean, args.verbose, args.step, args.outputdir)
 
-    # bin(13) = '0b1101', which corresponds to SAM flag bits:
-    # read paired; read unmapped; mate unmapped
-    if (args.single):
-        ## Flag for unmapped single paired reads is 4
-        ## Samtools version compatibility issues: -o flag for output and .bam need to be specified
-        cmd = 'samtools view -b -f 4 {args.outputdir}/Aligned.out.bam | samtools sort -n -o {args.outputdir}/star_unmapped.bam'.format(args=args)
-    else:
-        cmd = 'samtools view -b -f 13 {args.outputdir}/Aligned.out.bam | samtools sort -n -o {args.outputdir}/star_unmapped.bam'.format(args=args)
-
-    hp.run_cmd(cmd, args.verbose, 0)
+    if len(lanes) > 1:
+        write_lanes(args, [hhp.lane_reads(countdir, i) for i in lanes])
+        tmp.add(countdir, [])
 
-    cmd = 'samtools view {args.outputdir}/star_unmapped.bam | {args.scripts}/scripts/sam2fastq.py {args.outputdir}/star_unmapped {args.single}'.format(args=args)
-    hp.run_cmd(cmd, args.verbose, 0)
+    if args.starnative:
+        starnative(args, tmp)
+    else:
+        starbam(args, tmp)
 
-    cmd = 'wc -l {args.outputdir}/star_unmapped_1.fastq >> {args.outputdir}/mapping_percent.txt'.format(args=args)
-    hp.run_cmd(cmd, args.verbose, 0)
+    tmp.add(args.outputdir + '/star_unmapped_*.fastq', ['bowtie2'], compress=True)
 
     print('Bowtie2 mapping commenced')
 
+    if args.bwtstream:
+        bwtstream(args, tmp)
+        return
+
     if (args.single):
         cmd = 'bowtie2 -p {args.threads} -x {args.refbowtie} -U {args.outputdir}/star_unmapped_1.fastq -S {args.outputdir}/bwt2.sam'.format(args=args)
     else:
@@ -125,56 +264,145 @@ def hostsep(args):
     hp.run_log_cmd(cmd, args.verbose, args.olog, args.elog)
 
     print('Bowtie2 mapping finished')
+    tmp.add(args.outputdir + '/bwt2.sam', ['bwt2_flagstat', 'bwt2_unmapped'], compress=True)
+    tmp.done('bowtie2')
 
-    cmd = 'samtools flagstat {args.outputdir}/bwt2.sam > {args.outputdir}/mapping_stats.bwt.txt'.format(args=args)
-    hp.run_cmd(cmd, args.verbose, 0)
+    hp.run_pipeline([['samtools', 'flagstat', args.outputdir + '/bwt2.sam']], args.verbose, stdout=args.outputdir + '/mapping_stats.bwt.txt', stderr=args.elog)
+    tmp.done('bwt2_flagstat')
 
     print('find unmapped reads')
 
-    ## Samtools version compatibility issues: -o flag for output and .bam need to be specified
+    unmappedflag = '4' if args.single else '13'
+
+    ## Ioan: filter short reads (Ioan found Trinity chokes if read length <= jellyfish kmer of 25)
+    # sam2fastq.py filters the pairs on length (dropping both mates if either is too short, so they stay in step)
+    # and gzips them as it writes, so there's no separate pass to filter and zip
+    hp.run_pipeline([
+        ['samtools', 'view', '-S', '-f', unmappedflag, args.outputdir + '/bwt2.sam'],
+        [sys.executable, args.scripts + '/scripts/sam2fastq.py', args.outputdir + '/unmapped', str(args.single), '--pair',
+            '--readlenfilter', str(args.readlenfilter), '--gzip',
+            '--linecount', args.linecount, '--readstats', args.readstats, '--readstatskey', 'bwt2_unmapped']
+    ], args.verbose, stderr=args.elog)
+    tmp.done('bwt2_unmapped')
+
+    # the small stuff STAR leaves goes at the end
+    for i in ['_STARtmp', 'Log.*', 'SJ.out.tab']:
+        tmp.add(args.outputdir + '/' + i, [])
+    tmp.report()
+
+    hp.echostep(args.step, start=0)
+
+# -------------------------------------
+
+def bwtstream(args, tmp):
+    """
+    The second pass of host separation without a sam file: bowtie2's output goes straight into
+    sam2fastq.py, which counts every record (as samtools flagstat would), keeps the unmapped reads,
+    filters them on length and gzips them, all in one pass
+    """
+
     if (args.single):
-        cmd = 'samtools view -S -b -f 4 {args.outputdir}/bwt2.sam | samtools sort -n -o {args.outputdir}/bwt2_unmapped.bam'.format(args=args)
+        bowtie = ['-U', args.outputdir + '/star_unmapped_1.fastq']
     else:
-        cmd = 'samtools view -S -b -f 13 {args.outputdir}/bwt2.sam | samtools sort -n -o {args.outputdir}/bwt2_unmapped.bam'.format(args=args)
+        bowtie = ['-1', args.outputdir + '/star_unmapped_1.fastq', '-2', args.outputdir + '/star_unmapped_2.fastq']
 
-    hp.run_cmd(cmd, args.verbose, 0)
+    # sam2fastq.py pairs the mates by name, so bowtie2 needn't keep the records in input order (--reorder)
+    hp.run_pipeline([
+        ['bowtie2', '-p', args.threads, '-x', args.refbowtie] + bowtie,
+        [sys.executable, args.scripts + '/scripts/sam2fastq.py', args.outputdir + '/unmapped', str(args.single),
+            '--unmapped', '--pair', '--flagstat', args.outputdir + '/mapping_stats.bwt.txt', '--readlenfilter', str(args.readlenfilter),
+            '--gzip', '--linecount', args.linecount, '--readstats', args.readstats, '--readstatskey', 'bwt2_unmapped']
+    ], args.verbose, stderr=args.elog)
 
-    cmd = 'samtools view {args.outputdir}/bwt2_unmapped.bam | {args.scripts}/scripts/sam2fastq.py {args.outputdir}/bwt2_unmapped {args.single}'.format(args=args)
-    hp.run_cmd(cmd, args.verbose, 0)
+    print('Bowtie2 mapping finished')
+    tmp.done('bowtie2')
 
-    cmd = 'wc -l {args.outputdir}/bwt2_unmapped_1.fastq >> {args.outputdir}/mapping_percent.txt'.format(args=args)
-    hp.run_cmd(cmd, args.verbose, 0)
+    # the small stuff STAR leaves goes at the end
+    for i in ['_STARtmp', 'Log.*', 'SJ.out.tab']:
+        tmp.add(args.outputdir + '/' + i, [])
+    tmp.report()
 
-    ## rename and zip both mates, or single mate if unpaired reads
-    ## Ioan: filter short reads
-    for i in ['1', '2']:
-        if i=='1' or not (args.single):
-            # Ioan found Trinity chokes if read length <= jellyfish kmer of 25
-            hp.fastqfilter(
-                '{args.outputdir}/bwt2_unmapped_{i}.fastq'.format(args=args, i=i), 
-                '{args.outputdir}/unmapped_{i}.fastq'.format(args=args, i=i), 
-                args.readlenfilter
-            )
-            ## zipping the files
-            cmd = 'gzip {args.outputdir}/unmapped_{i}.fastq'.format(args=args, i=i)
-            hp.run_cmd(cmd, args.verbose, 0)
+    hp.echostep(args.step, start=0)
 
-    # if gtf variable set, get gene coverage
+# -------------------------------------
+
+def write_lanes(args, counts):
+    """Record the number of reads of each lane of the input (counts, in the order of mate1) in the read statistics"""
+
+    for (k, lane) in enumerate(args.mate1.split(',')):
+        read_stats.update(args.readstats, 'input_lane' + str(k + 1), {'reads': counts[k], 'file': lane})
+
+# -------------------------------------
+
+def shard(args):
+    """
+    Split the reads into shards, separate the host reads of each shard as a task of an array job
+    (so a deep sample can use many nodes, not just the threads of one), then merge what they made
+    """
+
+    sharddir = args.outputdir + '/shards'
+    hp.mkdirp(sharddir)
+    hp.mkdirp(sharddir + '/logs')
+
+    tmp = inter.Intermediates(args.noclean, args.verbose, args.step, args.outputdir)
+    tmp.add(sharddir, ['gather'])
+
+    # deal the reads out in chunks (the mates alike, so they stay in step)
+    chunksize = 100000
+    mates = ['1'] if args.single else ['1', '2']
+    print('split the reads into ' + str(args.shards) + ' shards')
+    for i in mates:
+        counts = hp.fastqsplit(getattr(args, 'mate' + i), sharddir + '/mate' + i, args.shards, args.gzip, chunksize)
+    numreads = sum(counts)
+    if len(counts) > 1:
+        write_lanes(args, counts)
+
+    # too few chunks to go round (each lane ends with a part chunk of its own) leaves empty shards at the end
+    numshards = min(args.shards, max(1, sum((j + chunksize - 1) // chunksize for j in counts)))
+    suffix = '.fastq.gz' if args.gzip else '.fastq'
+    for k in range(numshards + 1, args.shards + 1):
+        for i in mates:
+            os.remove(sharddir + '/mate' + i + '_' + str(k) + suffix)
+    print('{} reads in {} shards'.format(numreads, numshards))
+
+    # markers from an earlier run don't vouch for this one
+    for i in glob.glob(sharddir + '/*.ok'):
+        os.remove(i)
+
+    # the array job: one task per shard, each this same command on its own shard
+    ex = executors.get_executor(args.scheduler, args.verbose)
+    # (memory as pandora.py asks for step 1)
+    job = {'name': 'hs_' + args.id, 'out': sharddir + '/logs', 'err': sharddir + '/logs', 'mem': str(int(args.threads) * 16), 'hours': 12, 'cores': args.threads}
+    cmd = ' '.join([args.scripts + '/scripts/host_separation.py'] + [pipes.quote(i) for i in sys.argv[1:]] + ['--shards', '1', '--shardtask', '1'])
+    jid = ex.submit_array(cmd, numshards, job)
+
+    # hold the script up here, until all the shards finish
+    ex.wait([jid], job)
+
+    # unlike blast, a missing shard means missing reads: no carrying on without it
+    failed = [str(k) for k in range(1, numshards + 1) if not os.path.isfile(sharddir + '/' + str(k) + '.ok')]
+    if failed:
+        hp.quitwitherror(str(len(failed)) + ' of ' + str(numshards) + ' host separation shards failed (' + ', '.join(failed) + '); see ' + sharddir + '/logs', step=args.step)
+
+    print('merge the shards')
+    shards = [sharddir + '/' + str(k) for k in range(1, numshards + 1)]
+
+    # gzip files concatenated are a gzip file
+    for i in mates:
+        with open(args.outputdir + '/unmapped_' + i + '.fastq.gz', 'wb') as f:
+            for j in shards:
+                with open(j + '/unmapped_' + i + '.fastq.gz', 'rb') as g:
+                    shutil.copyfileobj(g, f, 1 << 20)
+
+    for i in ['STAR', 'bwt']:
+        hhp.merge_flagstat([j + '/mapping_stats.' + i + '.txt' for j in shards], args.outputdir + '/mapping_stats.' + i + '.txt')
+    hhp.merge_linecounts([j + '/mapping_percent.txt' for j in shards], args.linecount, [args.mate1, args.outputdir + '/star_unmapped_1.fastq', args.outputdir + '/unmapped_1.fastq'])
+    read_stats.merge_files([j + '/read_stats.json' for j in shards], args.readstats)
     if args.gtf:
-        print('featureCounts commenced')
-        cmd = 'featureCounts -a {args.gtf} -o {args.outputdir}/host_gene_counts.txt {args.outputdir}/Aligned.out.bam'.format(args=args)
-        # hp.run_cmd(cmd, args.verbose, 0)
-        hp.run_log_cmd(cmd, args.verbose, args.olog, args.elog)
-        print('featureCounts finished')
+        hhp.merge_gene_counts([j + '/host_gene_counts.txt' for j in shards], args.outputdir + '/host_gene_counts.txt', args.mate1)
 
-    # TO DO: make this code more compact
-    if not args.noclean:
-        print('clean up')
-        cmd = 'rm -rf {args.outputdir}/_STARtmp'.format(args=args)
-        hp.run_cmd(cmd, args.verbose, 0)
-        for i in ['Aligned.out.bam', 'Log.*', 'SJ.out.tab', 'star_unmapped.bam', 'star_unmapped_*.fastq', 'bwt2.sam', 'bwt2_unmapped.bam']:
-            cmd = 'rm {args.outputdir}/{i}'.format(args=args, i=i)
-            hp.run_cmd(cmd, args.verbose, 0)
+    tmp.done('gather')
+    tmp.report()
 
     hp.echostep(args.step, start=0)
 
@@ -185,60 +413,73 @@ def getunmapped(args):
 
     # fix violations of DRY (modify args variable)
 
-    cmd = 'samtools flagstat {args.bam} > {args.outputdir}/mapping_stats.STAR.txt'.format(args=args)
-    hp.run_cmd(cmd, args.verbose, 0)
-
-    print('find unmapped reads')
-
-    if (args.single):
-        cmd = 'samtools view -b -f 4 {args.bam} | samtools sort -n -o {args.outputdir}/unmapped.bam'.format(args=args)
+    unmappedflag = '4' if args.single else '13'
+
+    # the unmapped reads go straight from the bams (or the regions of them where they are) into the
+    # fastqs, so there's nothing intermediate to register: this just records the step's peak disk usage
+    tmp = inter.Intermediates(args.noclean, args.verbose, args.step, args.outputdir)
+
+    # several bams (lanes) are read one after another, each with counts of its own
+    bams = args.bam.split(',')
+    views = []
+    for (k, bam) in enumerate(bams):
+        flagstat = args.outputdir + '/mapping_stats.STAR' + ('.lane' + str(k + 1) if len(bams) > 1 else '') + '.txt'
+
+        # for a coordinate-sorted, indexed bam, go straight to the unmapped reads through the index rather than reading it all
+        stats = hp.bam_idxstats(bam, args.verbose)
+
+        if stats:
+            hhp.idxstats_flagstat(stats, flagstat)
+            # pairs with neither mate mapped have no position: they're all at the end ('*');
+            # single reads may sit next to a mapped mate, so look in every reference which has unmapped reads
+            regions = hhp.unmapped_regions(stats, not args.single)
+            print('indexed bam: unmapped reads in ' + str(len(regions)) + ' regions')
+        else:
+            hp.run_pipeline([['samtools', 'flagstat', bam]], args.verbose, stdout=flagstat, stderr=args.elog)
+            regions = []
+
+        views.append(['samtools', 'view', '-f', unmappedflag, bam] + regions)
+
+    if len(bams) > 1:
+        hhp.merge_flagstat([args.outputdir + '/mapping_stats.STAR.lane' + str(k + 1) + '.txt' for k in range(len(bams))], args.outputdir + '/mapping_stats.STAR.txt')
+        # one stream of all the lanes' unmapped reads (set -e, so any failing fails it)
+        view = 'set -e; ' + '; '.join(' '.join(pipes.quote(i) for i in j) for j in views)
     else:
-        cmd = 'samtools view -b -f 13 {args.bam} | samtools sort -n -o {args.outputdir}/unmapped.bam'.format(args=args)
+        view = views[0]
 
-    hp.run_cmd(cmd, args.verbose, 0)
-
-    cmd = 'samtools view {args.outputdir}/unmapped.bam | {args.scripts}/scripts/sam2fastq.py {args.outputdir}/tmp_unmapped {args.single}'.format(args=args)
-    hp.run_cmd(cmd, args.verbose, 0)
+    print('find unmapped reads')
 
-    ## filter short reads
-    for i in ['1', '2']:
-        if i=='1' or not (args.single):
-            hp.fastqfilter(
-                '{args.outputdir}/tmp_unmapped_{i}.fastq'.format(args=args, i=i), 
-                '{args.outputdir}/unmapped_{i}.fastq'.format(args=args, i=i), 
-                args.readlenfilter
-            )
+    # sam2fastq.py pairs the mates by name itself, so there's no need to sort by name
+    # (and filters the pairs on length, and gzips them, as it goes)
+    hp.run_pipeline([
+        view,
+        [sys.executable, args.scripts + '/scripts/sam2fastq.py', args.outputdir + '/unmapped', str(args.single), '--pair',
+            '--readlenfilter', str(args.readlenfilter), '--gzip',
+            '--readstats', args.readstats, '--readstatskey', 'unmapped']
+    ], args.verbose, stderr=args.elog)
 
-            cmd = 'rm {args.outputdir}/tmp_unmapped_{i}.fastq'.format(args=args, i=i)
-            hp.run_cmd(cmd, args.verbose, 0)
+    tmp.measure()
 
-    # if gtf variable set, get gene coverage
+    # if gtf variable set, get gene coverage (a column for each lane)
     if args.gtf:
         print('featureCounts commenced')
-        cmd = 'featureCounts -a {args.gtf} -o {args.outputdir}/host_gene_counts.txt {args.bam}'.format(args=args)
+        cmd = 'featureCounts -a {args.gtf} -o {args.outputdir}/host_gene_counts.txt {bams}'.format(args=args, bams=' '.join(bams))
         hp.run_log_cmd(cmd, args.verbose, args.olog, args.elog)
         print('featureCounts finished')
 
-    # check output not empty, then zip both mates (or single file if unpaired reads)
-    for i in ['1', '2']:
-        if i=='1' or not (args.single):
-            # check output not empty
-            cmd = 'head {args.outputdir}/unmapped_{i}.fastq | wc -l'.format(args=args, i=i)
-            numlines = hp.run_cmd(cmd, args.verbose, 1)
-            if numlines == '0':
-                print('[WARNING] No unmapped reads. Exiting')
-                sys.exit(0)
-            # zip
-            cmd = 'gzip {args.outputdir}/unmapped_{i}.fastq'.format(args=args, i=i)
-            hp.run_cmd(cmd, args.verbose, 0)
-
-    if not args.noclean:
-        print('clean up')
-        cmd = 'rm -rf ' + args.outputdir + '/' + 'unmapped.bam'
-        hp.run_cmd(cmd, args.verbose, 0)
+    # check output not empty (the mates are in step, so mate 1 will do)
+    with gzip.open(args.outputdir + '/unmapped_1.fastq.gz', 'rb') as f:
+        empty = not f.readline()
+    if empty:
+        print('[WARNING] No unmapped reads. Exiting')
+
+    tmp.report()
 
     hp.echostep(args.step, start=0)
 
+    if empty:
+        sys.exit(0)
+
 # -------------------------------------
 
 def main():
@@ -257,12 +498,21 @@ def main():
     hp.mkdirp(args.outputdir)
 
     if args.bam and args.bam != 'None':
+        if args.shards > 1:
+            print('[WARNING] --shards is for fastq input: reading the bam in one go')
         # get unmapped reads
         getunmapped(args)
+    elif args.shards > 1:
+        # host separation, scattered across shards of the reads
+        shard(args)
     else:
         # host separation
         hostsep(args)
 
+    # tell the wrapper of a sharded run this task finished
+    if args.shardtask:
+        open(args.outputdir + '.ok', 'w').close()
+
 # -------------------------------------
 
 if __name__ == '__main__':
@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+
+import argparse
+import sys
+import os
+import subprocess
+
+# stream a fastq file (gunzipped, if it's gzipped) to stdout, counting its reads as they go by
+
+# STAR runs this on each lane of the input in turn (--readFilesCommand lane_reads.py --countdir dir [--gzip]),
+# so the lanes needn't be concatenated first, and each is counted in the pass which maps it
+# (the count goes to a file in countdir: see host_helpers.lane_countfile)
+
+# usage: lane_reads.py --countdir counts --gzip lane1_R1.fastq.gz > lane1_R1.fastq
+
+# -------------------------------------
+
+def get_arg():
+    """Get Arguments
+    :rtype: object
+    """
+    # parse arguments
+
+    prog_description = 'Stream a fastq file to stdout, counting its reads'
+    parser = argparse.ArgumentParser(description=prog_description)
+    parser.add_argument('fastq', help='input fastq')
+    parser.add_argument('--countdir', required=True, help='the directory in which to write the number of reads')
+    parser.add_argument('--gzip', action='store_true', help='input fastq is gzipped')
+    args = parser.parse_args()
+
+    # need this to get local modules (this script lives in the scripts directory of the repository)
+    sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    global hhp
+    from helpers import host_helpers as hhp
+
+    return args
+
+# -------------------------------------
+
+def main():
+    """Main function"""
+
+    args = get_arg()
+
+    # gunzip in a process of its own, in parallel with the copying here
+    proc = None
+    if args.gzip:
+        proc = subprocess.Popen(['gzip', '-dc', args.fastq], stdout=subprocess.PIPE, bufsize=1 << 20)
+        f = proc.stdout
+    else:
+        f = open(args.fastq, 'rb')
+
+    # copy in blocks, counting lines rather than going read by read
+    numlines = 0
+    out = sys.stdout
+    while True:
+        block = f.read(1 << 20)
+        if not block:
+            break
+        numlines += block.count('\n')
+        out.write(block)
+    out.flush()
+    f.close()
+
+    if proc and proc.wait() != 0:
+        sys.stderr.write('[ERROR] gzip exited with error code ' + str(proc.returncode) + ' reading ' + args.fastq + '\n')
+        sys.exit(1)
+
+    with open(hhp.lane_countfile(args.countdir, args.fastq), 'w') as g:
+        g.write('{}\n'.format(numlines / 4))
+
+# -------------------------------------
+
+if __name__ == '__main__':
+
+    main()
@@ -25,6 +25,7 @@ def get_arg():
     parser.add_argument('--threshold', type=int, default=0, help='the ORF length threshold')
     parser.add_argument('--db', help='the database prefix')
     parser.add_argument('--nosge', type=int, default=0, help='no SGE bool')
+    parser.add_argument('--scheduler', default='sge', help='how to run the blast array job (see blast_wrapper.py) (default: sge)')
     parser.add_argument('--id', help='id')
     args = parser.parse_args()
 
@@ -69,7 +70,7 @@ def discovery(args):
         hp.mkdirp(args.outputdir + '/blast')
 
         # define command: blastp to nr, if blast flag
-        cmd = '{}/scripts/blast_wrapper.py --scripts {} --outputdir {} -i {} --logsdir {} --whichblast {} --threshold {} --db {} --id {} --noclean {}'.format(
+        cmd = '{}/scripts/blast_wrapper.py --scripts {} --outputdir {} -i {} --logsdir {} --whichblast {} --threshold {} --db {} --id {} --noclean {} --nosge {} --scheduler {}'.format(
                   args.scripts,
                   args.scripts,
                   args.outputdir  + '/blast',
@@ -80,6 +81,8 @@ def discovery(args):
                   args.db,
                   args.id,
                   args.noclean,
+                  args.nosge,
+                  args.scheduler,
         )
         hp.run_cmd(cmd, args.verbose, 1)
 
@@ -0,0 +1,211 @@
+#!/usr/bin/env python
+
+# A wrapper which runs one step of the pipeline
+# and, if the step succeeds, writes its checkpoint manifest
+# (in fail-fast mode, if it fails, cancels the jobs downstream of it)
+
+import argparse
+import sys
+import os
+import shutil
+import tempfile
+
+# -------------------------------------
+
+def get_arg():
+    """Get Arguments
+    :rtype: object
+    """
+    # parse arguments
+
+    prog_description = 'Run a pipeline step and record its checkpoint'
+    parser = argparse.ArgumentParser(description=prog_description)
+    parser.add_argument('-d', '--scripts', help='the git repository directory')
+    parser.add_argument('--step', required=True, help='the step (e.g., 1)')
+    parser.add_argument('--inputs', nargs='*', default=[], help='the files the step reads')
+    parser.add_argument('--outputs', nargs='*', default=[], help='the files the step writes')
+    parser.add_argument('--failfast', type=int, default=0, help='stop the step at the first failing command, and cancel the jobs downstream of a failed step (default: off)')
+    parser.add_argument('--timeout', type=float, default=0, help='kill the step if it runs longer than this many hours (default: no limit)')
+    parser.add_argument('--timeouts', help='time limits in hours for the tools the step runs, e.g. Trinity=48,blastn=6')
+    parser.add_argument('--idletimeouts', help='kill a tool if its logs stop growing for this many hours, e.g. Trinity=4,STAR=1')
+    parser.add_argument('--scratch', help='run the step in a temporary directory under this one (e.g., $TMPDIR or /dev/shm), then move what it wrote back (default: run in place)')
+    parser.add_argument('--verbose', type=int, default=0, help='verbose mode: echo commands, etc (default: off)')
+    parser.add_argument('cmd', nargs=argparse.REMAINDER, help='the command of the step (after --)')
+    args = parser.parse_args()
+
+    # drop the separator
+    if args.cmd and args.cmd[0] == '--':
+        args.cmd = args.cmd[1:]
+
+    # need this to get local modules
+    sys.path.append(args.scripts)
+    global hp
+    global ckpt
+    global executors
+    from helpers import helpers as hp
+    from helpers import checkpoint as ckpt
+    from helpers import executors
+
+    return args
+
+# -------------------------------------
+
+def runstep(args):
+    """Run the step, then write its manifest if it succeeded"""
+
+    # run python scripts with the interpreter running this one (as qsub -S does)
+    mycmd = list(args.cmd)
+    if mycmd[0].endswith('.py'):
+        mycmd = [sys.executable] + mycmd
+
+    # the step is (re)running, so any old manifest no longer describes its outputs,
+    # but the digests of its inputs save rehashing those which haven't changed since
+    cache = (ckpt.load_manifest(args.step) or {}).get('inputs', {})
+    ckpt.clear_manifest(args.step)
+
+    ckpt.update_status(args.step, 'running')
+
+    # the step's scripts pick fail-fast mode and tool time limits up from the environment (as do array jobs they submit)
+    env = dict(os.environ)
+    if args.failfast:
+        env['PANDORA_FAILFAST'] = '1'
+    if args.timeouts:
+        env['PANDORA_TIMEOUTS'] = args.timeouts
+    if args.idletimeouts:
+        env['PANDORA_IDLE'] = args.idletimeouts
+
+    # where to run: in place, or in node-local scratch
+    scratch = None
+    if args.scratch:
+        scratch = stage(args)
+
+    # the step's output goes straight to ours
+    (returncodes, stdout) = hp.run_pipeline([mycmd], args.verbose, stdout=sys.stdout, stderr=sys.stderr, step=args.step, env=env, timeout=args.timeout * 3600, cwd=scratch)
+    returncode = returncodes[0]
+
+    # whether it worked or not, bring back what it wrote (failures need looking at)
+    if scratch:
+        unstage(args, scratch)
+
+    if returncode == hp.watchdog_exit:
+        ckpt.update_status(args.step, 'failed', returncode, 'killed by the watchdog (a time limit, or its logs stopped growing)')
+    elif returncode != 0:
+        ckpt.update_status(args.step, 'failed', returncode)
+    elif not all(os.path.isfile(i) for i in ckpt.split_files(args.outputs)):
+        # exited cleanly but didn't produce everything: don't vouch for it
+        print('[WARNING] step ' + args.step + ' is missing outputs; no checkpoint written')
+        if args.failfast:
+            # downstream steps would only run on nothing
+            returncode = 1
+            ckpt.update_status(args.step, 'failed', returncode)
+        else:
+            ckpt.update_status(args.step, 'done', returncode)
+    else:
+        ckpt.write_manifest(args.step, args.inputs, args.outputs, ' '.join(args.cmd), cache)
+        ckpt.update_status(args.step, 'done', returncode)
+
+    if returncode != 0 and args.failfast:
+        cancel_downstream(args)
+
+    return returncode
+
+# -------------------------------------
+
+def stage(args):
+    """
+    Make a scratch directory with symlinks to the step's declared inputs (in the
+    directories they're in), and return its path (None if there's no scratch)
+
+    The step reads its inputs through the symlinks but writes new files to scratch.
+    Nothing else is linked: neither its declared outputs nor files left over by earlier runs,
+    so rewriting them doesn't write through to the originals.
+    """
+
+    # expand here, on the node which runs the step
+    scratchroot = os.path.expandvars(os.path.expanduser(args.scratch))
+    if not os.path.isdir(scratchroot):
+        print('[WARNING] no scratch directory ' + scratchroot + ' on this node; running step ' + args.step + ' in place')
+        return None
+    scratch = tempfile.mkdtemp(prefix='pandora_step' + args.step + '_', dir=scratchroot)
+
+    # the metrics file is shared by the steps: make sure it's a link, so concurrent steps don't clobber it
+    open(hp.metrics_file, 'a').close()
+
+    # files outside the working directory are read and written where they are
+    def local(files):
+        return sorted(set(i for i in (os.path.normpath(j) for j in files) if not os.path.isabs(i) and not i.startswith('..')))
+    inputs = local(ckpt.split_files(args.inputs) + [hp.metrics_file])
+
+    for i in local(ckpt.split_files(args.outputs)) + inputs:
+        mydir = os.path.join(scratch, os.path.dirname(i))
+        if not os.path.isdir(mydir):
+            os.makedirs(mydir)
+    for i in inputs:
+        if os.path.exists(i):
+            os.symlink(os.path.abspath(i), os.path.join(scratch, i))
+
+    if args.verbose:
+        print('[scratch] running step ' + args.step + ' in ' + scratch)
+        sys.stdout.flush()
+
+    return scratch
+
+# -------------------------------------
+
+def unstage(args, scratch):
+    """Move everything the step wrote (i.e., everything in scratch which isn't a symlink) back, then delete scratch"""
+
+    for (root, dirs, files) in os.walk(scratch):
+        rel = os.path.relpath(root, scratch)
+        for i in dirs:
+            path = os.path.normpath(os.path.join(rel, i))
+            if not os.path.islink(os.path.join(root, i)) and not os.path.isdir(path):
+                os.makedirs(path)
+        for i in files:
+            src = os.path.join(root, i)
+            if os.path.islink(src):
+                continue
+            path = os.path.normpath(os.path.join(rel, i))
+            # the step replaced the file (or the link to it)
+            if os.path.lexists(path):
+                os.remove(path)
+            shutil.move(src, path)
+
+    shutil.rmtree(scratch, ignore_errors=True)
+
+# -------------------------------------
+
+def cancel_downstream(args):
+    """Cancel the jobs of the steps which depend on this one, as recorded by pandora"""
+
+    jobs = ckpt.load_jobs()
+
+    # run locally, the scheduler itself skips dependent steps
+    if not jobs:
+        return
+
+    steps = sorted(ckpt.downstream(args.step, jobs['deps']))
+    jids = [jobs['jids'][i] for i in steps if jobs['jids'].get(i, '0') != '0']
+
+    if jids:
+        print('[fail-fast] step ' + args.step + ' failed: cancelling steps ' + ''.join(steps) + ' (jobs ' + ', '.join(jids) + ')')
+        sys.stdout.flush()
+        executors.get_executor(jobs['scheduler'], args.verbose).cancel(jids)
+        for i in steps:
+            ckpt.update_status(i, 'cancelled')
+
+# -------------------------------------
+
+def main():
+    """Main function"""
+
+    # get arguments
+    args = get_arg()
+    # run step
+    sys.exit(runstep(args))
+
+# -------------------------------------
+
+if __name__ == '__main__':
+
+    main()
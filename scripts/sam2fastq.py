@@ -1,19 +1,26 @@
 #!/usr/bin/env python
 
+import argparse
 import sys
 import os
+import subprocess
+import tempfile
+import shutil
+import zlib
+import struct
+import time
+from distutils import spawn
 
 # convert sam file to fastq
-# for this sam file, these reads are unmapped, 
+# for this sam file, these reads are unmapped,
 # so no need to worry about complementing or multiple mapping
 
-# argument is output fastq base name
-fastqbasename = sys.argv[1]
-args_single = sys.argv[2]
-
-# this silly line casts the string False to the boolean value
-if args_single == 'False':
-    args_single = False
+# usage: samtools view unmapped.bam | sam2fastq.py fastqbasename single
+# or, with the mates in any order (no need for samtools sort -n):
+# samtools view -f 13 all.bam | sam2fastq.py fastqbasename single --pair
+# or, straight from the aligner (all reads, header included):
+# bowtie2 ... | sam2fastq.py fastqbasename single --unmapped --pair --flagstat stats.txt --readlenfilter 25 --gzip
+# (--bgzf instead of --gzip writes blocked gzip, as bgzip does)
 
 # recapitulate:
 # first mate
@@ -35,31 +42,455 @@ if args_single == 'False':
 # 11 1024 0x400 PCR or optical duplicate
 # 12 2048 0x800 supplementary alignment
 
+# -------------------------------------
+
+def get_arg():
+    """Get Arguments
+    :rtype: object
+    """
+    # parse arguments
+
+    prog_description = 'Convert (unmapped) sam records on stdin to fastq'
+    parser = argparse.ArgumentParser(description=prog_description)
+    parser.add_argument('fastqbasename', help='output fastq base name (writes <base>_1.fastq and <base>_2.fastq)')
+    parser.add_argument('single', help='single end reads boolean (True or False)')
+    parser.add_argument('--unmapped', action='store_true', help='keep only unmapped reads (as samtools view -f 4, or -f 13 for pairs), e.g. when reading all of an aligner\'s output')
+    parser.add_argument('--flagstat', help='write counts of every record read, in the format of samtools flagstat, to this file')
+    parser.add_argument('--readlenfilter', type=int, help='drop reads whose length is smaller or equal to this (for paired reads, needs --pair: both mates are dropped if either is too short)')
+    parser.add_argument('--gzip', action='store_true', help='write gzipped fastq (<base>_1.fastq.gz, <base>_2.fastq.gz)')
+    parser.add_argument('--bgzf', action='store_true', help='write gzipped fastq in BGZF (blocked gzip) format, as bgzip does')
+    parser.add_argument('--threads', type=int, default=2, help='with --gzip or --bgzf, the number of threads for each mate\'s compression, if pigz or bgzip is available (default: 2)')
+    parser.add_argument('--pair', action='store_true', help='pair the mates by read name, so they needn\'t be adjacent (no need to sort by name), and write them in step (pairs with a mate missing are dropped)')
+    parser.add_argument('--maxpending', type=int, default=1000000, help='with --pair, the number of mates to hold in memory waiting for their partner before spilling them to disk (default: 1000000)')
+    parser.add_argument('--readstats', help='write statistics of the reads (before filtering on length) to this json file (see helpers/read_stats.py)')
+    parser.add_argument('--readstatskey', help='the name of the reads in the --readstats file (default: the base name of fastqbasename)')
+    parser.add_argument('--linecount', help='append the number of lines of mate 1 fastq (before filtering on length) to this file, as wc -l would')
+    args = parser.parse_args()
+
+    # need this to get local modules (this script lives in the scripts directory of the repository)
+    sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    global read_stats
+    from helpers import read_stats
+
+    # this silly line casts the string False to the boolean value
+    if args.single == 'False':
+        args.single = False
+
+    # filtering the mates on length one by one would put the two files out of step
+    if args.readlenfilter is not None and not args.single and not args.pair:
+        parser.error('--readlenfilter needs --pair for paired reads')
+
+    return args
+
+# -------------------------------------
+
+class FlagStat(object):
+    """Count sam records as samtools flagstat does (QC-passed, QC-failed)"""
+
+    names = ['total', 'secondary', 'supplementary', 'duplicates', 'mapped', 'paired', 'read1', 'read2', 'proper', 'pairmapped', 'singletons', 'diffchr', 'diffchrq5']
+
+    def __init__(self):
+        # most counts depend on the flag alone: count the flags, and work them out at the end
+        self.flags = {}
+        self.diffchr = [0, 0]
+        self.diffchrq5 = [0, 0]
+
+    def count(self, flag, n=1):
+        """Count n records with this flag"""
+        self.flags[flag] = self.flags.get(flag, 0) + n
+
+    def mate(self, flag, rname, mapq, rnext):
+        """
+        Count a primary paired record with itself and mate mapped (mapq as a string)
+        whose mate may be on a different reference ('=' means the same one)
+        """
+
+        if rnext != '=' and rnext != rname:
+            qc = 1 if flag & 512 else 0
+            self.diffchr[qc] += 1
+            if int(mapq) >= 5:
+                self.diffchrq5[qc] += 1
+
+    def tally(self):
+        """Return a dict which maps each name to its [QC-passed, QC-failed] count"""
+
+        c = dict((i, [0, 0]) for i in self.names)
+
+        for (flag, n) in self.flags.items():
+            qc = 1 if flag & 512 else 0
+            c['total'][qc] += n
+            if flag & 256:
+                c['secondary'][qc] += n
+            elif flag & 2048:
+                c['supplementary'][qc] += n
+            elif flag & 1:
+                c['paired'][qc] += n
+                if flag & 2 and not flag & 4:
+                    c['proper'][qc] += n
+                if flag & 64:
+                    c['read1'][qc] += n
+                if flag & 128:
+                    c['read2'][qc] += n
+                if flag & 8 and not flag & 4:
+                    c['singletons'][qc] += n
+                if not flag & 4 and not flag & 8:
+                    c['pairmapped'][qc] += n
+            if not flag & 4:
+                c['mapped'][qc] += n
+            if flag & 1024:
+                c['duplicates'][qc] += n
+
+        c['diffchr'] = self.diffchr
+        c['diffchrq5'] = self.diffchrq5
+
+        return c
+
+    def write(self, outfile):
+        """Write the counts in the format of samtools flagstat"""
+
+        c = self.tally()
+
+        def percent(i, total):
+            return '{:.2f}%'.format(100.0 * i / total) if total else 'N/A'
+
+        def both(i, total):
+            return '({} : {})'.format(percent(c[i][0], c[total][0]), percent(c[i][1], c[total][1]))
+
+        lines = [
+            ('total', 'in total (QC-passed reads + QC-failed reads)'),
+            ('secondary', 'secondary'),
+            ('supplementary', 'supplementary'),
+            ('duplicates', 'duplicates'),
+            ('mapped', 'mapped ' + both('mapped', 'total')),
+            ('paired', 'paired in sequencing'),
+            ('read1', 'read1'),
+            ('read2', 'read2'),
+            ('proper', 'properly paired ' + both('proper', 'paired')),
+            ('pairmapped', 'with itself and mate mapped'),
+            ('singletons', 'singletons ' + both('singletons', 'paired')),
+            ('diffchr', 'with mate mapped to a different chr'),
+            ('diffchrq5', 'with mate mapped to a different chr (mapQ>=5)')
+        ]
+
+        with open(outfile, 'w') as f:
+            for (i, text) in lines:
+                f.write('{} + {} {}\n'.format(c[i][0], c[i][1], text))
+
+# -------------------------------------
+
+class BgzfWriter(object):
+    """Write BGZF (gzip in independent blocks of at most 64K, as bgzip does) in this process"""
+
+    blocksize = 65280
+
+    def __init__(self, filename):
+        self.f = open(filename, 'wb')
+        # the data not yet written, in the pieces it came in (joined once a block's worth is here)
+        self.chunks = []
+        self.size = 0
+
+    def write(self, data):
+        self.chunks.append(data)
+        self.size += len(data)
+        if self.size >= self.blocksize:
+            data = ''.join(self.chunks)
+            end = len(data) - len(data) % self.blocksize
+            for i in range(0, end, self.blocksize):
+                self.block(data[i:i + self.blocksize])
+            self.chunks = [data[end:]]
+            self.size = len(data) - end
+
+    def block(self, data):
+        """Write one block: a gzip member whose extra field (BC) holds its size"""
+
+        c = zlib.compressobj(6, zlib.DEFLATED, -15)
+        z = c.compress(data) + c.flush()
+        # 18 bytes of header + the deflated data + 8 bytes of footer, less 1
+        self.f.write(struct.pack('<BBBBIBBHBBHH', 31, 139, 8, 4, 0, 0, 255, 6, 66, 67, 2, len(z) + 25))
+        self.f.write(z)
+        self.f.write(struct.pack('<II', zlib.crc32(data) & 0xffffffff, len(data)))
+
+    def close(self):
+        if self.size:
+            self.block(''.join(self.chunks))
+        # an empty block marks the end of the file
+        self.block('')
+        self.f.close()
+
+# -------------------------------------
+
+class FastqWriter(object):
+    """
+    A fastq file to write to, with a large buffer
+
+    compress: None, 'gzip' (through a pigz or gzip process, which compresses in parallel with
+    the parsing here) or 'bgzf' (through a bgzip process or, failing that, in this process)
+    """
+
+    buffersize = 1 << 20
+
+    def __init__(self, filename, compress=None, threads=2):
+        self.proc = None
+
+        if compress == 'gzip':
+            if spawn.find_executable('pigz'):
+                cmd = ['pigz', '-c', '-p', str(threads)]
+            else:
+                cmd = ['gzip', '-c']
+            self.proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=open(filename + '.gz', 'wb'), bufsize=self.buffersize)
+            self.f = self.proc.stdin
+        elif compress == 'bgzf':
+            if spawn.find_executable('bgzip'):
+                self.proc = subprocess.Popen(['bgzip', '-c', '-@', str(threads)], stdin=subprocess.PIPE, stdout=open(filename + '.gz', 'wb'), bufsize=self.buffersize)
+                self.f = self.proc.stdin
+            else:
+                self.f = BgzfWriter(filename + '.gz')
+        else:
+            self.f = open(filename, 'wb', self.buffersize)
+
+        self.write = self.f.write
+
+    def close(self):
+        """Close the file, and return the exit code of the compression process (0 if none)"""
+
+        self.f.close()
+        return self.proc.wait() if self.proc else 0
+
+# -------------------------------------
+
+class Pairs(object):
+    """
+    Pair mates by read name, holding those waiting for their partner in a dict
+
+    When more than maxpending mates are waiting, they're spilled to disk, into files bucketed
+    by a hash of the read name, so a mate and its partner always land in the same bucket.
+    At the end, each bucket is paired in memory in turn.
+    """
+
+    numbuckets = 64
 
-fastq1 = fastqbasename + '_1.fastq'
-fastq2 = fastqbasename + '_2.fastq'
+    def __init__(self, basename, maxpending):
+        self.basename = basename
+        self.maxpending = maxpending
+        # map each read name to (mate, read, qual)
+        self.pending = {}
+        self.spilldir = None
+        self.buckets = None
 
-with open(fastq1, 'w') as f, open(fastq2, 'w') as g:
-    # loop thro std:in
-    for line in sys.stdin:
-        id = line.split()[0]
-        flag = line.split()[1]
-        myread = line.split()[9]
-        qual = line.split()[10]
+    def add(self, id, mate, myread, qual):
+        """Add a mate: return its pair as ((read 1, qual 1), (read 2, qual 2)) if its partner is here already, else None"""
 
-        if (args_single):
+        other = self.pending.get(id)
+        if other and other[0] != mate:
+            del self.pending[id]
+            return self.order(mate, (myread, qual), (other[1], other[2]))
+
+        self.pending[id] = (mate, myread, qual)
+        if len(self.pending) > self.maxpending:
+            self.spill()
+
+        return None
+
+    @staticmethod
+    def order(mate, this, other):
+        return (this, other) if mate == '1' else (other, this)
+
+    def bucket(self, id):
+        return (zlib.crc32(id) & 0xffffffff) % self.numbuckets
+
+    def spill(self):
+        """Write the waiting mates to the bucket files"""
+
+        if not self.spilldir:
+            self.spilldir = tempfile.mkdtemp(prefix=os.path.basename(self.basename) + '_spill', dir=os.path.dirname(os.path.abspath(self.basename)))
+            self.buckets = [open(os.path.join(self.spilldir, str(i)), 'w') for i in range(self.numbuckets)]
+
+        for (id, (mate, myread, qual)) in self.pending.items():
+            self.buckets[self.bucket(id)].write('\t'.join([id, mate, myread, qual]) + '\n')
+        self.pending = {}
+
+    def finish(self):
+        """Yield (read name, pair) for the mates which were spilled, then warn about any left without a partner"""
+
+        # mates never spilled and still waiting have no partner
+        orphans = 0 if self.spilldir else len(self.pending)
+
+        if self.spilldir:
+            self.spill()
+            for i in self.buckets:
+                i.close()
+            for i in range(self.numbuckets):
+                pending = {}
+                with open(os.path.join(self.spilldir, str(i)), 'r') as f:
+                    for line in f:
+                        (id, mate, myread, qual) = line.rstrip('\n').split('\t')
+                        other = pending.get(id)
+                        if other and other[0] != mate:
+                            del pending[id]
+                            yield (id, self.order(mate, (myread, qual), (other[1], other[2])))
+                        else:
+                            pending[id] = (mate, myread, qual)
+                orphans += len(pending)
+            shutil.rmtree(self.spilldir, ignore_errors=True)
+
+        self.pending = {}
+
+        if orphans:
+            sys.stderr.write('[WARNING] dropped ' + str(orphans) + ' reads whose mate was missing\n')
+
+# -------------------------------------
+
+def write_pair(f, g, id, pair, minlen):
+    """Write both mates of a pair, unless either is too short (which keeps the files in step); return the number of reads written"""
+
+    ((read1, qual1), (read2, qual2)) = pair
+
+    # Ioan found Trinity chokes if read length <= jellyfish kmer of 25
+    if len(read1) < minlen or len(read2) < minlen:
+        return 0
+
+    f.write('@' + id + '/1\n' + read1 + '\n+\n' + qual1 + '\n')
+    g.write('@' + id + '/2\n' + read2 + '\n+\n' + qual2 + '\n')
+
+    return 2
+
+# -------------------------------------
+
+def sam2fastq(args):
+    """Convert sam records on stdin to fastq"""
+
+    starttime = time.time()
+
+    # get the flag of an unmapped read (pair: read paired; read unmapped; mate unmapped)
+    unmappedflag = 4 if args.single else 13
+    stats = FlagStat() if args.flagstat else None
+    # number of records read, of mate 1 reads before filtering on length, and of reads written
+    numrecords = 0
+    nummate1 = 0
+    numwritten = 0
+    # shortest read to keep
+    minlen = args.readlenfilter + 1 if args.readlenfilter is not None else 0
+    # map each flag seen so far (there are only a handful of distinct ones) to [int value, count]
+    flags = {}
+
+    compress = 'bgzf' if args.bgzf else 'gzip' if args.gzip else None
+    f = FastqWriter(args.fastqbasename + '_1.fastq', compress, args.threads)
+    # single end reads only need mate 1 (the plain file is made anyway, as ever)
+    g = FastqWriter(args.fastqbasename + '_2.fastq', compress, args.threads) if not (args.single and compress) else None
+    write1 = f.write
+    write2 = g.write if g else None
+
+    # mates waiting for their partner (with --pair)
+    pairs = Pairs(args.fastqbasename, args.maxpending) if args.pair and not args.single else None
+    # statistics of the reads which pass --unmapped
+    rstats = read_stats.ReadStats() if args.readstats else None
+    # (locals are quicker than attributes in the loop)
+    single = args.single
+    unmapped = args.unmapped
+
+    # loop thro std:in, in large reads
+    for line in os.fdopen(sys.stdin.fileno(), 'rb', 1 << 20):
+        # skip the header, if it's there
+        if line[0] == '@':
+            continue
+
+        # split once, and only as far as the quality (leave the tags be)
+        fields = line.split('\t', 11)
+        entry = flags.get(fields[1])
+        if entry is None:
+            entry = flags[fields[1]] = [int(fields[1]), 0]
+        entry[1] += 1
+        flag = entry[0]
+
+        # 2317 = paired, unmapped, mate unmapped, secondary, supplementary
+        if stats and (flag & 2317) == 1:
+            stats.mate(flag, fields[2], fields[4], fields[6])
+
+        if unmapped and (flag & unmappedflag) != unmappedflag:
+            continue
+
+        id = fields[0]
+        myread = fields[9]
+        qual = fields[10].rstrip('\n')
+
+        # (only primary records are reads)
+        if rstats and not flag & 2304:
+            rstats.add(myread)
+
+        if pairs:
+            # a read appears once as primary: skip any secondary or supplementary records
+            if flag & 2304:
+                continue
+            pair = pairs.add(id, '1' if flag & 64 else '2', myread, qual)
+            if pair:
+                nummate1 += 1
+                numwritten += write_pair(f, g, id, pair, minlen)
+            continue
+
+        if single or (flag & 64):
+            nummate1 += 1
+
+        # Ioan found Trinity chokes if read length <= jellyfish kmer of 25
+        if len(myread) < minlen:
+            continue
+
+        numwritten += 1
+        if single:
             # Ioan: Removing the '/1' read specification before the first '\n' character
             # possibly a source of formatting errors running Trinity with the --single flag
             # oe: putting this back in: Trinity 2.8.5 throws an error without it!
-            f.write('@' + id + '/1\n' + myread + '\n' + '+\n' + qual + '\n')
+            write1('@%s/1\n%s\n+\n%s\n' % (id, myread, qual))
+        # if mate 1 read (refer to key)
+        elif flag & 64:
+            write1('@%s/1\n%s\n+\n%s\n' % (id, myread, qual))
+        # else if mate 2 read
+        elif flag & 128:
+            write2('@%s/2\n%s\n+\n%s\n' % (id, myread, qual))
         else:
-            # get the binary value of the flag and bitwise AND with 64 ( i.e, int('1000000',2) )
-            # and then shift 6 bits to look at the 7th bit, which tells us if mate 1 (refer to key).
-            # I.e., (int('1000000',2) & 64) >> 6 == 1
-
-            # if mate 1 read
-            if (( int(flag) & 64 ) >> 6):
-                f.write('@' + id + '/1\n' + myread + '\n' + '+\n' + qual + '\n')
-            # else if mate 2 read
-            elif (( int(flag) & 128 ) >> 7):
-                g.write('@' + id + '/2\n' + myread + '\n' + '+\n' + qual + '\n')
+            numwritten -= 1
+
+    if pairs:
+        # pair up the mates which were spilled to disk
+        for (id, pair) in pairs.finish():
+            nummate1 += 1
+            numwritten += write_pair(f, g, id, pair, minlen)
+
+    for i in [f, g]:
+        if i and i.close() != 0:
+            sys.stderr.write('[ERROR] compression exited with error code ' + str(i.proc.returncode) + '\n')
+            sys.exit(1)
+
+    for (flag, n) in flags.values():
+        numrecords += n
+        if stats:
+            stats.count(flag, n)
+
+    if stats:
+        stats.write(args.flagstat)
+
+    if args.linecount:
+        with open(args.linecount, 'a') as h:
+            h.write('{} {}\n'.format(4 * nummate1, args.fastqbasename + '_1.fastq'))
+
+    if rstats:
+        read_stats.update(args.readstats, args.readstatskey or os.path.basename(args.fastqbasename), rstats.summary())
+
+    # throughput
+    elapsed = time.time() - starttime
+    sys.stderr.write('[sam2fastq] {} records read, {} reads written in {:.1f}s ({:.0f} records/s)\n'.format(numrecords, numwritten, elapsed, numrecords / max(elapsed, 1e-6)))
+
+# -------------------------------------
+
+def main():
+    """Main function"""
+
+    # get arguments
+    args = get_arg()
+    # convert
+    sam2fastq(args)
+
+# -------------------------------------
+
+if __name__ == '__main__':
+
+    main()
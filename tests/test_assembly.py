@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+
+"""
+    Tests of the Trinity step (scripts/assembly.py), with a stand-in for Trinity
+    ~~~~~~
+"""
+
+import os
+import sys
+import stat
+import shutil
+import argparse
+import tempfile
+import unittest
+from StringIO import StringIO
+
+repo = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repo)
+sys.path.insert(0, os.path.join(repo, 'scripts'))
+
+from helpers import helpers as hp
+from helpers import assembly_helpers as ahp
+from helpers import intermediates as inter
+import assembly
+
+# the modules assembly.py imports once it has its arguments
+(assembly.hp, assembly.ahp, assembly.inter) = (hp, ahp, inter)
+
+# -------------------------------------
+
+# fails unless given at most 2 cores, recording the cores of each attempt
+trinity = """#!/bin/sh
+while [ $# -gt 0 ]; do
+    case $1 in
+        --CPU) cpu=$2;;
+        --output) out=$2;;
+    esac
+    shift
+done
+echo $cpu >> cpus.txt
+[ $cpu -le 2 ] || exit 1
+printf '>TRINITY_DN1_c0_g1_i1 len=8\\nACGTACGT\\n' > $out/Trinity.fasta
+"""
+
+# -------------------------------------
+
+class TestTrinityRetries(unittest.TestCase):
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.dir = tempfile.mkdtemp()
+        os.chdir(self.dir)
+        os.mkdir('bin')
+        with open('bin/Trinity', 'w') as f:
+            f.write(trinity)
+        os.chmod('bin/Trinity', stat.S_IRWXU)
+        self.path = os.environ['PATH']
+        os.environ['PATH'] = os.path.join(self.dir, 'bin') + os.pathsep + self.path
+
+    def tearDown(self):
+        os.environ['PATH'] = self.path
+        os.chdir(self.cwd)
+        shutil.rmtree(self.dir)
+
+    def assembly(self, retries):
+        args = argparse.Namespace(mate1='r_1.fq', mate2='r_2.fq', single=False, outputdir='assembly_trinity', trinitymem='4',
+                                  trinitycores='8', trinitythreshold='200', retries=retries, noclean=0, verbose=0, step='assembly')
+        (stdout, stderr) = (sys.stdout, sys.stderr)
+        (sys.stdout, sys.stderr) = (StringIO(), StringIO())
+        try:
+            assembly.assembly(args)
+            return sys.stdout.getvalue()
+        finally:
+            (sys.stdout, sys.stderr) = (stdout, stderr)
+
+    def cpus(self):
+        with open('cpus.txt', 'r') as f:
+            return [int(i) for i in f]
+
+    def test_halves_cores(self):
+        output = self.assembly(3)
+        # 8 cores fails, 4 fails, 2 works
+        self.assertEqual(self.cpus(), [8, 4, 2])
+        self.assertIn('[WARNING] Trinity failed (exit code 1), retrying with --CPU 4', output)
+        with open('assembly/contigs_trinity.fasta', 'r') as f:
+            self.assertEqual(f.read(), '>contig_1\nACGTACGT\n')
+
+    def test_gives_up(self):
+        # out of retries, the missing output ends the step
+        with self.assertRaises(SystemExit):
+            self.assembly(1)
+        self.assertEqual(self.cpus(), [8, 4])
+
+# -------------------------------------
+
+if __name__ == '__main__':
+
+    unittest.main()
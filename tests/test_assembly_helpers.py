@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+
+"""
+    Tests of the coverage of the contigs (helpers/assembly_helpers.py)
+    ~~~~~~
+"""
+
+import os
+import sys
+import math
+import unittest
+
+import numpy as np
+
+repo = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repo)
+
+from helpers import assembly_helpers as ahp
+
+# -------------------------------------
+
+def record(contig, pos, cigar, qual):
+    """A sam record of a read mapped to a contig at a (1-based) position"""
+
+    seq = 'A' * len(qual) if qual != '*' else 'ACGTACGTAC'
+    return '\t'.join(['r', '0', contig, str(pos), '60', cigar, '*', '0', '0', seq, qual, 'NM:i:0']) + '\n'
+
+# -------------------------------------
+
+class TestDepth(unittest.TestCase):
+
+    def test_depth_array(self):
+        # blocks [0, 3), [2, 5) and one running off the end
+        depth = ahp.depth_array([0, 2, 6], [3, 5, 12], 8, 0)
+        self.assertEqual(depth.tolist(), [1, 1, 2, 1, 1, 0, 1, 1])
+        self.assertEqual(ahp.depth_array([0, 0, 0], [2, 2, 2], 3, 2).tolist(), [2, 2, 0])
+
+    def test_coverage_metrics(self):
+        (breadth, mean, cv) = ahp.coverage_metrics(np.array([0, 2, 2, 4]))
+        self.assertEqual((breadth, mean), (0.75, 2.0))
+        self.assertAlmostEqual(cv, math.sqrt(2) / 2)
+        (breadth, mean, cv) = ahp.coverage_metrics(np.zeros(5, dtype=np.int64))
+        self.assertEqual((breadth, mean), (0.0, 0.0))
+        self.assertTrue(math.isnan(cv))
+
+    def test_sam_depths(self):
+        lines = [
+            record('c1', 1, '4M', 'IIII'),
+            # soft clipped, a deletion, a skip: the deletion counts, the skip doesn't
+            record('c1', 3, '2S2M1D1M2N2M', 'IIIIII'),
+            # no qualities
+            record('c2', 2, '3M', '*'),
+        ]
+        depths = ahp.sam_depths(lines, {'c1': 12, 'c2': 5}, 0, 13)
+        self.assertEqual(depths['c1'].tolist(), [1, 1, 2, 2, 1, 1, 0, 0, 1, 1, 0, 0])
+        self.assertEqual(depths['c2'].tolist(), [0, 1, 1, 1, 0])
+
+    def test_sam_depths_base_quality(self):
+        # quality 12 ('-') is below mpileup's -Q 13 ('.'): those bases don't count (but deletions do)
+        lines = [
+            record('c1', 1, '5M', 'II-.I'),
+            record('c1', 1, '1S2M1D2M', '-I-II'),
+        ]
+        depths = ahp.sam_depths(lines, {'c1': 6}, 0, 13)
+        self.assertEqual(depths['c1'].tolist(), [2, 1, 1, 2, 2, 0])
+        # with no cutoff, every base counts
+        depths = ahp.sam_depths(lines, {'c1': 6}, 0, 0)
+        self.assertEqual(depths['c1'].tolist(), [2, 2, 2, 2, 2, 0])
+
+# -------------------------------------
+
+if __name__ == '__main__':
+
+    unittest.main()
@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+
+"""
+    Tests of the step checkpoints (helpers/checkpoint.py, scripts/run_step.py)
+    ~~~~~~
+"""
+
+import os
+import sys
+import json
+import shutil
+import tempfile
+import unittest
+import subprocess
+
+repo = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repo)
+
+from helpers import checkpoint as ckpt
+
+# -------------------------------------
+
+def rewrite(myfile, content):
+    """Change a file's content but not its size or mtime (so only reading it tells)"""
+
+    mtime = os.stat(myfile).st_mtime
+    with open(myfile, 'w') as f:
+        f.write(content)
+    os.utime(myfile, (mtime, mtime))
+
+# -------------------------------------
+
+class TestCheckpoint(unittest.TestCase):
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.dir = tempfile.mkdtemp()
+        os.chdir(self.dir)
+        with open('in.txt', 'w') as f:
+            f.write('aaaa\n')
+        # (whole seconds, so setting it back is exact)
+        os.utime('in.txt', (1000000000, 1000000000))
+        with open('out.txt', 'w') as f:
+            f.write('out\n')
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.dir)
+
+    def runstep(self):
+        cmd = [sys.executable, os.path.join(repo, 'scripts', 'run_step.py'), '--scripts', repo, '--step', '1',
+               '--inputs', 'in.txt', '--outputs', 'out.txt', '--', 'true']
+        with open(os.devnull, 'w') as devnull:
+            self.assertEqual(subprocess.call(cmd, stdout=devnull, stderr=devnull), 0)
+        with open(ckpt.manifest_path('1'), 'r') as f:
+            return json.load(f)['inputs']['in.txt']['sha1']
+
+    def test_rerun_reuses_digests(self):
+        first = self.runstep()
+        # same size and mtime: a rerun takes the digest from the old manifest rather than reading the file
+        rewrite('in.txt', 'bbbb\n')
+        self.assertEqual(self.runstep(), first)
+        # a new mtime: it's read again
+        os.utime('in.txt', (1000000010, 1000000010))
+        self.assertNotEqual(self.runstep(), first)
+
+    def test_manifest_matches(self):
+        ckpt.write_manifest('2', ['in.txt', None], ['out.txt'], 'step.py --x 1 --verbose 1')
+        self.assertTrue(ckpt.manifest_matches('2', ['in.txt'], ['out.txt'], 'step.py --x 1 --verbose 0'))
+        self.assertFalse(ckpt.manifest_matches('2', ['in.txt'], ['out.txt'], 'step.py --x 2'))
+        os.remove('out.txt')
+        self.assertFalse(ckpt.manifest_matches('2', ['in.txt'], ['out.txt'], 'step.py --x 1'))
+
+    def test_downstream(self):
+        deps = {'1': [], '2': ['1'], '3': ['2'], '4': ['3'], '7': ['2']}
+        self.assertEqual(ckpt.downstream('2', deps), set(['3', '4', '7']))
+        self.assertEqual(ckpt.downstream('4', deps), set())
+
+# -------------------------------------
+
+if __name__ == '__main__':
+
+    unittest.main()
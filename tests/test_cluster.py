@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+
+"""
+    Tests of the clustering of contigs by k-mer containment (helpers/cluster.py)
+    ~~~~~~
+"""
+
+import os
+import sys
+import shutil
+import string
+import tempfile
+import unittest
+
+import numpy as np
+
+repo = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repo)
+
+from helpers import cluster as cl
+
+# -------------------------------------
+
+def randomseq(n, seed):
+    return ''.join(np.random.RandomState(seed).choice(list('ACGT'), n))
+
+def mutate(seq, fraction, seed):
+    """Change a fraction of the bases of a sequence, evenly spread"""
+
+    rng = np.random.RandomState(seed)
+    seq = list(seq)
+    for i in rng.choice(len(seq), int(fraction * len(seq)), replace=False):
+        seq[i] = 'ACGT'['ACGT'.index(seq[i]) + 1 & 3]
+
+    return ''.join(seq)
+
+# -------------------------------------
+
+class TestCluster(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.fasta = os.path.join(self.dir, 'contigs.fasta')
+        self.long = randomseq(2000, 1)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def cluster(self, contigs, cutoff=99):
+        with open(self.fasta, 'w') as f:
+            for (myid, seq) in contigs:
+                f.write('>' + myid + '\n' + seq + '\n')
+        return cl.cluster(self.fasta, cutoff)
+
+    def test_contained(self):
+        contigs = [
+            ('part', self.long[300:1500]),
+            ('long', self.long),
+            # the other strand
+            ('reverse', self.long[800:1800][::-1].translate(string.maketrans('ACGT', 'TGCA'))),
+            # a few differences
+            ('close', mutate(self.long[100:1100], 0.005, 2)),
+            ('other', randomseq(1000, 3)),
+        ]
+        # longest first: each joins the cluster of the longest contig which contains it
+        self.assertEqual(self.cluster(contigs), {'long': ['part', 'reverse', 'close'], 'other': []})
+
+    def test_not_close_enough(self):
+        contigs = [
+            ('long', self.long),
+            # only half of it is in the long contig
+            ('overlap', self.long[1500:] + randomseq(500, 4)),
+            # all of it is, but at 85% identity
+            ('distant', mutate(self.long[200:1200], 0.15, 5)),
+        ]
+        self.assertEqual(self.cluster(contigs), {'long': [], 'overlap': [], 'distant': []})
+
+    def test_cutoff_and_ties(self):
+        contigs = [
+            ('a', self.long[:1000]),
+            # the same: ties go to the first in the fasta
+            ('b', self.long[:1000]),
+            ('short', self.long[:99]),
+        ]
+        self.assertEqual(self.cluster(contigs), {'a': ['b']})
+
+    def test_sketch(self):
+        (hashes, positions) = cl.sketch(self.long, 21, 8)
+        # about 1 in 8 of the k-mers, distinct and sorted, at positions in the sequence
+        self.assertTrue(150 < len(hashes) < 350)
+        self.assertTrue((np.diff(hashes.astype(np.float64)) > 0).all())
+        self.assertTrue(((positions >= 0) & (positions <= 2000 - 21)).all())
+        # the same sketch whatever the strand or case
+        (rev, positions) = cl.sketch(self.long[::-1].translate(string.maketrans('ACGT', 'TGCA')), 21, 8)
+        self.assertEqual(rev.tolist(), hashes.tolist())
+        self.assertEqual(cl.sketch(self.long.lower(), 21, 8)[0].tolist(), hashes.tolist())
+        # too short for a k-mer
+        self.assertEqual(len(cl.sketch('ACGT', 21, 8)[0]), 0)
+
+# -------------------------------------
+
+if __name__ == '__main__':
+
+    unittest.main()
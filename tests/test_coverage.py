@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+
+"""
+    Tests of the store of the depths of coverage of the contigs (helpers/coverage.py)
+    ~~~~~~
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+repo = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repo)
+
+from helpers import coverage as cov
+
+# -------------------------------------
+
+class TestCoverage(unittest.TestCase):
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.dir = tempfile.mkdtemp()
+        os.chdir(self.dir)
+
+        # two parts (as two batches would write them), and a contig with no coverage between them
+        self.depths = {'c1': np.array([0, 1, 2, 3, 4]), 'c3': np.array([7, 7, 0]), 'c4': np.array([1, 70000])}
+        with open('store.0', 'wb') as f:
+            cov.write_part(f, self.depths['c1'])
+        with open('store.1', 'wb') as f:
+            cov.write_part(f, self.depths['c3'])
+            cov.write_part(f, self.depths['c4'])
+        cov.write('store', [('c1', 5, True), ('c2', 4, False), ('c3', 3, True), ('c4', 2, True)], ['store.0', 'store.1'])
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.dir)
+
+    def test_round_trip(self):
+        # the parts are gathered into the store
+        self.assertEqual(sorted(os.listdir('.')), ['store.idx', 'store.npy'])
+        # (a plain numpy array)
+        self.assertEqual(np.load('store.npy').tolist(), [0, 1, 2, 3, 4, 7, 7, 0, 1, 70000])
+
+        c = cov.Coverage('store')
+        self.assertEqual(list(c), ['c1', 'c2', 'c3', 'c4'])
+        self.assertEqual(len(c), 4)
+        self.assertIn('c2', c)
+        self.assertNotIn('c5', c)
+        self.assertEqual([c.length(i) for i in c], [5, 4, 3, 2])
+        self.assertEqual([c.covered(i) for i in c], [True, False, True, True])
+        for i in self.depths:
+            self.assertEqual(c.depth(i).tolist(), self.depths[i].tolist())
+        self.assertEqual(c.depth('c2').tolist(), [0, 0, 0, 0])
+
+    def test_slices(self):
+        c = cov.Coverage('store')
+        self.assertEqual(c.depth('c1', 1, 3).tolist(), [1, 2])
+        self.assertEqual(c.depth('c1', 3).tolist(), [3, 4])
+        # (clipped to the contig, never into the next one)
+        self.assertEqual(c.depth('c1', 3, 10).tolist(), [3, 4])
+        self.assertEqual(c.depth('c3', -2).tolist(), [7, 0])
+        self.assertEqual(c.depth('c2', 1, 3).tolist(), [0, 0])
+        self.assertEqual(c.depth('c2', 3, 10).tolist(), [0])
+
+    def test_write_pileup(self):
+        cov.write_pileup('store', 'pileup.txt')
+        with open('pileup.txt', 'r') as f:
+            lines = f.read().splitlines()
+        # every position of the covered contigs, 1-based
+        self.assertEqual(len(lines), 10)
+        self.assertEqual(lines[:2], ['c1\t1\t0', 'c1\t2\t1'])
+        self.assertEqual(lines[-1], 'c4\t2\t70000')
+
+# -------------------------------------
+
+if __name__ == '__main__':
+
+    unittest.main()
@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+
+"""
+    Tests of the job-execution backends (helpers/executors.py)
+    ~~~~~~
+"""
+
+import os
+import sys
+import json
+import shutil
+import tempfile
+import unittest
+
+repo = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repo)
+
+from helpers import executors
+
+# -------------------------------------
+
+# stands in for sbatch: records the args it got (after the shell was through with them), prints a job id
+sbatch = '''#!{python}
+import sys, json
+with open({record!r}, 'w') as f:
+    json.dump(sys.argv[1:], f)
+print('42;cluster')
+'''
+
+# -------------------------------------
+
+class TestSlurm(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.record = os.path.join(self.dir, 'args.json')
+        with open(os.path.join(self.dir, 'sbatch'), 'w') as f:
+            f.write(sbatch.format(python=sys.executable, record=self.record))
+        os.chmod(os.path.join(self.dir, 'sbatch'), 0o755)
+        self.environ = dict(os.environ)
+        os.environ['PATH'] = self.dir + os.pathsep + os.environ['PATH']
+        # what the submitting shell would wrongly put in place of the node's
+        os.environ['TMPDIR'] = '/submit/host/tmp'
+
+    def tearDown(self):
+        os.environ.clear()
+        os.environ.update(self.environ)
+        shutil.rmtree(self.dir)
+
+    def wrapped(self):
+        with open(self.record, 'r') as f:
+            args = json.load(f)
+        return args[args.index('--wrap') + 1]
+
+    def test_wrap_is_passed_verbatim(self):
+        ex = executors.SlurmExecutor()
+        cmd = 'run_step.sh --scratch \'$TMPDIR\' -- echo "a b" `hostname` \\\\ $HOME it\'s'
+        self.assertEqual(ex.submit(cmd, {'name': 'job'}, ['7', '8']), '42')
+        self.assertEqual(self.wrapped(), cmd)
+        with open(self.record, 'r') as f:
+            self.assertIn('--dependency=afterany:7:8', json.load(f))
+
+    def test_python_scripts_run_with_this_interpreter(self):
+        ex = executors.SlurmExecutor()
+        ex.submit_array('step.py --x "$SLURM_ARRAY_TASK_ID"', 3)
+        self.assertEqual(self.wrapped(), sys.executable + ' step.py --x "$SLURM_ARRAY_TASK_ID"')
+
+# -------------------------------------
+
+class TestLocal(unittest.TestCase):
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.dir = tempfile.mkdtemp()
+        os.chdir(self.dir)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.dir)
+
+    def test_array_tasks_get_their_index(self):
+        os.mkdir('logs')
+        ex = executors.LocalExecutor(cores=2)
+        jid = ex.submit_array('echo $PANDORA_TASK_ID > task_$SGE_TASK_ID.txt; test $PANDORA_TASK_ID != 3', 4, {'name': 'a', 'out': 'logs', 'err': 'logs'})
+        for k in range(1, 5):
+            with open('task_{}.txt'.format(k), 'r') as f:
+                self.assertEqual(f.read().strip(), str(k))
+        # task 3 failed
+        self.assertEqual(ex.returncodes[jid], [0, 0, 1, 0])
+        self.assertEqual(ex.status(jid), 'failed')
+
+    def most_at_once(self, ex, job, ntasks=6):
+        """Run an array job of short tasks; return the most that ran at the same time"""
+
+        os.mkdir('logs')
+        job = dict(job, name='a', out='logs', err='logs')
+        ex.submit_array('echo start >> events.txt; sleep 0.2; echo end >> events.txt', ntasks, job)
+        (running, most) = (0, 0)
+        with open('events.txt', 'r') as f:
+            for line in f:
+                running += 1 if line.strip() == 'start' else -1
+                most = max(most, running)
+
+        return most
+
+    def test_pool_fits_cores_and_memory(self):
+        # 8 cores would take 8 tasks of a core, but 10G takes only 2 of 4G
+        self.assertEqual(self.most_at_once(executors.LocalExecutor(cores=8, mem=10), {'cores': 1, 'mem': '4'}), 2)
+
+    def test_pool_fits_the_step_grant(self):
+        # a step run by the local scheduler gets only what it was granted, not the machine
+        environ = dict(os.environ)
+        try:
+            os.environ['PANDORA_CORES'] = '2'
+            os.environ['PANDORA_MEM'] = '100.0'
+            ex = executors.LocalExecutor()
+        finally:
+            os.environ.clear()
+            os.environ.update(environ)
+        self.assertEqual((ex.cores, ex.mem), (2, 100.0))
+        self.assertEqual(self.most_at_once(ex, {'cores': 1, 'mem': '8'}), 2)
+        # a task bigger than the grant still runs, alone
+        shutil.rmtree('logs')
+        os.remove('events.txt')
+        self.assertEqual(self.most_at_once(ex, {'cores': 4, 'mem': '8'}, 3), 1)
+
+    def test_task_id(self):
+        environ = dict(os.environ)
+        try:
+            for i in ['PANDORA_TASK_ID', 'SGE_TASK_ID', 'SLURM_ARRAY_TASK_ID']:
+                os.environ.pop(i, None)
+            self.assertEqual(executors.task_id(), 'undefined')
+            os.environ['SGE_TASK_ID'] = 'undefined'
+            os.environ['SLURM_ARRAY_TASK_ID'] = '5'
+            self.assertEqual(executors.task_id(), '5')
+        finally:
+            os.environ.clear()
+            os.environ.update(environ)
+
+# -------------------------------------
+
+if __name__ == '__main__':
+
+    unittest.main()
@@ -0,0 +1,260 @@
+#!/usr/bin/env python
+
+"""
+    Tests of the general helper functions (helpers/helpers.py)
+    ~~~~~~
+"""
+
+import os
+import sys
+import gzip
+import json
+import time
+import shutil
+import signal
+import tempfile
+import unittest
+import subprocess
+from StringIO import StringIO
+
+repo = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repo)
+
+from helpers import helpers as hp
+
+# -------------------------------------
+
+class TestIsoforms(unittest.TestCase):
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.dir = tempfile.mkdtemp()
+        os.chdir(self.dir)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.dir)
+
+    def test_trinitygene(self):
+        self.assertEqual(hp.trinitygene('TRINITY_DN1000_c0_g1_i2'), 'TRINITY_DN1000_c0_g1')
+        self.assertEqual(hp.trinitygene('TRINITY_DN1000_c0_g12_i10'), 'TRINITY_DN1000_c0_g12')
+        self.assertEqual(hp.trinitygene('contig_7'), 'contig_7')
+
+    def test_fastarepresentatives(self):
+        with open('contigs.fasta', 'w') as f:
+            f.write('>DN1_c0_g1_i1\n' + 'A' * 150 + '\n>DN1_c0_g1_i2\n' + 'C' * 300 + '\n>DN1_c0_g1_i3\n' + 'G' * 50 + '\n')
+            f.write('>DN1_c0_g2_i1\n' + 'T' * 120 + '\n>other\n' + 'A' * 200 + '\n')
+        groups = dict((i, hp.trinitygene(i)) for i in ['DN1_c0_g1_i1', 'DN1_c0_g1_i2', 'DN1_c0_g1_i3', 'DN1_c0_g2_i1'])
+        representatives = hp.fastarepresentatives('contigs.fasta', 'out.fasta', groups, 99)
+
+        # the longest of each group, with the others above the cutoff
+        self.assertEqual(representatives, {'DN1_c0_g1_i2': ['DN1_c0_g1_i1'], 'DN1_c0_g2_i1': [], 'other': []})
+        with open('out.fasta', 'r') as f:
+            self.assertEqual(f.read().split()[::2], ['>DN1_c0_g1_i2', '>DN1_c0_g2_i1', '>other'])
+
+    def test_expandhits(self):
+        with open('hits.tsv', 'w') as f:
+            f.write('g1_i2\tacc1\t99.0\n')
+            f.write('# a comment\n')
+            f.write('g1_i2\n')
+            f.write('other\tacc2\t98.0\n')
+        hp.expandhits('hits.tsv', {'g1_i2': ['g1_i1', 'g1_i3'], 'other': []})
+
+        with open('hits.tsv', 'r') as f:
+            self.assertEqual(f.read().splitlines(), ['g1_i2\tacc1\t99.0', 'g1_i1\tacc1\t99.0', 'g1_i3\tacc1\t99.0',
+                                                     '# a comment', 'g1_i2', 'other\tacc2\t98.0'])
+        self.assertFalse(os.path.exists('hits.tsv.tmp'))
+
+# -------------------------------------
+
+class TestFastqSplit(unittest.TestCase):
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.dir = tempfile.mkdtemp()
+        os.chdir(self.dir)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.dir)
+
+    def reads(self, first, last):
+        return ''.join('@r{0}\nACGT\n+\nIIII\n'.format(k) for k in range(first, last))
+
+    def ids(self, myfile, bool_gzip):
+        with (gzip.open(myfile, 'rb') if bool_gzip else open(myfile, 'r')) as f:
+            return [int(i[2:]) for i in f.read().splitlines()[::4]]
+
+    def split(self, bool_gzip):
+        # two lanes, of 5 reads and 6
+        for (name, first, last) in [('a.fastq', 0, 5), ('b.fastq', 5, 11)]:
+            with (gzip.open(name + '.gz', 'wb') if bool_gzip else open(name, 'w')) as f:
+                f.write(self.reads(first, last))
+        suffix = '.gz' if bool_gzip else ''
+        counts = hp.fastqsplit('a.fastq' + suffix + ',b.fastq' + suffix, 'shard', 3, bool_gzip, chunksize=2)
+
+        self.assertEqual(counts, [5, 6])
+        # chunks of 2 reads dealt out in turn (a chunk doesn't run over into the next lane,
+        # but the next lane's first chunk goes to the next shard)
+        self.assertEqual([self.ids('shard_{0}.fastq{1}'.format(k, suffix), bool_gzip) for k in [1, 2, 3]],
+                         [[0, 1, 5, 6], [2, 3, 7, 8], [4, 9, 10]])
+
+    def test_plain(self):
+        self.split(False)
+
+    def test_gzip(self):
+        self.split(True)
+
+# -------------------------------------
+
+class TestRunPipeline(unittest.TestCase):
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.dir = tempfile.mkdtemp()
+        os.chdir(self.dir)
+        self.failfast = hp.failfast
+
+    def tearDown(self):
+        hp.failfast = self.failfast
+        os.chdir(self.cwd)
+        shutil.rmtree(self.dir)
+
+    def test_failfast(self):
+        hp.failfast = True
+        with open(os.devnull, 'w') as f:
+            stdout = sys.stdout
+            sys.stdout = f
+            try:
+                # callers which handle exit codes themselves get them back
+                self.assertEqual(hp.run_pipeline(['false'], 0, failfast=False)[0], [1])
+                # otherwise a failure ends the program
+                with self.assertRaises(SystemExit):
+                    hp.run_pipeline(['false'], 0, stderr=f)
+            finally:
+                sys.stdout = stdout
+
+    def test_interrupt_kills_process_group(self):
+        # under a time limit the command has a process group of its own, which Ctrl-C doesn't reach
+        script = 'import sys; sys.path.insert(0, {0!r}); from helpers import helpers as hp; hp.run_pipeline(["echo $$ > pid.txt; exec sleep 30"], 0, timeout=60)'.format(repo)
+        proc = subprocess.Popen([sys.executable, '-c', script], stderr=subprocess.PIPE)
+        for i in range(100):
+            if os.path.isfile('pid.txt') and open('pid.txt').read().strip():
+                break
+            time.sleep(0.05)
+        with open('pid.txt', 'r') as f:
+            pid = int(f.read())
+        proc.send_signal(signal.SIGINT)
+        (out, err) = proc.communicate()
+        self.assertIn('KeyboardInterrupt', err)
+
+        # the sleep went with it (gone, or a zombie no one has reaped yet)
+        def running():
+            try:
+                with open('/proc/{0}/stat'.format(pid), 'r') as f:
+                    return f.read().rsplit(')', 1)[1].split()[0] != 'Z'
+            except IOError:
+                return False
+        for i in range(40):
+            if not running():
+                break
+            time.sleep(0.05)
+        self.assertFalse(running())
+
+# -------------------------------------
+
+class TestWatchdog(unittest.TestCase):
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.dir = tempfile.mkdtemp()
+        os.chdir(self.dir)
+        self.interval = hp.watchdog_interval
+        hp.watchdog_interval = 0.1
+
+    def tearDown(self):
+        hp.watchdog_interval = self.interval
+        os.chdir(self.cwd)
+        shutil.rmtree(self.dir)
+
+    def test_parse_limits(self):
+        self.assertEqual(hp.parse_limits('Trinity=48,blastn=6,2=60'), {'Trinity': 48 * 3600, 'blastn': 6 * 3600, '2': 60 * 3600})
+        self.assertEqual(hp.parse_limits(' STAR = 0.5 ,,'), {'STAR': 1800})
+        self.assertEqual(hp.parse_limits(''), {})
+        # what doesn't parse is left out, with a warning
+        stderr = sys.stderr
+        sys.stderr = StringIO()
+        try:
+            self.assertEqual(hp.parse_limits('Trinity=two,blastn=6'), {'blastn': 6 * 3600})
+            self.assertIn('Trinity=two', sys.stderr.getvalue())
+        finally:
+            sys.stderr = stderr
+
+    def test_tool_name(self):
+        self.assertEqual(hp.tool_name('/opt/trinity/Trinity --CPU 8'), 'Trinity')
+        self.assertEqual(hp.tool_name(''), '')
+
+    def test_idle_killed(self):
+        stdout = sys.stdout
+        sys.stdout = StringIO()
+        try:
+            starttime = time.time()
+            (returncodes, output) = hp.run_pipeline(['echo started; sleep 30'], 0, stdout='out.txt', stderr='err.txt', idle=0.5)
+            message = sys.stdout.getvalue()
+        finally:
+            sys.stdout = stdout
+
+        # the logs stopped growing, so it was killed well before it would have finished
+        self.assertEqual(returncodes, [hp.watchdog_exit])
+        self.assertTrue(time.time() - starttime < 10)
+        self.assertIn('[watchdog] killing echo started; sleep 30: logs stopped growing', message)
+        with open(hp.metrics_file, 'r') as f:
+            self.assertIn('logs stopped growing', json.loads(f.readline())['killed'])
+
+# -------------------------------------
+
+class TestMetrics(unittest.TestCase):
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.dir = tempfile.mkdtemp()
+        os.chdir(self.dir)
+        self.interval = hp.metrics_interval
+        hp.metrics_interval = 0.05
+
+    def tearDown(self):
+        hp.metrics_interval = self.interval
+        hp.echostep('', start=0)
+        os.chdir(self.cwd)
+        shutil.rmtree(self.dir)
+
+    def test_run_cmd(self):
+        # hold 60M and spin the cpu for half a second, then fail
+        script = 'import sys, time; x = "a" * 60000000; t = time.time()\nwhile time.time() - t < 0.5: pass\nsys.exit(3)'
+        cmd = '{0} -c \'{1}\''.format(sys.executable, script)
+        hp.echostep('test')
+        with open(os.devnull, 'w') as f:
+            stdout = sys.stdout
+            sys.stdout = f
+            try:
+                hp.run_cmd(cmd, 0, 0)
+            finally:
+                sys.stdout = stdout
+
+        with open(hp.metrics_file, 'r') as f:
+            records = [json.loads(i) for i in f]
+        self.assertEqual(len(records), 1)
+        record = records[0]
+        self.assertEqual((record['step'], record['cmd'], record['returncode'], record['killed']), ('test', cmd, 3, None))
+        self.assertTrue(record['wall_s'] >= 0.5)
+        self.assertTrue(record['user_s'] + record['sys_s'] >= 0.3)
+        # the python (a child of the shell) counts in both
+        self.assertTrue(record['max_rss_kb'] >= 60000)
+        self.assertTrue(record['tree_peak_rss_kb'] >= 60000)
+        self.assertTrue(record['read_bytes'] >= 0 and record['write_bytes'] >= 0)
+
+# -------------------------------------
+
+if __name__ == '__main__':
+
+    unittest.main()
@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+
+"""
+    Tests of the helpers of the host separation step (helpers/host_helpers.py)
+    ~~~~~~
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+repo = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repo)
+
+from helpers import host_helpers as hhp
+
+# -------------------------------------
+
+# (the parts of STAR's Log.final.out which matter)
+log_final = '''                                 Started job on |	Oct 18 10:00:00
+                          Number of input reads |	1000
+                      Average input read length |	200
+                                    UNIQUE READS:
+                   Uniquely mapped reads number |	800
+                        Uniquely mapped reads % |	80.00%
+                             MULTI-MAPPING READS:
+        Number of reads mapped to multiple loci |	50
+             % of reads mapped to multiple loci |	5.00%
+        Number of reads mapped to too many loci |	10
+'''
+
+# as samtools flagstat writes it
+flagstat = '''{0} + 0 in total (QC-passed reads + QC-failed reads)
+{1} + 0 secondary
+0 + 0 supplementary
+0 + 0 duplicates
+{2} + 0 mapped (99.00% : N/A)
+{3} + 0 paired in sequencing
+'''
+
+# -------------------------------------
+
+class TestHostHelpers(unittest.TestCase):
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.dir = tempfile.mkdtemp()
+        os.chdir(self.dir)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.dir)
+
+    def write(self, myfile, content):
+        with open(myfile, 'w') as f:
+            f.write(content)
+
+    def read(self, myfile):
+        with open(myfile, 'r') as f:
+            return f.read().splitlines()
+
+    def test_star_flagstat(self):
+        self.write('Log.final.out', log_final)
+        hhp.star_flagstat('Log.final.out', 'stats.txt', False)
+        lines = self.read('stats.txt')
+        # a pair is two reads; only primary alignments are known, and labelled as such
+        self.assertEqual(lines[:3], ['2000 + 0 primary', '0 + 0 primary duplicates', '1700 + 0 primary mapped (85.00% : N/A)'])
+        self.assertNotIn('in total', '\n'.join(lines))
+        self.assertIn('1700 + 0 properly paired (85.00% : N/A)', lines)
+        # what the report takes as the reads mapped to the host: the first count of mapped reads
+        self.assertEqual(int([i for i in lines if 'mapped' in i][0].split()[0]), 1700)
+
+        hhp.star_flagstat('Log.final.out', 'stats.txt', True)
+        lines = self.read('stats.txt')
+        self.assertEqual(lines[2], '850 + 0 primary mapped (85.00% : N/A)')
+        self.assertIn('0 + 0 paired in sequencing', lines)
+
+    def test_unmapped_regions(self):
+        # samtools idxstats: reference, length, mapped, unmapped (the unmapped mates of mapped reads, or the unplaced ones on '*')
+        stats = [('chr1', 1000, 50, 3), ('chr2', 800, 20, 0), ('chrM', 16, 5, 1), ('*', 0, 0, 40)]
+        # pairs with neither mate mapped are all unplaced
+        self.assertEqual(hhp.unmapped_regions(stats, True), ['*'])
+        # single reads also sit on the references with unmapped reads
+        self.assertEqual(hhp.unmapped_regions(stats, False), ['chr1', 'chrM', '*'])
+        # never nothing, which would mean the whole bam
+        self.assertEqual(hhp.unmapped_regions([('chr1', 1000, 50, 0), ('*', 0, 0, 0)], False), ['*'])
+
+    def test_idxstats_flagstat(self):
+        stats = [('chr1', 1000, 50, 3), ('chr2', 800, 20, 0), ('*', 0, 0, 40)]
+        hhp.idxstats_flagstat(stats, 'stats.txt')
+        lines = self.read('stats.txt')
+        # only the total (mapped and unmapped) and mapped counts are known
+        self.assertEqual(lines[0], '113 + 0 in total (QC-passed reads + QC-failed reads)')
+        self.assertEqual(lines[4], '70 + 0 mapped (61.95% : N/A)')
+        self.assertEqual(lines[5], '0 + 0 paired in sequencing')
+        self.assertEqual(len(lines), 13)
+
+    def test_merge_flagstat(self):
+        self.write('a.txt', flagstat.format(100, 10, 90, 100))
+        self.write('b.txt', flagstat.format(300, 0, 150, 300))
+        hhp.merge_flagstat(['a.txt', 'b.txt'], 'ab.txt')
+        self.assertEqual(self.read('ab.txt'), ['400 + 0 in total (QC-passed reads + QC-failed reads)', '10 + 0 secondary', '0 + 0 supplementary',
+                                               '0 + 0 duplicates', '240 + 0 mapped (60.00% : N/A)', '400 + 0 paired in sequencing'])
+
+        # shards of STAR's own counts
+        self.write('Log.final.out', log_final)
+        hhp.star_flagstat('Log.final.out', 'a.txt', False)
+        hhp.star_flagstat('Log.final.out', 'b.txt', False)
+        hhp.merge_flagstat(['a.txt', 'b.txt'], 'ab.txt')
+        lines = self.read('ab.txt')
+        self.assertEqual(lines[:3], ['4000 + 0 primary', '0 + 0 primary duplicates', '3400 + 0 primary mapped (85.00% : N/A)'])
+        self.assertIn('0 + 0 singletons (0.00% : N/A)', lines)
+        self.assertIn('0 + 0 with mate mapped to a different chr (mapQ>=5)', lines)
+
+    def test_merge_linecounts(self):
+        self.write('a.txt', '40 shards/1/in_1.fastq\n12 shards/1/unmapped_1.fastq\n')
+        self.write('b.txt', '20 shards/2/in_1.fastq\n8 shards/2/unmapped_1.fastq\n')
+        hhp.merge_linecounts(['a.txt', 'b.txt'], 'ab.txt', ['in_1.fastq'])
+        # the lines without a label keep the names in the first file
+        self.assertEqual(self.read('ab.txt'), ['60 in_1.fastq', '20 shards/1/unmapped_1.fastq'])
+
+    def test_merge_gene_counts(self):
+        header = '# Program:featureCounts v2.0.1; Command:"featureCounts" ...\nGeneid\tChr\tStart\tEnd\tStrand\tLength\t{}\n'
+        self.write('a.txt', header.format('a.bam') + 'g1\t1\t1\t100\t+\t100\t5\ng2\t1\t200\t300\t-\t101\t0\n')
+        self.write('b.txt', header.format('b.bam') + 'g1\t1\t1\t100\t+\t100\t2\ng3\t2\t1\t50\t+\t50\t7\n')
+        self.write('a.txt.summary', 'Status\ta.bam\nAssigned\t5\nUnassigned_NoFeatures\t3\n')
+        self.write('b.txt.summary', 'Status\tb.bam\nAssigned\t9\nUnassigned_NoFeatures\t1\n')
+        hhp.merge_gene_counts(['a.txt', 'b.txt'], 'ab.txt', 'reads')
+
+        self.assertEqual(self.read('ab.txt'), ['# Program:featureCounts v2.0.1; Command:"featureCounts" ...', 'Geneid\tChr\tStart\tEnd\tStrand\tLength\treads',
+                                               'g1\t1\t1\t100\t+\t100\t7', 'g2\t1\t200\t300\t-\t101\t0', 'g3\t2\t1\t50\t+\t50\t7'])
+        self.assertEqual(self.read('ab.txt.summary'), ['Status\treads', 'Assigned\t14', 'Unassigned_NoFeatures\t4'])
+
+# -------------------------------------
+
+if __name__ == '__main__':
+
+    unittest.main()
@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+
+"""
+    Tests of the tracking of a step's intermediate files (helpers/intermediates.py)
+    ~~~~~~
+"""
+
+import os
+import sys
+import json
+import shutil
+import tempfile
+import unittest
+
+repo = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repo)
+
+from helpers import helpers as hp
+from helpers import intermediates as inter
+
+# -------------------------------------
+
+def write(myfile, size):
+    with open(myfile, 'wb') as f:
+        f.write(os.urandom(size))
+
+# -------------------------------------
+
+class TestIntermediates(unittest.TestCase):
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.dir = tempfile.mkdtemp()
+        os.chdir(self.dir)
+        os.mkdir('step')
+        os.mkdir('work')
+        os.mkdir('other')
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.dir)
+
+    def metrics(self):
+        with open(hp.metrics_file, 'r') as f:
+            return [json.loads(i) for i in f]
+
+    def test_readers(self):
+        tmp = inter.Intermediates(0, 0, 's', 'step')
+        write('step/a.txt', 100)
+        write('step/b.txt', 100)
+        tmp.add('step/a.txt', ['x', 'y'])
+        tmp.add('step/b.txt', ['y'])
+        tmp.add('work', [])
+
+        # a file goes when the last of its readers has finished
+        tmp.done('x')
+        self.assertEqual(sorted(os.listdir('step')), ['a.txt', 'b.txt'])
+        tmp.done('y')
+        self.assertEqual(os.listdir('step'), [])
+        # those with no readers wait for the report
+        self.assertTrue(os.path.isdir('work'))
+        tmp.report()
+        self.assertFalse(os.path.exists('work'))
+
+    def test_noclean(self):
+        tmp = inter.Intermediates(1, 0, 's', 'step')
+        write('step/a.txt', 100)
+        write('step/b.txt', 100)
+        tmp.add('step/a.txt', ['x'], compress=True)
+        tmp.add('step/b.txt', ['x'])
+        tmp.done('x')
+        self.assertEqual(sorted(os.listdir('step')), ['a.txt.gz', 'b.txt'])
+
+    def test_peak_of_step_only(self):
+        # the step's own directory, and what it registered elsewhere, count; another step's files don't
+        tmp = inter.Intermediates(0, 0, 's', 'step')
+        write('step/out.txt', 100000)
+        write('work/tmp.txt', 200000)
+        write('other/big.txt', 1000000)
+        tmp.add('work', ['x'])
+        tmp.done('x')
+        write('step/out2.txt', 100000)
+        tmp.report()
+
+        peak = self.metrics()[-1]
+        self.assertEqual(peak['dir'], 'step')
+        self.assertEqual(peak['step'], 's')
+        # (in allocated blocks, so about the sizes written)
+        self.assertTrue(300000 <= peak['peak_disk_bytes'] < 1000000, peak)
+
+# -------------------------------------
+
+if __name__ == '__main__':
+
+    unittest.main()
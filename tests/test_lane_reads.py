@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+
+"""
+    Tests of the counting of the reads of each lane as STAR reads it (scripts/lane_reads.py)
+    ~~~~~~
+"""
+
+import os
+import sys
+import gzip
+import shutil
+import tempfile
+import unittest
+import subprocess
+
+repo = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repo)
+
+from helpers import host_helpers as hhp
+
+# -------------------------------------
+
+def fastq(numreads):
+    return ''.join('@r{0}\nACGT\n+\nIIII\n'.format(k) for k in range(numreads))
+
+# -------------------------------------
+
+class TestLaneReads(unittest.TestCase):
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.dir = tempfile.mkdtemp()
+        os.chdir(self.dir)
+        os.mkdir('counts')
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.dir)
+
+    def lane_reads(self, myfile, *args):
+        cmd = [sys.executable, os.path.join(repo, 'scripts', 'lane_reads.py'), myfile, '--countdir', 'counts'] + list(args)
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        (out, err) = proc.communicate()
+        return (proc.returncode, out, err)
+
+    def test_plain(self):
+        with open('a.fastq', 'w') as f:
+            f.write(fastq(5))
+        # the reads go by as they are, and are counted
+        self.assertEqual(self.lane_reads('a.fastq'), (0, fastq(5), ''))
+        self.assertEqual(hhp.lane_reads('counts', 'a.fastq'), 5)
+
+    def test_gzip(self):
+        # more than a block, so the count carries across blocks
+        with gzip.open('a.fastq.gz', 'wb') as f:
+            f.write(fastq(100000))
+        (code, out, err) = self.lane_reads('a.fastq.gz', '--gzip')
+        self.assertEqual((code, len(out)), (0, len(fastq(100000))))
+        self.assertEqual(hhp.lane_reads('counts', 'a.fastq.gz'), 100000)
+
+    def test_gzip_error(self):
+        (code, out, err) = self.lane_reads('missing.fastq.gz', '--gzip')
+        self.assertEqual(code, 1)
+        self.assertIn('gzip exited with error code', err)
+        # no count, rather than a wrong one
+        self.assertIsNone(hhp.lane_reads('counts', 'missing.fastq.gz'))
+
+    def test_lane_countfile(self):
+        # the same lane however it's named; lanes of the same name in different directories apart
+        os.mkdir('x')
+        self.assertEqual(hhp.lane_countfile('counts', 'a.fastq'), hhp.lane_countfile('counts', os.path.abspath('a.fastq')))
+        self.assertNotEqual(hhp.lane_countfile('counts', 'a.fastq'), hhp.lane_countfile('counts', 'x/a.fastq'))
+        self.assertEqual(os.path.dirname(hhp.lane_countfile('counts', 'a.fastq')), 'counts')
+
+# -------------------------------------
+
+if __name__ == '__main__':
+
+    unittest.main()
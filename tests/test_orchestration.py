@@ -0,0 +1,211 @@
+#!/usr/bin/env python
+
+"""
+    Tests of the orchestration of the steps (pandora.py scan and batch,
+    run_step.py's fail-fast cancelling), offline, with the fake scheduler
+    ~~~~~~
+"""
+
+import os
+import sys
+import json
+import shutil
+import tempfile
+import unittest
+import subprocess
+from StringIO import StringIO
+
+repo = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repo)
+
+import pandora
+from helpers import checkpoint as ckpt
+from helpers import executors
+
+# -------------------------------------
+
+def wrapped(cmd):
+    """Return (step, inputs, outputs, step command) of a command wrapped by run_step.py (see pandora.checkpoint_steps)"""
+
+    (wrapper, mycmd) = cmd.split(' -- ', 1)
+    words = wrapper.split()
+    step = words[words.index('--step') + 1]
+    inputs = words[words.index('--inputs') + 1:words.index('--outputs')]
+    outputs = words[words.index('--outputs') + 1:]
+
+    return (step, inputs, outputs, mycmd)
+
+# -------------------------------------
+
+class TestOrchestration(unittest.TestCase):
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.dir = tempfile.mkdtemp()
+        os.chdir(self.dir)
+        for i in ['a_1.fq', 'a_2.fq', 'b_1.fq', 'b_2.fq']:
+            open(i, 'w').close()
+        # a new fake scheduler for each test
+        executors._executors.clear()
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.dir)
+
+    def pandora(self, *args):
+        """Run pandora.py (in this process, quietly) with the fake scheduler; return the jobs it submitted"""
+
+        argv = ['pandora.py'] + list(args) + ['--scheduler', 'fake', '--hpc', '--refstar', 'star', '--refbowtie', 'bwt', '--blastdb', 'nt']
+        (sys.argv, stdout) = (argv, sys.stdout)
+        sys.stdout = StringIO()
+        try:
+            pandora.main()
+        finally:
+            (sys.argv, sys.stdout) = (['python'], stdout)
+
+        return executors.get_executor('fake').jobs
+
+    def steps(self, jobs):
+        """Map each step submitted to (jid, the steps it's held on)"""
+
+        steps = {}
+        jid2step = {}
+        for i in jobs:
+            step = wrapped(i['cmd'])[0]
+            steps[step] = (i['jid'], set(jid2step[j] for j in i['hold']))
+            jid2step[i['jid']] = step
+
+        return steps
+
+    def test_scan_order_and_holds(self):
+        jobs = self.pandora('scan', '-id', 's1', '-r1', 'a_1.fq', '-r2', 'a_2.fq')
+        self.assertEqual([wrapped(i['cmd'])[0] for i in jobs], list('123456'))
+        self.assertTrue(all(i['kind'] == 'submit' for i in jobs))
+
+        # each step is held on just the steps whose outputs it reads
+        steps = self.steps(jobs)
+        self.assertEqual(dict((i, steps[i][1]) for i in steps),
+                         {'1': set(), '2': set('1'), '3': set('2'), '4': set('3'), '5': set('123'), '6': set('123')})
+
+        # the jobs are recorded, for fail-fast cancelling
+        recorded = ckpt.load_jobs()
+        self.assertEqual(recorded['scheduler'], 'fake')
+        self.assertEqual(recorded['jids'], dict((i, steps[i][0]) for i in steps))
+
+    def test_sharded_step1_resources(self):
+        def res(*args):
+            sys.argv = ['pandora.py', 'scan', '-id', 's1', '-r1', 'a_1.fq', '-r2', 'a_2.fq', '--hpc', '--refstar', 'star', '--map_threads', '4'] + list(args)
+            try:
+                return pandora.scan_steps(pandora.get_arg())[4]['1']
+            finally:
+                sys.argv = ['python']
+
+        self.assertEqual(res(), (4, 64, 12))
+        # under a scheduler, the array's tasks map: Step 1 only splits and merges
+        self.assertEqual(res('--map_shards', '3'), (1, 4, 24))
+        # locally, the tasks run within Step 1's budget, so it keeps all of it
+        self.assertEqual(res('--map_shards', '3', '--noSGE'), (4, 64, 12))
+
+    def test_scan_skips_checkpointed(self):
+        jobs = self.pandora('scan', '-id', 's1', '-r1', 'a_1.fq', '-r2', 'a_2.fq', '--steps', '12')
+
+        # step 1 finishes, as run_step.py would record it
+        (step, inputs, outputs, mycmd) = wrapped(jobs[0]['cmd'])
+        for i in outputs:
+            if not os.path.isdir(os.path.dirname(i)):
+                os.makedirs(os.path.dirname(i))
+            open(i, 'w').close()
+        ckpt.write_manifest(step, inputs, outputs, mycmd)
+
+        executors._executors.clear()
+        jobs = self.pandora('scan', '-id', 's1', '-r1', 'a_1.fq', '-r2', 'a_2.fq', '--steps', '12')
+        self.assertEqual([wrapped(i['cmd'])[0] for i in jobs], ['2'])
+        self.assertEqual(jobs[0]['hold'], [])
+
+        # new parameters: step 1 (and so step 2, after it) runs again
+        executors._executors.clear()
+        jobs = self.pandora('scan', '-id', 's1', '-r1', 'a_1.fq', '-r2', 'a_2.fq', '--steps', '12', '--map_threads', '8')
+        self.assertEqual([wrapped(i['cmd'])[0] for i in jobs], ['1', '2'])
+
+        # --force reruns it anyway
+        ckpt.write_manifest(step, inputs, outputs, mycmd)
+        executors._executors.clear()
+        jobs = self.pandora('scan', '-id', 's1', '-r1', 'a_1.fq', '-r2', 'a_2.fq', '--steps', '12', '--force')
+        self.assertEqual([wrapped(i['cmd'])[0] for i in jobs], ['1', '2'])
+
+    def test_batch(self):
+        with open('samples.txt', 'w') as f:
+            f.write('# sample\tmate1\tmate2\n')
+            f.write('s1\ta_1.fq\ta_2.fq\n')
+            f.write('s2\tb_1.fq\tb_2.fq\n')
+        jobs = self.pandora('batch', '-id', 'batch', '--samples', 'samples.txt', '--batchdir', 'out', '--steps', '123')
+
+        # a chain of held jobs per sample, named for it, one sample after the other
+        self.assertEqual([i['job']['name'] for i in jobs], ['pandora1_s1', 'pandora2_s1', 'pandora3_s1', 'pandora1_s2', 'pandora2_s2', 'pandora3_s2'])
+        for k in [0, 3]:
+            self.assertEqual(jobs[k]['hold'], [])
+            self.assertEqual(jobs[k + 1]['hold'], [jobs[k]['jid']])
+            self.assertEqual(jobs[k + 2]['hold'], [jobs[k + 1]['jid']])
+
+        # each sample's jobs are recorded in its own directory, with its own inputs
+        for sampleid in ['s1', 's2']:
+            with open(os.path.join('out', sampleid, ckpt.jobsfile), 'r') as f:
+                self.assertEqual(sorted(json.load(f)['jids']), list('123'))
+        self.assertIn(os.path.abspath('b_1.fq'), jobs[3]['cmd'])
+        self.assertNotIn(os.path.abspath('b_1.fq'), jobs[0]['cmd'])
+
+    def test_blast_array_then_wait(self):
+        os.mkdir('assembly')
+        with open('assembly/contigs_trinity.fasta', 'w') as f:
+            for k in range(1, 6):
+                f.write('>contig_{}\n{}\n'.format(k, 'ACGT' * 50))
+        cmd = [sys.executable, os.path.join(repo, 'scripts', 'blast_wrapper.py'), '--scripts', repo, '--scheduler', 'fake',
+               '--db', 'nt', '--id', 's1', '--threshold', '99', '--filelength', '2']
+        with open(os.devnull, 'r') as devnull:
+            proc = subprocess.Popen(cmd, stdin=devnull, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            (out, err) = proc.communicate()
+
+        # an array job of a task per chunk, then a wait on it (nothing ran, so every task counts as failed)
+        fake = [i.split()[:4] for i in out.split('\n') if i.startswith('[fake')]
+        self.assertEqual(fake, [['[fake', 'array]', 'jid=1000', 'hold=-'], ['[fake', 'wait]', '1000']])
+        self.assertIn('tasks=3 ', out)
+        self.assertIn('3 of 3 blast tasks failed', out)
+        self.assertEqual(proc.returncode, 0)
+
+    def test_failfast_cancels_downstream(self):
+        ckpt.write_jobs('fake', {'1': '1000', '2': '1001', '3': '1002', '7': '1003'}, {'1': set(), '2': set('1'), '3': set('2'), '7': set('2')})
+        cmd = [sys.executable, os.path.join(repo, 'scripts', 'run_step.py'), '--scripts', repo, '--step', '2', '--failfast', '1', '--', 'false']
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        (out, err) = proc.communicate()
+
+        self.assertNotEqual(proc.returncode, 0)
+        self.assertIn('[fake cancel] 1002,1003', out)
+        with open(ckpt.statusfile, 'r') as f:
+            status = json.load(f)
+        self.assertEqual(dict((i, status[i]['state']) for i in status), {'2': 'failed', '3': 'cancelled', '7': 'cancelled'})
+
+    def test_scratch_links_only_inputs(self):
+        # an input, an old output, and something left over from an earlier run
+        os.mkdir('out')
+        for (name, text) in [('a_1.fq', 'reads\n'), ('out/out.txt', 'old\n'), ('leftover.txt', 'old\n')]:
+            with open(name, 'w') as f:
+                f.write(text)
+        os.mkdir('scratch')
+        cmd = [sys.executable, os.path.join(repo, 'scripts', 'run_step.py'), '--scripts', repo, '--step', '2', '--scratch', 'scratch',
+               '--inputs', 'a_1.fq', '--outputs', 'out/out.txt', '--', 'sh', '-c', 'test ! -e leftover.txt && cat a_1.fq > out/out.txt && echo new > new.txt']
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        (out, err) = proc.communicate()
+
+        self.assertEqual(proc.returncode, 0, out + err)
+        # what the step wrote came back; the rest is as it was
+        for (name, text) in [('a_1.fq', 'reads\n'), ('out/out.txt', 'reads\n'), ('leftover.txt', 'old\n'), ('new.txt', 'new\n')]:
+            self.assertFalse(os.path.islink(name))
+            with open(name, 'r') as f:
+                self.assertEqual(f.read(), text)
+        self.assertEqual(os.listdir('scratch'), [])
+
+# -------------------------------------
+
+if __name__ == '__main__':
+
+    unittest.main()
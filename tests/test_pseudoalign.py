@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+
+"""
+    Tests of the pseudo-alignment of reads to contigs (helpers/pseudoalign.py)
+    ~~~~~~
+"""
+
+import os
+import sys
+import shutil
+import string
+import tempfile
+import unittest
+
+import numpy as np
+
+repo = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repo)
+
+from helpers import pseudoalign as pa
+
+# -------------------------------------
+
+def revcomp(seq):
+    return seq[::-1].translate(string.maketrans('ACGT', 'TGCA'))
+
+def pack(seq):
+    """A k-mer packed 2 bits a base, as a number"""
+    return sum('ACGT'.index(b) << 2 * (len(seq) - 1 - j) for (j, b) in enumerate(seq))
+
+def randomseq(n, seed):
+    return ''.join(np.random.RandomState(seed).choice(list('ACGT'), n))
+
+# -------------------------------------
+
+class TestKmers(unittest.TestCase):
+
+    def test_kmers_at(self):
+        seq = 'ACGTTGCANAC'
+        (kmers, valid) = pa.kmers_at(pa.encode(seq), np.arange(len(seq) - 3), 4)
+        # the lesser of each 4-mer and its reverse complement
+        expected = [min(pack(seq[i:i + 4]), pack(revcomp(seq[i:i + 4]))) if 'N' not in seq[i:i + 4] else None for i in range(len(seq) - 3)]
+        self.assertEqual(valid.tolist(), [i is not None for i in expected])
+        self.assertEqual([int(i) for (i, j) in zip(kmers, expected) if j is not None], [i for i in expected if i is not None])
+
+    def test_strand(self):
+        # a sequence and its reverse complement have the same canonical k-mers
+        seq = randomseq(100, 1)
+        (fwd, valid) = pa.kmers_at(pa.encode(seq), np.arange(100 - 31 + 1), 31)
+        (rev, valid) = pa.kmers_at(pa.encode(revcomp(seq)), np.arange(100 - 31 + 1), 31)
+        self.assertEqual(sorted(fwd.tolist()), sorted(rev.tolist()))
+        # lower case too
+        (low, valid) = pa.kmers_at(pa.encode(seq.lower()), np.arange(100 - 31 + 1), 31)
+        self.assertEqual(low.tolist(), fwd.tolist())
+
+    def test_read_starts(self):
+        # every 4 bases, and the last k-mer (the read of 9 has just the one, the read of 5 none)
+        (reads, offsets) = pa.read_starts(np.array([20, 9, 5]), 9, 4)
+        self.assertEqual(reads.tolist(), [0, 0, 0, 0, 1])
+        self.assertEqual(offsets.tolist(), [0, 4, 8, 11, 0])
+
+# -------------------------------------
+
+class TestIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.fasta = os.path.join(self.dir, 'contigs.fasta')
+        # c2 shares its first 40 bases with the end of c1; c3 is too short for a k-mer
+        self.c1 = randomseq(200, 2)
+        self.c2 = self.c1[160:] + randomseq(160, 3)
+        with open(self.fasta, 'w') as f:
+            f.write('>c1 some description\n' + self.c1 + '\n>c2\n' + self.c2 + '\n>c3\nACGT\n')
+        self.index = pa.KmerIndex(self.fasta, 15)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_index(self):
+        self.assertEqual(self.index.names, ['c1', 'c2', 'c3'])
+        self.assertEqual(self.index.lengths, [200, 200, 4])
+        # sorted and distinct
+        self.assertTrue((np.diff(self.index.kmers.astype(np.float64)) > 0).all())
+
+    def test_lookup(self):
+        starts = np.array([0, 100, 150, 170])
+        (kmers, valid) = pa.kmers_at(pa.encode(self.c1), starts, 15)
+        (contigs, positions, shared) = self.index.lookup(kmers)
+        self.assertEqual(contigs.tolist(), [0, 0, 0, 0])
+        self.assertEqual(positions.tolist(), starts.tolist())
+        # the k-mers wholly in the 40 bases c1 and c2 share are in both
+        self.assertEqual(shared.tolist(), [False, False, False, True])
+
+        (kmers, valid) = pa.kmers_at(pa.encode(self.c2), np.array([5, 50]), 15)
+        (contigs, positions, shared) = self.index.lookup(kmers)
+        # the shared one maps to the first contig it's in
+        self.assertEqual(contigs.tolist(), [0, 1])
+        self.assertEqual(positions.tolist(), [165, 50])
+
+        # not in any contig (either strand)
+        (kmers, valid) = pa.kmers_at(pa.encode('A' * 15), np.array([0]), 15)
+        self.assertEqual(self.index.lookup(kmers)[0].tolist(), [-1])
+
+    def test_hits_and_assign(self):
+        reads = [self.c1[10:60] + '\n', revcomp(self.c2[100:150]) + '\n', self.c1[165:195] + '\n', 'N' * 50 + '\n']
+        (r, c, p, s) = pa.hits(self.index, reads, 8)
+        self.assertEqual(sorted(set(r.tolist())), [0, 1, 2])
+        assigned = pa.assign(len(reads), 3, r, c, s)
+        # the third read is all in the part c1 and c2 share: it goes to the first
+        self.assertEqual(assigned.tolist(), [0, 1, 0, -1])
+
+    def test_assign(self):
+        # read 0: 2 unshared k-mers in contig 1, 1 in contig 0; read 1: only shared k-mers;
+        # read 2: a shared k-mer in contig 0, but an unshared one in contig 2; read 3: no hits
+        reads = np.array([0, 0, 0, 1, 1, 2, 2])
+        contigs = np.array([1, 0, 1, 2, 0, 0, 2])
+        shared = np.array([False, False, False, True, True, True, False])
+        self.assertEqual(pa.assign(4, 3, reads, contigs, shared).tolist(), [1, 2, 2, -1])
+
+# -------------------------------------
+
+if __name__ == '__main__':
+
+    unittest.main()
@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+
+"""
+    Tests of the read statistics (helpers/read_stats.py)
+    ~~~~~~
+"""
+
+import os
+import sys
+import json
+import shutil
+import tempfile
+import unittest
+
+repo = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repo)
+
+from helpers import read_stats
+
+# -------------------------------------
+
+class TestReadStats(unittest.TestCase):
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.dir = tempfile.mkdtemp()
+        os.chdir(self.dir)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.dir)
+
+    def test_summary(self):
+        stats = read_stats.ReadStats()
+        for i in ['ACGT', 'GGCN', 'ACGT', 'AAAAAA']:
+            stats.add(i)
+        d = stats.summary()
+        self.assertEqual((d['reads'], d['bases'], d['mean_length']), (4, 18, 4.5))
+        self.assertEqual(d['length_histogram'], {'4': 3, '6': 1})
+        self.assertEqual((d['gc_fraction'], d['n_fraction']), (round(7 / 18.0, 4), round(1 / 18.0, 4)))
+        self.assertEqual((d['duplicate_rate'], d['duplicate_sample']), (0.25, 4))
+        # nothing to take fractions of
+        self.assertEqual(read_stats.ReadStats().summary()['gc_fraction'], None)
+
+    def test_update(self):
+        read_stats.update('stats.json', 'input', {'reads': 10})
+        read_stats.update('stats.json', 'unmapped', {'reads': 4})
+        # the other records are kept
+        read_stats.update('stats.json', 'input', {'reads': 12})
+        with open('stats.json', 'r') as f:
+            self.assertEqual(json.load(f), {'input': {'reads': 12}, 'unmapped': {'reads': 4}})
+        self.assertEqual(os.listdir('.'), ['stats.json'])
+
+    def test_merge(self):
+        a = {'reads': 3, 'bases': 30, 'mean_length': 10.0, 'length_histogram': {'10': 3}, 'gc_fraction': 0.5, 'n_fraction': 0.0,
+             'duplicate_rate': 0.0, 'duplicate_sample': 3}
+        b = {'reads': 1, 'bases': 20, 'mean_length': 20.0, 'length_histogram': {'10': 0, '20': 1}, 'gc_fraction': 0.25, 'n_fraction': 0.1,
+             'duplicate_rate': 1.0, 'duplicate_sample': 1}
+        d = read_stats.merge([a, b])
+        self.assertEqual((d['reads'], d['bases'], d['mean_length'], d['duplicate_sample']), (4, 50, 12.5, 4))
+        self.assertEqual(d['length_histogram'], {'10': 3, '20': 1})
+        # fractions weighted by the bases (or the sampled reads) of each
+        self.assertEqual((d['gc_fraction'], d['n_fraction'], d['duplicate_rate']), (0.4, 0.04, 0.25))
+        # records with only some fields merge just those
+        self.assertEqual(read_stats.merge([{'reads': 2}, {'reads': 5}]), {'reads': 7})
+        self.assertEqual(read_stats.merge([{'reads': 0, 'bases': 0, 'gc_fraction': None}])['gc_fraction'], None)
+
+    def test_merge_files(self):
+        read_stats.update('a.json', 'input', {'reads': 2})
+        read_stats.update('a.json', 'unmapped', {'reads': 1, 'bases': 10})
+        read_stats.update('b.json', 'input', {'reads': 3})
+        # an existing record of the merged file is replaced; a missing shard is passed over
+        read_stats.update('ab.json', 'input', {'reads': 100})
+        read_stats.merge_files(['a.json', 'b.json', 'c.json'], 'ab.json')
+        with open('ab.json', 'r') as f:
+            self.assertEqual(json.load(f), {'input': {'reads': 5}, 'unmapped': {'reads': 1, 'bases': 10, 'mean_length': 10.0}})
+
+# -------------------------------------
+
+if __name__ == '__main__':
+
+    unittest.main()
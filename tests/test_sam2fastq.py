@@ -0,0 +1,231 @@
+#!/usr/bin/env python
+
+"""
+    Tests of the conversion of sam records to fastq (scripts/sam2fastq.py)
+    ~~~~~~
+"""
+
+import os
+import sys
+import gzip
+import shutil
+import struct
+import tempfile
+import unittest
+import subprocess
+from StringIO import StringIO
+
+repo = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(repo, 'scripts'))
+
+import sam2fastq
+
+# -------------------------------------
+
+# the empty block bgzip ends a file with
+bgzf_eof = '1f8b08040000000000ff0600424302001b0003000000000000000000'.decode('hex')
+
+# -------------------------------------
+
+class TestBgzfWriter(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.file = os.path.join(self.dir, 'out.fastq.gz')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def blocks(self):
+        """Return the (compressed size, uncompressed size) of each block of the file"""
+
+        with open(self.file, 'rb') as f:
+            data = f.read()
+        (blocks, i) = ([], 0)
+        while i < len(data):
+            bsize = struct.unpack('<H', data[i + 16:i + 18])[0] + 1
+            blocks.append((bsize, struct.unpack('<I', data[i + bsize - 4:i + bsize])[0]))
+            i += bsize
+        self.assertEqual(i, len(data))
+        self.assertTrue(data.endswith(bgzf_eof))
+
+        return blocks
+
+    def test_round_trip(self):
+        # many small writes, and a few bigger than a block
+        pieces = ['@read{0}/1\n{1}\n+\n{2}\n'.format(k, 'ACGT' * (k % 40), 'I' * 4 * (k % 40)) for k in range(5000)]
+        pieces[10] = 'N' * 200000
+        pieces[11] = 'A'
+        w = sam2fastq.BgzfWriter(self.file)
+        for i in pieces:
+            w.write(i)
+        w.close()
+
+        with gzip.open(self.file, 'rb') as f:
+            self.assertEqual(f.read(), ''.join(pieces))
+        # full blocks, then what's left, then the end of file block
+        sizes = [i[1] for i in self.blocks()]
+        self.assertEqual(sizes[:-2], [sam2fastq.BgzfWriter.blocksize] * (len(sizes) - 2))
+        self.assertEqual(sum(sizes), len(''.join(pieces)))
+        self.assertEqual(sizes[-1], 0)
+
+    def test_empty(self):
+        sam2fastq.BgzfWriter(self.file).close()
+        with open(self.file, 'rb') as f:
+            self.assertEqual(f.read(), bgzf_eof)
+
+# -------------------------------------
+
+class TestFlagStat(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_tally(self):
+        stats = sam2fastq.FlagStat()
+        # a proper pair, a pair with neither mapped, a singleton and its unmapped mate,
+        # a secondary and a supplementary alignment, a duplicate, and a QC-failed mate
+        for flag in [99, 147, 77, 141, 73, 133, 353, 2145, 1123, 675]:
+            stats.count(flag)
+        stats.count(99, 2)
+        # mates on different references, with low and high mapq
+        stats.mate(97, 'chr1', '3', 'chr2')
+        stats.mate(97, 'chr1', '30', 'chr2')
+        stats.mate(609, 'chr1', '30', 'chr3')
+        stats.mate(97, 'chr1', '30', '=')
+        stats.mate(97, 'chr1', '30', 'chr1')
+
+        c = stats.tally()
+        self.assertEqual(c['total'], [11, 1])
+        self.assertEqual((c['secondary'], c['supplementary'], c['duplicates']), ([1, 0], [1, 0], [1, 0]))
+        # (mapped counts secondary and supplementary alignments too; the rest only primary ones)
+        self.assertEqual(c['mapped'], [8, 1])
+        self.assertEqual(c['paired'], [9, 1])
+        self.assertEqual((c['read1'], c['read2']), ([6, 0], [3, 1]))
+        self.assertEqual((c['proper'], c['pairmapped'], c['singletons']), ([5, 1], [5, 1], [1, 0]))
+        self.assertEqual((c['diffchr'], c['diffchrq5']), ([2, 1], [1, 1]))
+
+    def test_write(self):
+        stats = sam2fastq.FlagStat()
+        stats.count(99, 3)
+        stats.count(77)
+        outfile = os.path.join(self.dir, 'stats.txt')
+        stats.write(outfile)
+        with open(outfile, 'r') as f:
+            lines = f.read().splitlines()
+        self.assertEqual(len(lines), 13)
+        self.assertEqual(lines[0], '4 + 0 in total (QC-passed reads + QC-failed reads)')
+        self.assertEqual(lines[4], '3 + 0 mapped (75.00% : N/A)')
+        self.assertEqual(lines[8], '3 + 0 properly paired (75.00% : N/A)')
+        self.assertEqual(lines[10], '0 + 0 singletons (0.00% : N/A)')
+
+# -------------------------------------
+
+def record(id, flag, seq):
+    """A sam record of an unmapped read"""
+
+    return '\t'.join([id, str(flag), '*', '0', '0', '*', '*', '0', '0', seq, 'I' * len(seq)]) + '\n'
+
+# -------------------------------------
+
+class TestPairs(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_pairs_in_memory(self):
+        pairs = sam2fastq.Pairs(os.path.join(self.dir, 'out'), 10)
+        self.assertIsNone(pairs.add('r1', '2', 'CC', 'BB'))
+        self.assertIsNone(pairs.add('r2', '1', 'GG', 'DD'))
+        # mate 1 comes first, whichever came first
+        self.assertEqual(pairs.add('r1', '1', 'AA', 'II'), (('AA', 'II'), ('CC', 'BB')))
+        self.assertEqual(list(pairs.finish()), [])
+
+    def test_pairs_spilled(self):
+        # no more than 3 waiting in memory: most mates meet their partner on disk
+        pairs = sam2fastq.Pairs(os.path.join(self.dir, 'out'), 3)
+        found = {}
+        for k in range(20):
+            found['r' + str(k)] = pairs.add('r' + str(k), '1', 'A' * k, 'I' * k)
+        for k in range(19, -1, -1):
+            if k != 7:
+                found['r' + str(k)] = found['r' + str(k)] or pairs.add('r' + str(k), '2', 'C' * k, 'J' * k)
+        stderr = sys.stderr
+        sys.stderr = StringIO()
+        try:
+            found.update(pairs.finish())
+            warning = sys.stderr.getvalue()
+        finally:
+            sys.stderr = stderr
+
+        for k in range(20):
+            if k != 7:
+                self.assertEqual(found['r' + str(k)], (('A' * k, 'I' * k), ('C' * k, 'J' * k)))
+        # r7 has no mate 2
+        self.assertIsNone(found['r7'])
+        self.assertIn('dropped 1 reads', warning)
+        # the spill files are gone
+        self.assertEqual(os.listdir(self.dir), [])
+
+    def test_write_pair(self):
+        (f, g) = (StringIO(), StringIO())
+        self.assertEqual(sam2fastq.write_pair(f, g, 'r1', (('AAA', 'III'), ('CCCC', 'JJJJ')), 3), 2)
+        self.assertEqual((f.getvalue(), g.getvalue()), ('@r1/1\nAAA\n+\nIII\n', '@r1/2\nCCCC\n+\nJJJJ\n'))
+        # either mate too short drops both
+        self.assertEqual(sam2fastq.write_pair(f, g, 'r2', (('AAAA', 'IIII'), ('CC', 'JJ')), 3), 0)
+        self.assertEqual(sam2fastq.write_pair(f, g, 'r3', (('AA', 'II'), ('CCCC', 'JJJJ')), 3), 0)
+        self.assertEqual(f.getvalue().count('@'), 1)
+        self.assertEqual(g.getvalue().count('@'), 1)
+
+# -------------------------------------
+
+class TestCommand(unittest.TestCase):
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.dir = tempfile.mkdtemp()
+        os.chdir(self.dir)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.dir)
+
+    def sam2fastq(self, records, *args):
+        cmd = [sys.executable, os.path.join(repo, 'scripts', 'sam2fastq.py'), 'out', 'False'] + list(args)
+        proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        (out, err) = proc.communicate(''.join(records))
+        return (proc.returncode, err)
+
+    def test_readlenfilter_keeps_pairs_in_step(self):
+        # r2's mate 2 is too short; the mates are out of order
+        records = [record('r1', 77, 'A' * 30), record('r2', 141, 'C' * 10), record('r2', 77, 'G' * 30), record('r1', 141, 'T' * 30)]
+        (code, err) = self.sam2fastq(records, '--pair', '--readlenfilter', '25')
+        self.assertEqual(code, 0)
+        with open('out_1.fastq', 'r') as f:
+            self.assertEqual(f.read(), '@r1/1\n' + 'A' * 30 + '\n+\n' + 'I' * 30 + '\n')
+        with open('out_2.fastq', 'r') as f:
+            self.assertEqual(f.read(), '@r1/2\n' + 'T' * 30 + '\n+\n' + 'I' * 30 + '\n')
+
+    def test_readlenfilter_needs_pair(self):
+        (code, err) = self.sam2fastq([record('r1', 77, 'A' * 30)], '--readlenfilter', '25')
+        self.assertEqual(code, 2)
+        self.assertIn('--readlenfilter needs --pair', err)
+        # single end reads don't
+        cmd = [sys.executable, os.path.join(repo, 'scripts', 'sam2fastq.py'), 'out', 'True', '--readlenfilter', '25']
+        proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        proc.communicate(record('r1', 4, 'A' * 30) + record('r2', 4, 'A' * 20))
+        self.assertEqual(proc.returncode, 0)
+        with open('out_1.fastq', 'r') as f:
+            self.assertEqual(f.read().count('@'), 1)
+
+# -------------------------------------
+
+if __name__ == '__main__':
+
+    unittest.main()
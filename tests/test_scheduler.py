@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+
+"""
+    Tests of the local scheduling of steps (helpers/scheduler.py)
+    ~~~~~~
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+from StringIO import StringIO
+
+repo = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repo)
+
+from helpers import scheduler
+
+# -------------------------------------
+
+def task(name, cores, mem, priority, seconds=0.2, fail=False):
+    """A task which logs when it starts and ends"""
+
+    cmd = 'echo start {0} >> events.txt; sleep {1}; echo end {0} >> events.txt'.format(name, seconds)
+    if fail:
+        cmd += '; false'
+
+    return {'cmd': cmd, 'cores': cores, 'mem': mem, 'priority': priority}
+
+# -------------------------------------
+
+class TestRunDag(unittest.TestCase):
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.dir = tempfile.mkdtemp()
+        os.chdir(self.dir)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.dir)
+
+    def run_dag(self, tasks, deps, cores, mem):
+        stdout = sys.stdout
+        sys.stdout = StringIO()
+        try:
+            status = scheduler.run_dag(tasks, deps, cores, mem, 0, 'log.o', 'log.e')
+        finally:
+            sys.stdout = stdout
+        with open('events.txt', 'r') as f:
+            events = [i.split() for i in f]
+        return (status, events)
+
+    def test_limits(self):
+        tasks = dict((i, task(i, 2, 1, 0)) for i in 'abcde')
+        (status, events) = self.run_dag(tasks, {}, 4, 100)
+        self.assertEqual(status, dict((i, 0) for i in 'abcde'))
+
+        # never more than 4 cores' worth (2 tasks) at once
+        (running, most) = (0, 0)
+        for (event, name) in events:
+            running += 1 if event == 'start' else -1
+            most = max(most, running)
+        self.assertEqual(most, 2)
+
+    def test_memory_and_oversized(self):
+        # b asks for more memory than there is: it's capped, so it runs (alone)
+        tasks = {'a': task('a', 1, 6, 0), 'b': task('b', 1, 20, 1), 'c': task('c', 1, 6, 2)}
+        (status, events) = self.run_dag(tasks, {}, 8, 10)
+        self.assertEqual(status, {'a': 0, 'b': 0, 'c': 0})
+        self.assertEqual(events, [['start', 'a'], ['end', 'a'], ['start', 'b'], ['end', 'b'], ['start', 'c'], ['end', 'c']])
+
+    def test_grant_in_environment(self):
+        # each task finds what it was granted (capped at what there is) in its environment
+        tasks = {'a': task('a', 2, 3, 0), 'b': task('b', 16, 50, 1)}
+        tasks['a']['cmd'] += '; echo $PANDORA_CORES $PANDORA_MEM > a.txt'
+        tasks['b']['cmd'] += '; echo $PANDORA_CORES $PANDORA_MEM > b.txt'
+        self.run_dag(tasks, {}, 4, 10)
+        for (name, granted) in [('a', [2, 3]), ('b', [4, 10])]:
+            with open(name + '.txt', 'r') as f:
+                self.assertEqual([float(i) for i in f.read().split()], granted)
+
+    def test_dependencies_and_skips(self):
+        tasks = {'1': task('1', 1, 1, 0, fail=True), '2': task('2', 1, 1, 1), '3': task('3', 1, 1, 2), '4': task('4', 1, 1, 3)}
+        deps = {'2': set('1'), '3': set('2'), '4': set()}
+        (status, events) = self.run_dag(tasks, deps, 4, 100)
+        # a failure skips everything downstream of it, however far, but nothing else
+        self.assertEqual(status, {'1': 1, '2': None, '3': None, '4': 0})
+        self.assertEqual(sorted(i[1] for i in events if i[0] == 'start'), ['1', '4'])
+
+    def test_big_task_not_starved(self):
+        # x holds half the cores; big needs them all, and outranks the stream of small tasks behind it
+        tasks = {'x': task('x', 2, 1, 0, 0.3), 'big': task('big', 4, 1, 1, 0.1)}
+        for k in range(6):
+            tasks['s' + str(k)] = task('s' + str(k), 1, 1, 2, 0.2)
+        (status, events) = self.run_dag(tasks, {}, 4, 100)
+        self.assertTrue(all(i == 0 for i in status.values()))
+
+        starts = [i[1] for i in events if i[0] == 'start']
+        # nothing takes the cores big is waiting for: it starts as soon as x is done
+        self.assertEqual(starts[:2], ['x', 'big'])
+
+    def test_backfill_around_reservation(self):
+        # big waits on x's cores (all of them); small1 is expected to be done before x is (going by
+        # their hours), so it backfills ahead of big; small2 might not be, so it waits
+        tasks = {'x': task('x', 3, 1, 0, 0.4), 'big': task('big', 4, 1, 1, 0.1), 'small1': task('small1', 1, 1, 2, 0.1), 'small2': task('small2', 1, 1, 3, 0.1)}
+        (tasks['x']['hours'], tasks['small1']['hours'], tasks['small2']['hours']) = (1, 0.5, 2)
+        (status, events) = self.run_dag(tasks, {}, 4, 100)
+        starts = [i[1] for i in events if i[0] == 'start']
+        # (x and small1 start together, so they may log in either order)
+        self.assertEqual(sorted(starts[:2]), ['small1', 'x'])
+        self.assertLess(starts.index('big'), starts.index('small2'))
+
+# -------------------------------------
+
+class TestStepGraph(unittest.TestCase):
+
+    def test_step_graph(self):
+        io = {'1': (['in.fq'], ['a']), '2': (['a'], ['b', 'c']), '3': (['b', None], ['d']), '4': (['c', 'a'], ['e'])}
+        self.assertEqual(scheduler.step_graph('1234', io), {'1': set(), '2': set('1'), '3': set('2'), '4': set('12')})
+        # steps not being run are assumed done
+        self.assertEqual(scheduler.step_graph('34', io), {'3': set(), '4': set()})
+
+# -------------------------------------
+
+if __name__ == '__main__':
+
+    unittest.main()
@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+
+"""
+    Tests of the count of the jobs sharing a STAR genome in shared memory (helpers/star_shm.py),
+    with STAR stubbed out
+    ~~~~~~
+"""
+
+import os
+import sys
+import json
+import shutil
+import tempfile
+import unittest
+import subprocess
+from StringIO import StringIO
+
+repo = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repo)
+
+from helpers import helpers as hp
+from helpers import star_shm
+
+# -------------------------------------
+
+class TestSharedGenome(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        # STAR: record the --genomeLoad mode of each run, and succeed (or not)
+        (self.run_pipeline, self.calls, self.returncode) = (hp.run_pipeline, [], 0)
+        def run_pipeline(stages, bool_verbose, **kwargs):
+            self.calls.append(stages[0][stages[0].index('--genomeLoad') + 1])
+            return ([self.returncode], None)
+        hp.run_pipeline = run_pipeline
+        (self.stdout, sys.stdout) = (sys.stdout, StringIO())
+
+    def tearDown(self):
+        sys.stdout = self.stdout
+        hp.run_pipeline = self.run_pipeline
+        genome = star_shm.SharedGenome(self.dir, 0)
+        for i in [genome.lockfile, genome.statefile]:
+            if os.path.exists(i):
+                os.remove(i)
+        shutil.rmtree(self.dir)
+
+    def state(self, genome, state=None):
+        """Return the state of a genome (after setting it, if given)"""
+
+        if state is not None:
+            with open(genome.statefile, 'w') as f:
+                json.dump(state, f)
+        with open(genome.statefile, 'r') as f:
+            return json.load(f)
+
+    def test_first_loads_last_removes(self):
+        genome = star_shm.SharedGenome(self.dir, 0)
+        self.assertTrue(genome.attach())
+        self.assertEqual(self.calls, ['LoadAndExit'])
+        self.assertEqual(self.state(genome), {'loaded': True, 'pids': [os.getpid()]})
+
+        genome.detach()
+        self.assertEqual(self.calls, ['LoadAndExit', 'Remove'])
+        self.assertEqual(self.state(genome), {'loaded': False, 'pids': []})
+        # (only once)
+        genome.detach()
+        self.assertEqual(len(self.calls), 2)
+
+    def test_other_jobs(self):
+        # another job on the node is using the genome, and one died without detaching
+        other = subprocess.Popen(['sleep', '30'])
+        dead = subprocess.Popen(['true'])
+        dead.wait()
+        genome = star_shm.SharedGenome(self.dir, 0)
+        self.state(genome, {'loaded': True, 'pids': [other.pid, dead.pid]})
+        try:
+            self.assertTrue(genome.attach())
+            # already loaded; the dead job is dropped from the count
+            self.assertEqual(self.calls, [])
+            self.assertEqual(self.state(genome)['pids'], [other.pid, os.getpid()])
+
+            # the other job still uses it
+            genome.detach()
+            self.assertEqual(self.calls, [])
+            self.assertEqual(self.state(genome), {'loaded': True, 'pids': [other.pid]})
+        finally:
+            other.kill()
+            other.wait()
+
+        # nobody's left, so the next job to detach removes it
+        genome.attach()
+        genome.detach()
+        self.assertEqual(self.calls, ['Remove'])
+
+    def test_load_fails(self):
+        self.returncode = 1
+        genome = star_shm.SharedGenome(self.dir, 0)
+        # STAR loads its own copy instead: nothing to count, or remove
+        self.assertFalse(genome.attach())
+        self.assertEqual(self.state(genome), {'loaded': False, 'pids': []})
+        genome.detach()
+        self.assertEqual(self.calls, ['LoadAndExit'])
+
+# -------------------------------------
+
+if __name__ == '__main__':
+
+    unittest.main()